@@ -1,7 +1,20 @@
+import asyncio
+import os
+import sys
+import random
+from array import array
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 
+# Pulls are written in the prepped-slate columnar format from 'opto/code/'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opto', 'code'))
+import slate_file
+import odds_store
+
 # Define headers for requests
 headers = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:132.0) Gecko/20100101 Firefox/132.0",
@@ -13,90 +26,327 @@ headers = {
     "Priority": "u=0"
 }
 
-# Base URL components
-BASE_URL = "https://sportsbook-nash.draftkings.com/api/sportscontent/dkusoh/v1/leagues/{leagueId}/categories/{categoryId}/subcategories/{subcategoryId}"
+# Base URL components, point BASE_HOST at dksb_stub.py to run offline
+BASE_HOST = "https://sportsbook-nash.draftkings.com"
+API_PATH = "/api/sportscontent/dkusoh/v1/leagues/{leagueId}/categories/{categoryId}/subcategories/{subcategoryId}"
+BASE_URL = BASE_HOST + API_PATH
 
-# Main function to extract data
-def fetch_and_save_selections(league_id, categories, subcategories):
-    all_data = {}
+# Fetch engine settings: requests in flight, average request rate and burst, retries on
+# throttling and server errors with exponential backoff
+MAX_CONCURRENCY = 8
+REQUESTS_PER_SECOND = 4
+BURST = 8
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+# Longest wait before a retry, whatever the server's Retry-After asks for
+MAX_BACKOFF = 60
+RETRY_STATUS = {429, 500, 502, 503, 504}
+REQUEST_TIMEOUT = 15
 
-    for subcategory in subcategories:
-        category_id = subcategory.get("categoryId")
-        subcategory_id = subcategory.get("id")
-        subcategory_name = subcategory.get("name", "Unknown Subcategory")
 
-        # Construct endpoint for each subcategory
-        endpoint = BASE_URL.format(leagueId=league_id, categoryId=category_id, subcategoryId=subcategory_id)
-        print(f"Fetching data from URL: {endpoint}")
+class TokenBucket:
+    # Hands out `rate` tokens per second on average, holding at most `capacity` for bursts.
+    # Waiters queue on the lock so tokens go out in request order.
 
-        # Fetch data from constructed endpoint
-        response = requests.get(endpoint, headers=headers)
-        if response.status_code == 200:
-            print(f"Received status code 200 for subcategory {subcategory_name} (ID: {subcategory_id})")
-            data = response.json()
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def make_session(pool_size=MAX_CONCURRENCY):
+    # One keep-alive session with a connection pool as large as the number of requests in flight
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def backoff_delay(attempt, retry_after=None):
+    # Server's Retry-After when it gives seconds, otherwise exponential backoff with jitter,
+    # capped at MAX_BACKOFF
+    if retry_after is not None and retry_after.strip().isdigit():
+        return min(float(retry_after), MAX_BACKOFF)
+    return min(BACKOFF_BASE * 2 ** attempt + random.uniform(0, BACKOFF_BASE), MAX_BACKOFF)
+
+
+async def fetch_json(session, bucket, semaphore, endpoint, validators=None):
+    # GETs one endpoint. Returns (status, data, validators); status 304 means the market is
+    # unchanged since the ETag/Last-Modified in validators, None means it never got a response.
+    request_headers = {}
+    if validators:
+        if validators.get("etag"):
+            request_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            request_headers["If-Modified-Since"] = validators["last_modified"]
+
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                response = await asyncio.to_thread(session.get, endpoint, headers=request_headers,
+                                                   timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                if attempt == MAX_RETRIES:
+                    print(f"Giving up on {endpoint} after {attempt + 1} attempts: {e}")
+                    return None, None, validators
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS and attempt < MAX_RETRIES:
+                print(f"Status code {response.status_code} from {endpoint}, retrying")
+                await asyncio.sleep(backoff_delay(attempt, response.headers.get("Retry-After")))
+                continue
+            if response.status_code == 200:
+                new_validators = {"etag": response.headers.get("ETag"),
+                                  "last_modified": response.headers.get("Last-Modified")}
+                return 200, response.content, new_validators
+            return response.status_code, None, validators
+
+
+def recording_path(record_dir, league_id, category_id, subcategory_id):
+    # Where a raw subcategory response is recorded, and where dksb_stub.py replays it from
+    return os.path.join(record_dir, f"{league_id}_{category_id}_{subcategory_id}.json")
+
+
+# Selections are extracted into one buffer per column: identifiers and labels as text, odds and
+# lines as floats. SELECTION_KEY_COLUMN ties each row back to the subcategory it came from.
+SELECTION_KEY_COLUMN = "subcategory"
+TEXT_COLUMNS = [SELECTION_KEY_COLUMN, "event_id", "event_name", "market_id", "market_name", "selection_id",
+                "label", "outcome_type", "participants"]
+NUMERIC_COLUMNS = ["points", "odds_american", "odds_decimal"]
+PARTICIPANT_SEPARATOR = "|"
+
+
+def _to_float(value):
+    # Odds strings come as '+150', '-110' or with a unicode minus, missing values become NaN
+    if value is None or value == "":
+        return float("nan")
+    if isinstance(value, str):
+        value = value.replace("\u2212", "-")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+class SelectionColumns:
+    # Columnar buffers filled while walking each response's events, markets and selections, so
+    # no per-selection record is ever built. The response itself is still parsed whole by
+    # json.loads, only the records are avoided.
+
+    def __init__(self):
+        self.text = {col: [] for col in TEXT_COLUMNS}
+        self.numbers = {col: array("d") for col in NUMERIC_COLUMNS}
+
+    def __len__(self):
+        return len(self.text[SELECTION_KEY_COLUMN])
+
+    def to_frame(self):
+        frame = pd.DataFrame({col: pd.Categorical(values) for col, values in self.text.items()})
+        for col, values in self.numbers.items():
+            frame[col] = np.frombuffer(values, dtype=np.float64) if len(values) else np.empty(0)
+        return frame
+
+
+def extract_selections_data(data, subcategory_key=None, columns=None, debug=False):
+    # Appends every selection in one API response to `columns` and returns it, tagged with the
+    # subcategory it was fetched for when given
+    columns = columns if columns is not None else SelectionColumns()
+    text = columns.text
+    numbers = columns.numbers
 
-            # Debug: Print the raw JSON structure to examine
-            print("Raw JSON data received:")
-            print(json.dumps(data, indent=4))  # Only for troubleshooting, remove after verifying structure
-
-            # Extract selections data
-            extracted_selections = extract_selections_data(data)
-            if extracted_selections:
-                all_data[f"{category_id}_{subcategory_id}"] = extracted_selections
-            else:
-                print(f"No selections data found for subcategory {subcategory_name} (ID: {subcategory_id})")
-
-            # Add delay to avoid rate limiting
-            time.sleep(1)
-        else:
-            print(f"Failed to fetch data for {subcategory_name} (ID: {subcategory_id}). Status code: {response.status_code}")
-
-    # Save data to a JSON file
-    output_filename = f"league_{league_id}_selections_data.json"
-    with open(output_filename, 'w') as f:
-        json.dump(all_data, f, indent=4)
-    print(f"Data successfully saved to {output_filename}")
-
-# Extract selections data from API response
-def extract_selections_data(data):
-    selections_data = []
-
-    # Debug: Print key access points
     if "events" not in data:
-        print("No 'events' key found in data.")
-        return selections_data
+        if debug:
+            print("No 'events' key found in data.")
+        return columns
 
     for event in data.get("events", []):
-        event_id = event.get("eventId")
+        event_id = str(event.get("eventId"))
         event_name = event.get("name", "Unknown Event")
         participants = {p["id"]: p.get("name", "Unknown") for p in event.get("participants", [])}
 
         for market in event.get("markets", []):
-            market_id = market.get("id")
+            market_id = str(market.get("id"))
             market_name = market.get("name", "Unknown Market")
+            selections = market.get("selections") or []
 
-            for selection in market.get("selections", []):
-                selection_data = {
-                    "event_id": event_id,
-                    "event_name": event_name,
-                    "market_id": market_id,
-                    "market_name": market_name,
-                    "selection_id": selection.get("id"),
-                    "label": selection.get("label"),
-                    "odds": selection.get("displayOdds", {}),
-                    "outcome_type": selection.get("outcomeType"),
-                    "points": selection.get("points"),
-                    "participants": [
-                        participants.get(p["id"], "Unknown") for p in selection.get("participants", [])
-                    ]
-                }
-                selections_data.append(selection_data)
-
-            # Debug: Log empty markets or selections if not found
-            if not market.get("selections"):
+            # Debug: Log empty markets
+            if debug and not selections:
                 print(f"No selections found in market '{market_name}' (Market ID: {market_id}) for event '{event_name}' (Event ID: {event_id})")
 
-    return selections_data
+            for selection in selections:
+                odds = selection.get("displayOdds") or {}
+                text[SELECTION_KEY_COLUMN].append(subcategory_key)
+                text["event_id"].append(event_id)
+                text["event_name"].append(event_name)
+                text["market_id"].append(market_id)
+                text["market_name"].append(market_name)
+                text["selection_id"].append(str(selection.get("id")))
+                text["label"].append(selection.get("label"))
+                text["outcome_type"].append(selection.get("outcomeType"))
+                text["participants"].append(PARTICIPANT_SEPARATOR.join(
+                    participants.get(p["id"], "Unknown") for p in selection.get("participants", [])))
+                numbers["points"].append(_to_float(selection.get("points")))
+                numbers["odds_american"].append(_to_float(odds.get("american")))
+                numbers["odds_decimal"].append(_to_float(odds.get("decimal")))
+
+    return columns
+
+
+async def fetch_selections(league_id, subcategories, base_url=BASE_URL, previous=None, validators=None,
+                           record_dir=None, concurrency=MAX_CONCURRENCY, rate=REQUESTS_PER_SECOND, debug=False):
+    # Fetches every subcategory concurrently and returns all selections as one columnar frame.
+    # Subcategories with rows in the `previous` pull are requested conditionally and their rows
+    # are reused as-is when the server says they haven't changed.
+    validators = validators if validators is not None else {}
+    previous_keys = set(previous[SELECTION_KEY_COLUMN].astype(str)) if previous is not None else set()
+    session = make_session(concurrency)
+    bucket = TokenBucket(rate, BURST)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    requests_to_send = []
+    for subcategory in subcategories:
+        category_id = subcategory.get("categoryId")
+        subcategory_id = subcategory.get("id")
+        endpoint = base_url.format(leagueId=league_id, categoryId=category_id, subcategoryId=subcategory_id)
+        key = f"{category_id}_{subcategory_id}"
+        requests_to_send.append((subcategory, key, endpoint, validators.get(endpoint) if key in previous_keys else None))
+
+    try:
+        results = await asyncio.gather(*[fetch_json(session, bucket, semaphore, endpoint, endpoint_validators)
+                                         for _, _, endpoint, endpoint_validators in requests_to_send])
+    finally:
+        session.close()
+
+    columns = SelectionColumns()
+    unchanged_keys = []
+    for (subcategory, key, endpoint, _), (status, content, new_validators) in zip(requests_to_send, results):
+        category_id = subcategory.get("categoryId")
+        subcategory_id = subcategory.get("id")
+        subcategory_name = subcategory.get("name", "Unknown Subcategory")
+
+        if status == 304:
+            print(f"Subcategory {subcategory_name} (ID: {subcategory_id}) unchanged, keeping saved selections")
+            unchanged_keys.append(key)
+            continue
+        if status != 200:
+            print(f"Failed to fetch data for {subcategory_name} (ID: {subcategory_id}). Status code: {status}")
+            continue
+
+        print(f"Received status code 200 for subcategory {subcategory_name} (ID: {subcategory_id})")
+        validators[endpoint] = new_validators
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+            with open(recording_path(record_dir, league_id, category_id, subcategory_id), 'wb') as f:
+                f.write(content)
+        data = json.loads(content)
+
+        # Debug: Print the raw JSON structure to examine
+        if debug:
+            print("Raw JSON data received:")
+            print(json.dumps(data, indent=4))
+
+        # Extract selections data
+        found = len(columns)
+        extract_selections_data(data, key, columns, debug)
+        if len(columns) == found:
+            print(f"No selections data found for subcategory {subcategory_name} (ID: {subcategory_id})")
+
+    frames = [columns.to_frame()]
+    if unchanged_keys:
+        frames.append(previous[previous[SELECTION_KEY_COLUMN].astype(str).isin(unchanged_keys)])
+    # Union the text categories across the new and reused rows
+    selections = pd.concat(frames, ignore_index=True)
+    return selections.astype({col: "category" for col in TEXT_COLUMNS})
+
+
+def pull_path(output_dir, league_id, pulled_at):
+    return os.path.join(output_dir, f"league_{league_id}_selections_{pulled_at}{slate_file.SLATE_EXTENSION}")
+
+
+def latest_pull(output_dir, league_id):
+    # Path of the most recent pull for a league, None if there isn't one. Timestamps in the file
+    # names sort in time order.
+    prefix = f"league_{league_id}_selections_"
+    pulls = sorted(f for f in os.listdir(output_dir)
+                   if f.startswith(prefix) and f.endswith(slate_file.SLATE_EXTENSION))
+    return os.path.join(output_dir, pulls[-1]) if pulls else None
+
+
+def load_pull(path):
+    # Selections frame of one pull, memory-mapped
+    return slate_file.open_slate(path)["selections"]
+
+
+def update_odds_store(output_dir, league_id):
+    # Appends every saved pull for a league that isn't in its odds store yet, oldest first
+    prefix = f"league_{league_id}_selections_"
+    store = odds_store.OddsStore(odds_store.store_path(output_dir, league_id))
+    try:
+        pulled = store.pulled()
+        changed = 0
+        for f in sorted(os.listdir(output_dir)):
+            if not (f.startswith(prefix) and f.endswith(slate_file.SLATE_EXTENSION)):
+                continue
+            pulled_at = odds_store.pull_timestamp(f[len(prefix):-len(slate_file.SLATE_EXTENSION)])
+            if pulled_at not in pulled:
+                changed += store.append_pull(load_pull(os.path.join(output_dir, f)), pulled_at, league_id,
+                                             PARTICIPANT_SEPARATOR)
+        return changed
+    finally:
+        store.close()
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+# Main function to extract data
+def fetch_and_save_selections(league_id, categories, subcategories, base_url=BASE_URL, output_dir=".",
+                              record_dir=None, concurrency=MAX_CONCURRENCY, rate=REQUESTS_PER_SECOND, debug=False):
+    # Each pull is written as one columnar file. The latest pull and the ETag/Last-Modified of
+    # each endpoint are kept between runs so unchanged markets aren't downloaded again.
+    validators_filename = os.path.join(output_dir, f"league_{league_id}_http_cache.json")
+    validators = _load_json(validators_filename, {})
+    previous_path = latest_pull(output_dir, league_id)
+    previous = load_pull(previous_path) if previous_path else None
+
+    selections = asyncio.run(fetch_selections(league_id, subcategories, base_url, previous, validators,
+                                              record_dir, concurrency, rate, debug))
+
+    # Save the pull as a columnar file
+    pulled_at = odds_store.pull_name(time.time())
+    output_filename = pull_path(output_dir, league_id, pulled_at)
+    metadata = {"league_id": league_id, "pulled_at": pulled_at, "subcategories": len(subcategories)}
+    slate_file.write_slate(output_filename, {"selections": selections}, metadata)
+    with open(validators_filename, 'w') as f:
+        json.dump(validators, f, indent=4)
+    print(f"{len(selections)} selections successfully saved to {output_filename}")
+
+    # Keep the line history, only changed odds and points are stored
+    changed = update_odds_store(output_dir, league_id)
+    print(f"{changed} selections moved since the previous pull")
+    return selections
+
 
 # Sample categories and subcategories input (Normally, you'd retrieve these from another API call)
 categories = [
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dksb
+
+# Local stand-in for the sportsbook API. Replays responses recorded with
+# fetch_and_save_selections(..., record_dir=...), answers conditional requests from each
+# file's hash and mtime, and can throttle the first requests to each path to exercise retries.
+API_PATTERN = re.compile(r"/leagues/(\d+)/categories/(\d+)/subcategories/(\d+)")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        match = API_PATTERN.search(self.path)
+        path = dksb.recording_path(self.server.record_dir, *match.groups()) if match else None
+        if path is None or not os.path.exists(path):
+            self._send(404)
+            return
+
+        # Injected throttling before the recorded response is served
+        with self.server.lock:
+            hits = self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        if hits <= self.server.throttle_first:
+            self._send(429, extra_headers={"Retry-After": "0"})
+            return
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        mtime = int(os.path.getmtime(path))
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        validators = {"ETag": etag, "Last-Modified": formatdate(mtime, usegmt=True)}
+
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            unchanged = if_none_match == etag
+        elif if_modified_since is not None:
+            unchanged = parsedate_to_datetime(if_modified_since).timestamp() >= mtime
+        else:
+            unchanged = False
+        if unchanged:
+            self._send(304, extra_headers=validators)
+            return
+        self._send(200, body, validators)
+
+    def _send(self, status, body=b"", extra_headers=None):
+        self.send_response(status)
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_stub_server(record_dir, port=0, throttle_first=0, verbose=False):
+    # Serves record_dir from a background thread. Returns the server and a base URL template to
+    # pass to fetch_and_save_selections; call server.shutdown() when done.
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.record_dir = record_dir
+    server.throttle_first = throttle_first
+    server.verbose = verbose
+    server.hits = {}
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}" + dksb.API_PATH
+    return server, base_url
+
+
+if __name__ == "__main__":
+    record_dir = sys.argv[1] if len(sys.argv) > 1 else "recordings"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8808
+    server, base_url = start_stub_server(record_dir, port, verbose=True)
+    print(f"Replaying {record_dir} at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,198 @@
+import calendar
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# Append-only history of sportsbook pulls. A selection gets a snapshot row only when its odds or
+# points differ from its previous snapshot; 'lines' keeps each selection's opening and current
+# values so movement queries never replay the history.
+PRICE_COLUMNS = ["points", "odds_american", "odds_decimal"]
+ATTRIBUTE_COLUMNS = ["event_id", "event_name", "market_id", "market_name", "label", "outcome_type",
+                     "participants", "subcategory"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pulls (
+    pulled_at REAL PRIMARY KEY,
+    league_id INTEGER,
+    selections INTEGER,
+    changed INTEGER
+);
+CREATE TABLE IF NOT EXISTS selections (
+    selection_id TEXT PRIMARY KEY,
+    event_id TEXT, event_name TEXT, market_id TEXT, market_name TEXT,
+    label TEXT, outcome_type TEXT, participants TEXT, subcategory TEXT
+);
+CREATE TABLE IF NOT EXISTS selection_participants (
+    participant TEXT,
+    selection_id TEXT,
+    PRIMARY KEY (participant, selection_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (
+    selection_id TEXT,
+    pulled_at REAL,
+    points REAL, odds_american REAL, odds_decimal REAL,
+    PRIMARY KEY (selection_id, pulled_at)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lines (
+    selection_id TEXT PRIMARY KEY,
+    open_at REAL, open_points REAL, open_odds_american REAL, open_odds_decimal REAL,
+    updated_at REAL, points REAL, odds_american REAL, odds_decimal REAL
+);
+CREATE INDEX IF NOT EXISTS snapshots_pulled_at ON snapshots (pulled_at);
+CREATE INDEX IF NOT EXISTS selections_event ON selections (event_id);
+CREATE INDEX IF NOT EXISTS selections_market ON selections (market_id);
+CREATE INDEX IF NOT EXISTS lines_moved ON lines (updated_at) WHERE updated_at > open_at;
+"""
+
+
+# Pull names are UTC times to the microsecond, two pulls in the same second stay apart
+PULL_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+
+def pull_name(at):
+    # unix seconds -> 'YYYYmmddTHHMMSS.ffffff' (UTC)
+    seconds, micros = divmod(int(round(at * 1e6)), 1000000)
+    return time.strftime(PULL_TIME_FORMAT, time.gmtime(seconds)) + f".{micros:06d}"
+
+
+def pull_timestamp(pulled_at):
+    # 'YYYYmmddTHHMMSS.ffffff' (UTC) from a pull file name or header -> unix seconds. Names from
+    # before the microseconds were added parse to the whole second.
+    seconds, _, fraction = pulled_at.partition(".")
+    return calendar.timegm(time.strptime(seconds, PULL_TIME_FORMAT)) + (int(fraction) / 1e6 if fraction else 0)
+
+
+def _nullable(values):
+    # NaN -> None so sqlite stores NULL
+    return [None if v != v else float(v) for v in values]
+
+
+class OddsStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def pulled(self):
+        return {row[0] for row in self.conn.execute("SELECT pulled_at FROM pulls")}
+
+    def append_pull(self, selections, pulled_at, league_id=None, participant_separator="|"):
+        # Adds one pull (a dksb selections frame) taken at unix time pulled_at. Players in the
+        # participants column are split on participant_separator for the participant index.
+        # Returns the number of selections whose odds or points changed, new selections included.
+        if pulled_at in self.pulled():
+            return 0
+        selections = selections.drop_duplicates("selection_id", keep="last")
+        current = pd.DataFrame({
+            "selection_id": selections["selection_id"].astype(str).to_numpy(),
+            **{col: selections[col].to_numpy(dtype=np.float64) for col in PRICE_COLUMNS},
+        })
+        latest = pd.read_sql_query("SELECT selection_id, points, odds_american, odds_decimal FROM lines", self.conn)
+        merged = current.merge(latest, on="selection_id", how="left", suffixes=("", "_prev"), indicator=True)
+
+        # Changed when any price differs, NaN on both sides counts as equal
+        is_new = (merged["_merge"] == "left_only").to_numpy()
+        changed = is_new.copy()
+        for col in PRICE_COLUMNS:
+            now, prev = merged[col].to_numpy(), merged[f"{col}_prev"].to_numpy(dtype=np.float64)
+            changed |= ~((now == prev) | (np.isnan(now) & np.isnan(prev)))
+        delta = merged[changed]
+
+        rows = list(zip(delta["selection_id"], *(_nullable(delta[col]) for col in PRICE_COLUMNS)))
+        new_ids = set(merged.loc[is_new, "selection_id"])
+        attributes = selections[selections["selection_id"].astype(str).isin(new_ids)]
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                [(sid, pulled_at, *prices) for sid, *prices in rows])
+            self.conn.executemany(
+                "INSERT INTO lines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (selection_id) DO UPDATE SET "
+                "updated_at = excluded.updated_at, points = excluded.points, "
+                "odds_american = excluded.odds_american, odds_decimal = excluded.odds_decimal",
+                [(sid, pulled_at, *prices, pulled_at, *prices) for sid, *prices in rows])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO selections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                zip(attributes["selection_id"].astype(str),
+                    *(attributes[col].astype(object).where(attributes[col].notna(), None) for col in ATTRIBUTE_COLUMNS)))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO selection_participants VALUES (?, ?)",
+                [(name, str(sid)) for sid, names in zip(attributes["selection_id"], attributes["participants"])
+                 if isinstance(names, str) for name in names.split(participant_separator) if name])
+            self.conn.execute("INSERT INTO pulls VALUES (?, ?, ?, ?)",
+                              (pulled_at, league_id, len(current), len(rows)))
+        return len(rows)
+
+    def history(self, participant=None, event_id=None, market_id=None, since=None, until=None):
+        # Snapshots with their selection's attributes, filtered through the indexes. since/until
+        # are unix seconds. Each row is a price that held from pulled_at until the next row.
+        joins = ["JOIN selections s ON s.selection_id = h.selection_id"]
+        where, params = [], []
+        if participant is not None:
+            joins.append("JOIN selection_participants p ON p.selection_id = h.selection_id")
+            where.append("p.participant = ?")
+            params.append(participant)
+        if event_id is not None:
+            where.append("s.event_id = ?")
+            params.append(str(event_id))
+        if market_id is not None:
+            where.append("s.market_id = ?")
+            params.append(str(market_id))
+        if since is not None:
+            where.append("h.pulled_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("h.pulled_at <= ?")
+            params.append(until)
+        query = ("SELECT h.selection_id, h.pulled_at, h.points, h.odds_american, h.odds_decimal, "
+                 "s.event_name, s.market_name, s.label, s.participants FROM snapshots h " + " ".join(joins)
+                 + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY h.selection_id, h.pulled_at")
+        return pd.read_sql_query(query, self.conn, params=params)
+
+    def lines_at(self, at):
+        # Each selection's odds and points as of unix time `at`, from the latest snapshot at or before it
+        query = ("SELECT h.selection_id, h.pulled_at, h.points, h.odds_american, h.odds_decimal FROM snapshots h "
+                 "JOIN (SELECT selection_id, MAX(pulled_at) AS pulled_at FROM snapshots WHERE pulled_at <= ? "
+                 "GROUP BY selection_id) m ON m.selection_id = h.selection_id AND m.pulled_at = h.pulled_at")
+        return pd.read_sql_query(query, self.conn, params=[at])
+
+    def biggest_moves(self, limit=20, participant=None, market_name=None):
+        # Selections ranked by how far their implied probability has moved since open, with the
+        # change in points alongside. Only lines that changed after open are read.
+        joins = ["JOIN selections s ON s.selection_id = l.selection_id"]
+        where, params = ["l.updated_at > l.open_at", "l.open_odds_decimal > 0", "l.odds_decimal > 0"], []
+        if participant is not None:
+            joins.append("JOIN selection_participants p ON p.selection_id = l.selection_id")
+            where.append("p.participant = ?")
+            params.append(participant)
+        if market_name is not None:
+            where.append("s.market_name = ?")
+            params.append(market_name)
+        query = ("SELECT l.selection_id, s.participants, s.market_name, s.label, l.open_at, l.updated_at, "
+                 "l.open_points, l.points, l.open_odds_american, l.odds_american, "
+                 "1.0 / l.odds_decimal - 1.0 / l.open_odds_decimal AS implied_move, "
+                 "l.points - l.open_points AS points_move FROM lines l " + " ".join(joins)
+                 + " WHERE " + " AND ".join(where)
+                 + " ORDER BY ABS(1.0 / l.odds_decimal - 1.0 / l.open_odds_decimal) DESC LIMIT ?")
+        return pd.read_sql_query(query, self.conn, params=params + [limit])
+
+
+def store_path(output_dir, league_id):
+    return os.path.join(output_dir, f"league_{league_id}_odds.sqlite")
+
+
+if __name__ == "__main__":
+    # Biggest moves since open for a league's store, optionally for one player
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else "."
+    league_id = int(sys.argv[2]) if len(sys.argv) > 2 else 88808
+    participant = sys.argv[3] if len(sys.argv) > 3 else None
+    store = OddsStore(store_path(output_dir, league_id))
+    print(store.biggest_moves(participant=participant).to_string(index=False))
+    store.close()
@@ -0,0 +1,33 @@
+import streamlit as st
+
+# Tables in both apps render in Streamlit's virtualized grid, which does the number formatting,
+# so nothing is styled per cell
+TABLE_HEIGHT = 600
+TABLE_FLOAT_FORMAT = '%.2f'
+
+
+def table_column_config(df):
+    # Two decimals for every float column, Proj's help noting it includes the session's overrides
+    config = {col: st.column_config.NumberColumn(col, format=TABLE_FLOAT_FORMAT)
+              for col in df.select_dtypes(include=['float']).columns}
+    if 'Proj' in config:
+        config['Proj'] = st.column_config.NumberColumn('Proj', format=TABLE_FLOAT_FORMAT,
+                                                       help='Projection, after any overrides')
+    return config
+
+
+def show_table(df):
+    st.dataframe(df, column_config=table_column_config(df), hide_index=True, use_container_width=True,
+                 height=min(TABLE_HEIGHT, 38 + 35 * len(df)))
+
+
+def rerun_with_notice(message):
+    # Full app rerun after a sidebar action changed the tables, with the action's message shown
+    # by show_notice on the rerun
+    st.session_state['notice'] = message
+    st.rerun()
+
+
+def show_notice():
+    if 'notice' in st.session_state:
+        st.success(st.session_state.pop('notice'))
@@ -0,0 +1,252 @@
+import os
+import json
+import hashlib
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import settings
+import functions as fn
+import process_csv
+import optimizer
+import enumeration
+import players
+from lineups import LineupStore
+
+# Backtests the prep -> overrides -> lineups chain over archived raw exports and scores the
+# lineups against the export's Actual column. Each stage's output is cached per slate under a
+# key of everything it depends on, so a config change only re-runs the stages downstream of it.
+ACTUAL_COLUMN = 'Actual'
+# Raw columns the prep stage reads beyond the site's prep columns
+PREP_EXTRA_COLUMNS = [ACTUAL_COLUMN]
+
+DEFAULT_CONFIG = {
+    'site': settings.DEFAULT_SITE,
+    # Directory of per-game overrides CSVs named SD_<game>_overrides.csv, None for none
+    'overrides_dir': None,
+    'adjustment_factor': 1.0,
+    # 'optimizer' (MILP with exposure caps) or 'enumerate' (exact top-N)
+    'method': 'optimizer',
+    'metric': 'Proj',
+    'num_lineups': 20,
+    'max_exposure': 1.0,
+}
+
+# Config keys each stage reads, in chain order. A stage's cache key covers its own keys and the
+# key of the stage before it. The prep stage's also covers the settings it reads outside
+# prep_fingerprint: the extra raw columns, the captain columns and the site rules the optimal
+# lineup is priced with. The adjust stage's covers the slate's overrides file contents.
+STAGES = ['prep', 'adjust', 'lineups']
+STAGE_CONFIG = {
+    'prep': ['site'],
+    'adjust': ['adjustment_factor'],
+    'lineups': ['method', 'metric', 'num_lineups', 'max_exposure'],
+}
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def overrides_path(config, game_identifier):
+    if config['overrides_dir'] is None:
+        return None
+    path = os.path.join(config['overrides_dir'], f'SD_{game_identifier}_overrides.csv')
+    return path if os.path.exists(path) else None
+
+
+def stage_keys(raw_csv_file, config):
+    # Cache key of every stage for one slate
+    game_identifier = process_csv.game_identifier_from_path(raw_csv_file)
+    keys = {}
+    previous = process_csv.prep_fingerprint(raw_csv_file, sites=[config['site']])
+    for stage in STAGES:
+        inputs = {key: config[key] for key in STAGE_CONFIG[stage]}
+        if stage == 'prep':
+            inputs.update({'extra_columns': PREP_EXTRA_COLUMNS,
+                           'captain_columns': process_csv.raw_captain_columns([config['site']]),
+                           'site_rules': settings.SITE_RULES[config['site']]})
+        if stage == 'adjust':
+            path = overrides_path(config, game_identifier)
+            inputs['overrides'] = _file_hash(path) if path is not None else None
+        digest = hashlib.sha256((previous + json.dumps(inputs, sort_keys=True)).encode())
+        keys[stage] = previous = digest.hexdigest()
+    return keys
+
+
+def cache_path(cache_dir, raw_csv_file, stage, key):
+    slate_dir = os.path.join(cache_dir, os.path.basename(raw_csv_file).replace('.csv', ''))
+    return os.path.join(slate_dir, f'{stage}_{key[:16]}.pkl')
+
+
+def _cached(path, compute):
+    # Loads a stage result from path, or computes and stores it. Returns (result, was_cached).
+    if os.path.exists(path):
+        return pd.read_pickle(path), True
+    result = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pd.to_pickle(result, tmp_path)
+    os.replace(tmp_path, path)
+    return result, False
+
+
+def prep_stage(raw_csv_file, config):
+    # Prepped player table of the slate, its player registry and each player's actual flex points
+    raw_df = process_csv.read_raw_csv(raw_csv_file, extra_columns=PREP_EXTRA_COLUMNS, sites=[config['site']])
+    registry = players.PlayerRegistry.from_raw(raw_df)
+    player_rows = fn.build_player_table(raw_df, process_csv.raw_captain_columns([config['site']]))
+    table = process_csv.prep_site_table(player_rows, config['site'], registry=registry)
+    actuals = player_rows.set_index('Name')[ACTUAL_COLUMN].reindex(table['Name']).to_numpy(dtype=float)
+    return {'table': table, 'players': registry.to_frame(), 'actual': actuals,
+            'optimal': optimal_actual(table, actuals, config['site'])}
+
+
+def optimal_actual(table, actuals, site):
+    # Best lineup score the slate allowed in hindsight, NaN without actuals
+    if np.isnan(actuals).all():
+        return np.nan
+    rules = settings.SITE_RULES[site]
+    scored = table.assign(**{ACTUAL_COLUMN: np.nan_to_num(actuals)})
+    captain_df = fn.captain_view(scored, rules['captain_multiplier'])
+    captain_df[ACTUAL_COLUMN] = captain_df[ACTUAL_COLUMN] * rules['captain_multiplier']
+    best = enumeration.enumerate_lineups(captain_df, fn.flex_view(scored), metric=ACTUAL_COLUMN, top_k=1,
+                                         salary_cap=rules['salary_cap'], flex_slots=rules['flex_slots'])
+    return float(best[ACTUAL_COLUMN].iloc[0]) if len(best) else np.nan
+
+
+def adjust_stage(prepped, config, game_identifier):
+    # Captain and flex tables with the slate's overrides applied, percentiles rescaled to match
+    table = prepped['table']
+    multiplier = settings.SITE_RULES[config['site']]['captain_multiplier']
+    captain_df, flex_df = fn.captain_view(table, multiplier), fn.flex_view(table).copy()
+    path = overrides_path(config, game_identifier)
+    if path is not None:
+        overrides = fn.read_overrides_csv(path)
+        # The prepped tables carry no DFS IDs, ID-keyed overrides go through the registry to names
+        if overrides.index.name in ('DFS ID', 'ID'):
+            registry = players.PlayerRegistry(prepped['players'])
+            dense = registry.index_of_keys(overrides.index)
+            known = dense >= 0
+            overrides = pd.Series(overrides.to_numpy()[known], index=pd.Index(registry.names[dense[known]], name='Name'))
+        flex_df = fn.apply_projection_overrides(flex_df, overrides, adjustment_factor=config['adjustment_factor'])
+        captain_df = fn.apply_projection_overrides(captain_df, overrides, proj_multiplier=multiplier,
+                                                   adjustment_factor=config['adjustment_factor'])
+    return {'captain': captain_df, 'flex': flex_df}
+
+
+def lineups_stage(adjusted, config):
+    captain_df, flex_df = adjusted['captain'], adjusted['flex']
+    rules = settings.SITE_RULES[config['site']]
+    salary_cap, flex_slots = rules['salary_cap'], rules['flex_slots']
+    if config['method'] == 'enumerate':
+        return enumeration.enumerate_lineups(captain_df, flex_df, metric=config['metric'], top_k=config['num_lineups'],
+                                             salary_cap=salary_cap, flex_slots=flex_slots)
+    lineup_optimizer = optimizer.ShowdownOptimizer(captain_df, flex_df, metric=config['metric'],
+                                                   salary_cap=salary_cap, flex_slots=flex_slots)
+    return lineup_optimizer.generate(config['num_lineups'], default_max_exposure=config['max_exposure'])
+
+
+def score_lineups(prepped, adjusted, lineups_df, config):
+    # Actual points of every lineup, captains at the site's multiplier
+    rules = settings.SITE_RULES[config['site']]
+    multiplier = rules['captain_multiplier']
+    actual = pd.Series(prepped['actual'], index=prepped['table']['Name'])
+    pool = fn.build_player_pool(adjusted['captain'], adjusted['flex'], config['metric'])
+    pool_actual = actual.reindex(pool['Name']).fillna(0).to_numpy(dtype=float)
+    return LineupStore.from_frame(pool, lineups_df, rules['flex_slots']).score(pool_actual, pool_actual * multiplier)
+
+
+def backtest_slate(raw_csv_file, config, cache_dir=settings.BACKTEST_CACHE_DIR):
+    # Runs the chain for one slate through the stage cache and scores it. Returns a summary dict
+    # and the lineups with their actual points.
+    game_identifier = process_csv.game_identifier_from_path(raw_csv_file)
+    keys = stage_keys(raw_csv_file, config)
+    paths = {stage: cache_path(cache_dir, raw_csv_file, stage, keys[stage]) for stage in STAGES}
+
+    prepped, prep_cached = _cached(paths['prep'], lambda: prep_stage(raw_csv_file, config))
+    adjusted, adjust_cached = _cached(paths['adjust'], lambda: adjust_stage(prepped, config, game_identifier))
+    lineups_df, lineups_cached = _cached(paths['lineups'], lambda: lineups_stage(adjusted, config))
+
+    summary = {'source': os.path.basename(raw_csv_file), 'game': game_identifier, 'lineups': len(lineups_df),
+               'cached': ','.join(stage for stage, hit in zip(STAGES, [prep_cached, adjust_cached, lineups_cached])
+                                  if hit)}
+    lineups_df = lineups_df.copy()
+    if np.isnan(prepped['actual']).all() or not len(lineups_df):
+        logging.warning(f"{os.path.basename(raw_csv_file)} has no actuals, lineups not scored")
+        lineups_df[ACTUAL_COLUMN] = np.nan
+        summary.update({'projected_mean': round(lineups_df[config['metric']].mean(), 2), 'actual_mean': np.nan,
+                        'actual_max': np.nan, 'optimal': np.nan, 'pct_of_optimal': np.nan})
+        return summary, lineups_df
+
+    scores = score_lineups(prepped, adjusted, lineups_df, config)
+    optimal = prepped['optimal']
+    lineups_df[ACTUAL_COLUMN] = np.round(scores, 2)
+    summary.update({'projected_mean': round(lineups_df[config['metric']].mean(), 2),
+                    'actual_mean': round(float(scores.mean()), 2), 'actual_max': round(float(scores.max()), 2),
+                    'optimal': round(optimal, 2),
+                    'pct_of_optimal': scores.max() / optimal if optimal > 0 else np.nan})
+    return summary, lineups_df
+
+
+def _backtest_task(task):
+    raw_csv_file, config, cache_dir = task
+    try:
+        return backtest_slate(raw_csv_file, config, cache_dir) + (None,)
+    except Exception as e:
+        return {'source': os.path.basename(raw_csv_file)}, None, str(e)
+
+
+def run_backtest(raw_dir=settings.RAW_CSV_DIR, config=None, cache_dir=settings.BACKTEST_CACHE_DIR, workers=None):
+    # Backtests every raw export in raw_dir across a process pool. Returns the per-slate summary
+    # and {source file: scored lineups}.
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    csv_files = sorted(os.path.join(raw_dir, f) for f in os.listdir(raw_dir) if f.endswith('.csv'))
+    if not csv_files:
+        logging.error("No CSV files found in the backtest directory.")
+        return pd.DataFrame(), {}
+
+    logging.info(f"Backtesting {len(csv_files)} slates...")
+    tasks = [(raw_csv_file, config, cache_dir) for raw_csv_file in csv_files]
+    if len(tasks) == 1:
+        results = [_backtest_task(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as executor:
+            results = list(executor.map(_backtest_task, tasks, chunksize=max(1, len(tasks) // 64)))
+
+    summaries, scored = [], {}
+    for summary, lineups_df, error in results:
+        if error is not None:
+            logging.error(f"Backtest of {summary['source']} failed: {error}")
+            continue
+        summaries.append(summary)
+        scored[summary['source']] = lineups_df
+    return pd.DataFrame(summaries), scored
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Backtest lineup generation against actual points")
+    parser.add_argument('raw_dir', nargs='?', default=settings.RAW_CSV_DIR)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--method', choices=['optimizer', 'enumerate'], default=DEFAULT_CONFIG['method'])
+    parser.add_argument('--metric', default=DEFAULT_CONFIG['metric'])
+    parser.add_argument('--num-lineups', type=int, default=DEFAULT_CONFIG['num_lineups'])
+    parser.add_argument('--max-exposure', type=float, default=DEFAULT_CONFIG['max_exposure'])
+    parser.add_argument('--overrides-dir', default=None)
+    args = parser.parse_args()
+
+    config = {'method': args.method, 'metric': args.metric, 'num_lineups': args.num_lineups,
+              'max_exposure': args.max_exposure, 'overrides_dir': args.overrides_dir}
+    summary, _ = run_backtest(args.raw_dir, config, workers=args.workers)
+    if len(summary):
+        print(summary.to_string(index=False))
+        print(f"Mean actual {summary['actual_mean'].mean():.2f}, "
+              f"mean share of optimal {summary['pct_of_optimal'].mean():.1%} over {len(summary)} slates")
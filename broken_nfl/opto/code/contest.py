@@ -0,0 +1,189 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import settings
+import functions as fn
+import simulation as sim
+import correlation as cor
+import optimizer
+import lineups as lu
+
+# Default contest: $5 entry, payouts as (last rank paid, prize per entry) in rank order
+DEFAULT_ENTRY_FEE = 5
+DEFAULT_PAYOUTS = [(1, 50000), (2, 20000), (3, 10000), (5, 5000), (10, 2000), (20, 1000), (50, 400),
+                   (100, 200), (250, 100), (500, 50), (1000, 30), (2500, 20), (5000, 15),
+                   (10000, 12), (20000, 10)]
+
+# Sims scored per step inside a worker, bounds the (sims x field) score matrix
+SCORE_CHUNK_SIZE = 50
+
+# Batches sample_field draws before giving up on filling the field with under-cap lineups
+MAX_FIELD_BATCHES = 100
+
+
+def sample_field(pool, field_size, seed=None, salary_cap=settings.SALARY_CAP, flex_slots=settings.FLEX_SLOTS):
+    # Samples opposing lineups with captain and flex picks in proportion to 'CPT Roster%' and
+    # 'Roster%'. Picks without replacement use the Gumbel top-k trick, so a whole batch of
+    # lineups is drawn with a few array operations; salary-invalid lineups are redrawn.
+    rng = np.random.default_rng(seed)
+    n = len(pool)
+    cpt_weight = np.log(np.fmax(pool['CPT Roster%'].fillna(0).to_numpy(dtype=float), 1e-6))
+    cpt_weight[pool['CPT Salary'].isna().to_numpy()] = -np.inf
+    flex_weight = np.log(np.fmax(pool['Roster%'].to_numpy(dtype=float), 1e-6))
+    cpt_salary = pool['CPT Salary'].fillna(0).to_numpy(dtype=float)
+    flex_salary = pool['Salary'].to_numpy(dtype=float)
+
+    field = []
+    needed = field_size
+    for _ in range(MAX_FIELD_BATCHES):
+        if needed <= 0:
+            break
+        batch = max(needed * 2, 1000)
+        captains = np.argmax(cpt_weight + rng.gumbel(size=(batch, n)), axis=1)
+        keys = flex_weight + rng.gumbel(size=(batch, n))
+        keys[np.arange(batch), captains] = -np.inf
+        flex = np.argpartition(-keys, flex_slots - 1, axis=1)[:, :flex_slots]
+        salary = cpt_salary[captains] + flex_salary[flex].sum(axis=1)
+        valid = salary <= salary_cap
+        lineups = np.column_stack([captains, flex])[valid][:needed]
+        field.append(lineups)
+        needed -= len(lineups)
+    if needed > 0:
+        raise ValueError(f"Only {field_size - needed} of {field_size} field lineups fit under the "
+                         f"{salary_cap} cap after {MAX_FIELD_BATCHES} batches, check the ownership weights")
+    return np.vstack(field).astype(np.int16)
+
+
+def prize_by_rank(payouts):
+    # Expands [(last rank, prize), ...] into one prize per paid rank
+    prizes = []
+    for last_rank, prize in payouts:
+        prizes.extend([prize] * (last_rank - len(prizes)))
+    return np.array(prizes, dtype=np.float64)
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _simulate_slice(task):
+    # Worker: scores the portfolio and the field for sims [start, stop) of the shared outcome
+    # matrix and returns per-lineup win, top-1% and winnings totals. A lineup tied with field
+    # entries shares the tied places: it gets the mean prize over them and an equal share of
+    # the win and of the top-1% places among them.
+    outcomes_shm, outcomes = _attach(*task['outcomes'])
+    field_shm, field = _attach(*task['field'])
+    try:
+        portfolio = task['portfolio']
+        prizes = task['prizes']
+        prize_totals = np.concatenate([[0], np.cumsum(prizes)])
+        num_players = outcomes.shape[1]
+        field_weights = lu.sim_weight_matrix(lu.incidence_matrix(field, num_players), num_players)
+        portfolio_weights = lu.sim_weight_matrix(lu.incidence_matrix(portfolio, num_players), num_players)
+        # Ranks beyond both the paid places and the top 1% never need exact placement
+        top_places = max(len(prizes), task['top_one_rank'])
+        top_places = min(top_places, len(field))
+
+        wins = np.zeros(len(portfolio))
+        top_one = np.zeros(len(portfolio))
+        winnings = np.zeros(len(portfolio))
+        for start in range(task['start'], task['stop'], SCORE_CHUNK_SIZE):
+            chunk = outcomes[start:min(start + SCORE_CHUNK_SIZE, task['stop'])]
+            field_scores = (field_weights @ chunk.T).T
+            portfolio_scores = (portfolio_weights @ chunk.T).T
+            top = -np.partition(-field_scores, top_places - 1, axis=1)[:, :top_places]
+            top.sort(axis=1)
+            for s in range(len(chunk)):
+                # Field entries scoring above and level with each of our lineups, our own entries
+                # don't compete
+                scores = portfolio_scores[s]
+                above = np.searchsorted(top[s], scores, side='right')
+                below = np.searchsorted(top[s], scores, side='left')
+                ahead = top_places - above
+                ties = above - below
+                # A tie group reaching the lowest kept place can run past it, count it in full
+                spill = (below == 0) & (ties > 0) & (top_places < len(field))
+                if spill.any():
+                    ties[spill] = (field_scores[s][:, None] == scores[spill]).sum(axis=0)
+                share = 1 / (ties + 1)
+                wins += (ahead == 0) * share
+                top_one += np.clip(task['top_one_rank'] - ahead, 0, ties + 1) * share
+                # Places ahead .. ahead + ties (0-based), unpaid places add nothing
+                last = np.minimum(ahead + ties + 1, len(prizes))
+                winnings += (prize_totals[last] - prize_totals[np.minimum(ahead, len(prizes))]) * share
+        return wins, top_one, winnings
+    finally:
+        outcomes_shm.close()
+        field_shm.close()
+
+
+def _share(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def simulate_contest(captain_df, flex_df, lineups_df, field_size=100000, num_sims=10000,
+                     payouts=DEFAULT_PAYOUTS, entry_fee=DEFAULT_ENTRY_FEE, seed=None,
+                     correlated=True, workers=None):
+    # Scores our lineups against a Roster%-weighted field over num_sims outcome draws and reports
+    # win rate, top-1% rate and ROI per lineup. The outcome matrix and field are placed in shared
+    # memory once; each worker process gets a slice of the sims and only the shm names.
+    logging.info(f"Simulating {len(lineups_df)} lineups vs a {field_size} entry field over {num_sims} sims...")
+    pool = fn.build_player_pool(captain_df, flex_df)
+    flex_unique = flex_df.drop_duplicates('Name')
+    model = sim.fit_outcome_model(flex_unique)
+    factor = cor.factor_slate(flex_unique) if correlated else None
+
+    outcomes = np.empty((num_sims, len(pool)), dtype=np.float32)
+    row = 0
+    for chunk in model.draw(num_sims, seed, factor=factor):
+        outcomes[row:row + len(chunk)] = chunk
+        row += len(chunk)
+    field = sample_field(pool, field_size, seed=None if seed is None else seed + 1)
+    portfolio = lu.LineupStore.from_frame(pool, lineups_df).lineups
+
+    workers = workers or os.cpu_count() or 1
+    outcomes_shm, field_shm = _share(outcomes), _share(field)
+    try:
+        bounds = np.linspace(0, num_sims, min(workers, num_sims) + 1).astype(int)
+        tasks = [{
+            'outcomes': (outcomes_shm.name, outcomes.shape, outcomes.dtype),
+            'field': (field_shm.name, field.shape, field.dtype),
+            'portfolio': portfolio,
+            'prizes': prize_by_rank(payouts),
+            'top_one_rank': max(1, int(np.ceil(field_size * 0.01))),
+            'start': start,
+            'stop': stop,
+        } for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            results = list(executor.map(_simulate_slice, tasks))
+    finally:
+        for shm in (outcomes_shm, field_shm):
+            shm.close()
+            shm.unlink()
+
+    wins, top_one, winnings = (np.sum(parts, axis=0) for parts in zip(*results))
+    results_df = lineups_df.copy()
+    results_df['Win%'] = wins / num_sims
+    results_df['Top 1%'] = top_one / num_sims
+    results_df['Avg Payout'] = winnings / num_sims
+    results_df['ROI'] = (winnings / num_sims - entry_fee) / entry_fee
+    logging.info("Contest simulation complete")
+    return results_df
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for game_identifier in fn.list_prepped_games():
+        captain_df, flex_df = fn.load_prepped_slate(game_identifier)
+        lineups_df = optimizer.ShowdownOptimizer(captain_df, flex_df).generate(20)
+        results_df = simulate_contest(captain_df, flex_df, lineups_df, field_size=10000, num_sims=1000, seed=0)
+        print(results_df.sort_values('ROI', ascending=False).to_string(index=False))
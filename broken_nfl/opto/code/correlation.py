@@ -0,0 +1,87 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+from scipy.special import ndtr
+import settings
+import slate_cache
+
+# Outcome correlation between two players by position pair, for teammates and for opponents.
+# Pairs are stored with positions in alphabetical order; anything missing is uncorrelated.
+SAME_TEAM_CORRELATION = {
+    ('QB', 'WR'): 0.35, ('QB', 'TE'): 0.30, ('QB', 'RB'): 0.10, ('K', 'QB'): 0.20,
+    ('DST', 'QB'): -0.05, ('WR', 'WR'): 0.05, ('TE', 'WR'): 0.05, ('RB', 'WR'): -0.05,
+    ('RB', 'TE'): -0.05, ('RB', 'RB'): -0.15, ('DST', 'RB'): 0.15, ('K', 'RB'): 0.10,
+    ('K', 'WR'): 0.10, ('K', 'TE'): 0.10, ('DST', 'K'): 0.10,
+}
+OPPONENT_CORRELATION = {
+    ('QB', 'QB'): 0.25, ('QB', 'WR'): 0.15, ('QB', 'TE'): 0.10, ('WR', 'WR'): 0.10,
+    ('TE', 'WR'): 0.05, ('RB', 'RB'): -0.10, ('DST', 'QB'): -0.35, ('DST', 'WR'): -0.20,
+    ('DST', 'TE'): -0.15, ('DST', 'RB'): -0.15, ('DST', 'K'): -0.15, ('DST', 'DST'): -0.10,
+}
+
+# Factorizations keyed on the flex table's path and slate version, least recently used first.
+# They depend only on roster and Std, so projection overrides don't invalidate them.
+_factor_cache = OrderedDict()
+
+
+class CorrelationFactor:
+    # Cholesky factor of the slate covariance. Correlated normal draws are eps @ lower.T, then
+    # divided by std to give the standard normals that drive each player's outcome quantile.
+
+    def __init__(self, names, std, lower):
+        self.names = np.asarray(names)
+        self.std = std.astype(np.float32)
+        self.lower_t = np.ascontiguousarray(lower.T, dtype=np.float32)
+
+    def uniforms(self, rng, rows):
+        # One matrix multiply per chunk turns independent normals into correlated uniforms
+        eps = rng.standard_normal((rows, len(self.names)), dtype=np.float32)
+        return ndtr((eps @ self.lower_t) / self.std)
+
+
+def player_std(flex_df):
+    # Each player's 'Std' from the prepped table, floored so the covariance stays positive definite
+    if 'Std' not in flex_df.columns:
+        raise ValueError("The flex table has no Std column, re-prep the slate")
+    return np.fmax(flex_df['Std'].to_numpy(dtype=np.float64), 0.1)
+
+
+def correlation_matrix(flex_df):
+    # Pairwise correlations from position pair and same-team vs opponent
+    pos = flex_df['Pos'].to_numpy()
+    team = flex_df['Team'].to_numpy()
+    n = len(flex_df)
+    corr = np.eye(n)
+    for i in range(n):
+        for j in range(i + 1, n):
+            pair = tuple(sorted((pos[i], pos[j])))
+            table = SAME_TEAM_CORRELATION if team[i] == team[j] else OPPONENT_CORRELATION
+            corr[i, j] = corr[j, i] = table.get(pair, 0.0)
+    return nearest_correlation(corr)
+
+
+def nearest_correlation(corr, min_eigenvalue=1e-6):
+    # Position-pair tables aren't guaranteed positive definite, so clip the spectrum and
+    # rescale back to a unit diagonal
+    eigenvalues, eigenvectors = np.linalg.eigh(corr)
+    corr = (eigenvectors * np.fmax(eigenvalues, min_eigenvalue)) @ eigenvectors.T
+    scale = np.sqrt(np.diag(corr))
+    return corr / np.outer(scale, scale)
+
+
+def covariance_matrix(flex_df):
+    std = player_std(flex_df)
+    return correlation_matrix(flex_df) * np.outer(std, std)
+
+
+def factor_slate(flex_df):
+    logging.info("Factoring slate covariance matrix...")
+    std = player_std(flex_df)
+    lower = np.linalg.cholesky(covariance_matrix(flex_df))
+    return CorrelationFactor(flex_df['Name'].to_numpy(), std, lower)
+
+
+def load_correlation_factor(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # Cached factorization for a prepped slate, CSV or binary, refactored only when a new version
+    # is published
+    return slate_cache.cached_fit(_factor_cache, game_identifier, factor_slate, prepped_dir)
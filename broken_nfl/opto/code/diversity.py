@@ -0,0 +1,118 @@
+import os
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import settings
+import functions as fn
+import optimizer
+import simulation as sim
+
+# Randomized-projection lineups: each candidate lineup is the optimum of its own projection
+# draw, sampled from every player's fitted outcome distribution between these quantiles
+DRAW_QUANTILES = (0.25, 0.85)
+
+# Projection draws solved per requested lineup and round; duplicates and the exposure pass drop
+# some, and another round is drawn while the selection comes up short, without the players the
+# selection already has at their cap
+OVERSAMPLE = 2
+MAX_ROUNDS = 3
+
+
+def draw_projections(model, num_draws, rng, quantiles=DRAW_QUANTILES):
+    # (num_draws, players) flex points in the outcome model's player order, each player's draw
+    # uniform in probability between the two quantiles of their 25th-85th outcome curve
+    uniforms = rng.uniform(quantiles[0], quantiles[1], size=(num_draws, model.num_players))
+    return model.scores_from_uniforms(uniforms).astype(np.float64)
+
+
+def _solve_draws(task):
+    # Worker: one model for the whole batch, the objective swapped per draw
+    captain_df, flex_df, draws, excluded, salary_cap, flex_slots = task
+    lineup_optimizer = optimizer.ShowdownOptimizer(captain_df, flex_df, salary_cap=salary_cap, flex_slots=flex_slots)
+    for i in excluded:
+        for var in lineup_optimizer.player_vars(i):
+            var.upBound = 0
+    lineups = []
+    for points in draws:
+        lineup_optimizer.set_points(points)
+        solution = lineup_optimizer.solve()
+        if solution is not None:
+            lineups.append([solution[0]] + solution[1])
+    return lineups
+
+
+def exposure_caps(pool, num_lineups, max_exposure=None, default_max_exposure=1.0):
+    # Lineup count cap per pool player from {name: fraction} settings
+    max_exposure = max_exposure or {}
+    fractions = np.array([max_exposure.get(name, default_max_exposure) for name in pool['Name']], dtype=float)
+    return np.maximum(np.round(fractions * num_lineups).astype(int), 1)
+
+
+def select_lineups(pool, candidates, num_lineups, caps):
+    # Drops duplicate candidates, then takes them best base projection first while every
+    # player stays under their exposure cap
+    seen, unique = set(), []
+    for lineup in candidates:
+        key = (lineup[0], frozenset(lineup[1:]))
+        if key not in seen:
+            seen.add(key)
+            unique.append(lineup)
+    if not unique:
+        return []
+    lineups = np.array(unique)
+    score = pool['CPT Points'].to_numpy()[lineups[:, 0]] + pool['Points'].to_numpy()[lineups[:, 1:]].sum(axis=1)
+    used = np.zeros(len(pool), dtype=int)
+    selected = []
+    for i in np.argsort(-score, kind='stable'):
+        if np.all(used[lineups[i]] < caps[lineups[i]]):
+            used[lineups[i]] += 1
+            selected.append(lineups[i].tolist())
+            if len(selected) == num_lineups:
+                break
+    return selected
+
+
+def generate_randomized(captain_df, flex_df, num_lineups, seed=None, max_exposure=None,
+                        default_max_exposure=1.0, oversample=OVERSAMPLE, salary_cap=settings.SALARY_CAP,
+                        flex_slots=settings.FLEX_SLOTS, workers=None):
+    # num_lineups distinct lineups, each optimal for a randomized projection set. The draws come
+    # from one seeded RNG before the solves are split across worker processes, so a seed gives
+    # the same lineups whatever the worker count. Totals are reported on the base projections.
+    if not 1 <= num_lineups <= settings.MAX_LINEUPS:
+        raise ValueError(f"num_lineups must be between 1 and {settings.MAX_LINEUPS}")
+
+    num_draws = num_lineups * oversample
+    pool = fn.build_player_pool(captain_df, flex_df, 'Proj')
+    model = sim.fit_outcome_model(flex_df.drop_duplicates('Name'))
+    rng = np.random.default_rng(seed)
+    workers = min(workers or os.cpu_count() or 1, num_draws)
+    caps = exposure_caps(pool, num_lineups, max_exposure, default_max_exposure)
+
+    candidates, selected, excluded = [], [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _ in range(MAX_ROUNDS):
+            logging.info(f"Solving {num_draws} randomized projection sets for {num_lineups} lineups...")
+            draws = draw_projections(model, num_draws, rng)
+            tasks = [(captain_df, flex_df, batch, excluded, salary_cap, flex_slots)
+                     for batch in np.array_split(draws, workers)]
+            candidates += [lineup for batch in executor.map(_solve_draws, tasks) for lineup in batch]
+            selected = select_lineups(pool, candidates, num_lineups, caps)
+            if len(selected) == num_lineups:
+                break
+            used = np.bincount(np.ravel(selected).astype(int), minlength=len(pool))
+            excluded = np.flatnonzero(used >= caps).tolist()
+
+    if len(selected) < num_lineups:
+        logging.warning(f"Only {len(selected)} distinct lineups within exposure caps from {len(candidates)} solves")
+    logging.info(f"Selected {len(selected)} lineups from {len(candidates)} randomized solves")
+    return fn.lineups_to_frame(pool, selected, 'Proj', flex_slots)
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for game_identifier in fn.list_prepped_games():
+        captain_df, flex_df = fn.load_prepped_slate(game_identifier)
+        lineups_df = generate_randomized(captain_df, flex_df, settings.MAX_LINEUPS, seed=0, default_max_exposure=0.6)
+        print(lineups_df.to_string(index=False))
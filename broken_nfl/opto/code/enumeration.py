@@ -0,0 +1,140 @@
+import logging
+import numpy as np
+import settings
+import functions as fn
+
+
+def _suffix_sums(values, slots, largest):
+    # sums[r, j] is the total of the r smallest (or largest) values among players j..n-1, which
+    # bounds what the remaining r slots of a partial lineup can add. Unfillable entries are +/-inf.
+    n = len(values)
+    sums = np.full((slots + 1, n + 1), -np.inf if largest else np.inf)
+    sums[0] = 0
+    for j in range(n):
+        tail = np.sort(values[j:])
+        if largest:
+            tail = tail[::-1]
+        taken = np.cumsum(tail[:slots])
+        sums[1:len(taken) + 1, j] = taken
+    return sums
+
+
+def _expand(combos, last, n):
+    # Appends every higher player index to each partial combination, fully vectorized
+    counts = n - 1 - last
+    parent = np.repeat(np.arange(len(combos)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return parent, np.repeat(last + 1, counts) + offsets
+
+
+def flex_combinations(salary, points, budget, floor=-np.inf, slots=settings.FLEX_SLOTS):
+    # Enumerates every set of 'slots' players with total salary <= budget and total points > floor.
+    # Partial sets are grown one player at a time in index order and pruned when the cheapest
+    # possible completion breaks the budget or the best possible completion can't beat the floor.
+    n = len(salary)
+    min_salary = _suffix_sums(salary, slots, largest=False)
+    max_points = _suffix_sums(points, slots, largest=True)
+
+    combos = np.arange(n, dtype=np.int16)[:, None]
+    combo_salary = salary.copy()
+    combo_points = points.copy()
+    for size in range(1, slots + 1):
+        remaining = slots - size
+        last = combos[:, -1].astype(np.int64)
+        keep = ((combo_salary + min_salary[remaining, last + 1] <= budget)
+                & (combo_points + max_points[remaining, last + 1] > floor))
+        combos, combo_salary, combo_points = combos[keep], combo_salary[keep], combo_points[keep]
+        if remaining == 0 or not len(combos):
+            break
+
+        parent, nxt = _expand(combos, combos[:, -1].astype(np.int64), n)
+        combos = np.hstack([combos[parent], nxt[:, None].astype(np.int16)])
+        combo_salary = combo_salary[parent] + salary[nxt]
+        combo_points = combo_points[parent] + points[nxt]
+
+    return combos, combo_salary, combo_points
+
+
+def enumerate_lineups(captain_df, flex_df, metric='Proj', top_k=settings.MAX_LINEUPS,
+                      salary_cap=settings.SALARY_CAP, flex_slots=settings.FLEX_SLOTS):
+    # Exact top-K Showdown lineups by 'metric' (Proj, 75th, 85th, ...). Captains are processed in
+    # order of their best possible score; each captain's flex sets are enumerated with the current
+    # K-th best score as the floor, so only lineups that can still make the top K are ever built.
+    logging.info(f"Enumerating top {top_k} lineups by {metric}...")
+    return enumerate_pool(fn.build_player_pool(captain_df, flex_df, metric), metric, top_k, salary_cap, flex_slots)
+
+
+def enumerate_pool(pool, metric='Proj', top_k=settings.MAX_LINEUPS, salary_cap=settings.SALARY_CAP,
+                   flex_slots=settings.FLEX_SLOTS):
+    # enumerate_lineups on an already built player pool, e.g. the optimizer's
+    top_lineups, _ = top_completions(pool, top_k, salary_cap, flex_slots=flex_slots)
+    logging.info(f"Enumerated {len(top_lineups)} lineups")
+    return fn.lineups_to_frame(pool, top_lineups.tolist(), metric, flex_slots)
+
+
+def top_completions(pool, top_k, salary_cap=settings.SALARY_CAP, captain=None, flex=(), excluded=(),
+                    flex_slots=settings.FLEX_SLOTS):
+    # Top-K lineups as (K, flex_slots + 1) pool indices, captain first, and their scores, best first. A fixed
+    # captain and fixed flex players are in every lineup and excluded players in none.
+    flex_salary = np.ascontiguousarray(pool['Salary'].to_numpy(dtype=np.float64))
+    flex_points = np.ascontiguousarray(pool['Points'].to_numpy(dtype=np.float64))
+    cpt_salary = pool['CPT Salary'].to_numpy(dtype=np.float64)
+    cpt_points = pool['CPT Points'].to_numpy(dtype=np.float64)
+
+    fixed = np.asarray(flex, dtype=np.int64)
+    slots = flex_slots - len(fixed)
+    available = np.ones(len(pool), dtype=bool)
+    available[list(excluded)] = False
+    available[fixed] = False
+    if captain is None:
+        captains = np.flatnonzero(~np.isnan(cpt_salary) & available)
+    else:
+        captains = np.array([captain])
+        available[captain] = False
+    fixed_salary, fixed_points = flex_salary[fixed].sum(), flex_points[fixed].sum()
+
+    best_flex = np.sort(flex_points[available])[::-1][:slots]
+    # Upper bound per captain: their captain points plus the top flex points of everyone else
+    upper_bound = cpt_points[captains] + best_flex.sum() + fixed_points
+    captains = captains[np.argsort(-upper_bound)]
+
+    top_lineups = np.empty((0, flex_slots + 1), dtype=np.int16)
+    top_scores = np.empty(0)
+    floor = -np.inf
+    for captain in captains:
+        if cpt_points[captain] + best_flex.sum() + fixed_points <= floor:
+            continue
+
+        others = np.flatnonzero(available & (np.arange(len(pool)) != captain))
+        budget = salary_cap - cpt_salary[captain] - fixed_salary
+        if slots:
+            combos, _, combo_points = flex_combinations(
+                flex_salary[others], flex_points[others], budget, floor - cpt_points[captain] - fixed_points, slots)
+        else:
+            # Every flex slot fixed, the one lineup left only has to fit under the cap
+            fits = budget >= 0
+            combos, combo_points = np.empty((int(fits), 0), dtype=np.int16), np.zeros(int(fits))
+        if not len(combos):
+            continue
+
+        lineups = np.hstack([np.full((len(combos), 1), captain, dtype=np.int16),
+                             np.tile(fixed.astype(np.int16), (len(combos), 1)), others[combos].astype(np.int16)])
+        top_lineups = np.vstack([top_lineups, lineups])
+        top_scores = np.concatenate([top_scores, combo_points + cpt_points[captain] + fixed_points])
+        if len(top_scores) > top_k:
+            keep = np.argpartition(-top_scores, top_k - 1)[:top_k]
+            top_lineups, top_scores = top_lineups[keep], top_scores[keep]
+        if len(top_scores) == top_k:
+            floor = top_scores.min()
+
+    order = np.argsort(-top_scores, kind='stable')
+    return top_lineups[order], top_scores[order]
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for game_identifier in fn.list_prepped_games():
+        captain_df, flex_df = fn.load_prepped_slate(game_identifier)
+        print(enumerate_lineups(captain_df, flex_df).to_string(index=False))
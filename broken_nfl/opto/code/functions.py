@@ -1,30 +1,71 @@
+import os
+import numpy as np
 import pandas as pd
 import logging
+import settings
+import slate_file
 
 # Configure logging if not already configured in the main script
 # Uncomment the following line if logging is not configured elsewhere
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Percentile columns rescaled along with a projection, the low end is clamped at zero
+PERCENTILE_COLUMNS = ['25th', '50th', '75th', '85th']
+CLAMPED_PERCENTILES = ['25th', '50th']
+
+# Columns the points-per-dollar metrics are derived from, in display order
+PPD_COLUMNS = ['25th', '50th', 'Proj', '75th', '85th']
+
+# Prepped slates hold one row per player in PLAYER_TABLE. Captain-only values sit in their own
+# columns, each standing in for its flex column in the captain view; the points columns are
+# scaled by the captain multiplier there.
+PLAYER_TABLE = 'player_table'
+CAPTAIN_COLUMNS = {'CPT Salary': 'Salary', 'CPT Roster%': 'Roster%'}
+CAPTAIN_SCALED_COLUMNS = ['25th', '50th', 'Proj', '75th', '85th', 'Adj_Proj', 'Std']
+
+# Columns a projection override rewrites, in the order projection_deltas returns them
+OVERRIDE_COLUMNS = ['Proj'] + PERCENTILE_COLUMNS + [f'{col}/$' for col in PPD_COLUMNS]
+
+# Columns accepted as the player key and the new projection in an uploaded overrides CSV
+OVERRIDE_KEY_COLUMNS = ['Name', 'DFS ID', 'ID']
+OVERRIDE_PROJ_COLUMNS = ['Proj', 'My Proj', 'Adj_Proj', 'New Proj']
+
+
+def rescale_percentiles(percentiles, shift_factor):
+    # percentiles is a (rows, PERCENTILE_COLUMNS) array, shift_factor holds one factor per row.
+    # The result keeps the dtype of percentiles so it can go straight back into a float32 table.
+    scaled = (percentiles * shift_factor[:, None]).astype(percentiles.dtype, copy=False)
+    clamped = [PERCENTILE_COLUMNS.index(col) for col in CLAMPED_PERCENTILES]
+    # fmax mirrors max(0, x) and maps NaN to zero
+    scaled[:, clamped] = np.fmax(scaled[:, clamped], 0)
+    return scaled
+
+
+def ppd_values(df):
+    # Points per $1000 of salary for every PPD column in one array operation
+    values = df[PPD_COLUMNS].to_numpy(dtype=float)
+    salary = df['Salary'].to_numpy(dtype=float)
+    return values / salary[:, None] * 1000
+
+
 def adjust_percentiles(df, adjustment_factor=1.0):
 
     logging.info("adjusting percentile outcome values..")
 
     try:
-        # Filter rows where 'proj' is different from 'adj_proj'
-        adjustment_needed = df[df['Proj'] != df['Adj_Proj']]
-        
-        # Iterate over rows where adjustment is needed
-        for idx, row in adjustment_needed.iterrows():
-            # Calculate the shift factor based on 'proj' and 'adj_proj'
-            shift_factor = (row['Adj_Proj'] / row['Proj']) * adjustment_factor
-
-            # Adjust the percentiles
-            df.at[idx, '25th'] = max(0, row['25th'] * shift_factor)
-            df.at[idx, '50th'] = max(0, row['50th'] * shift_factor)
-            df.at[idx, '75th'] = row['75th'] * shift_factor
-            df.at[idx, '85th'] = row['85th'] * shift_factor
-
-            
+        # Rows where 'proj' is different from 'adj_proj'
+        proj = df['Proj'].to_numpy(dtype=float)
+        adj_proj = df['Adj_Proj'].to_numpy(dtype=float)
+        adjustment_needed = proj != adj_proj
+
+        if adjustment_needed.any():
+            # Shift factor based on 'proj' and 'adj_proj' for every row at once
+            shift_factor = (adj_proj[adjustment_needed] / proj[adjustment_needed]) * adjustment_factor
+            percentiles = df.loc[adjustment_needed, PERCENTILE_COLUMNS].to_numpy()
+            df.loc[adjustment_needed, PERCENTILE_COLUMNS] = rescale_percentiles(percentiles, shift_factor)
+            # The spread moves with the percentiles
+            if 'Std' in df.columns:
+                df.loc[adjustment_needed, 'Std'] = df.loc[adjustment_needed, 'Std'].to_numpy(dtype=float) * shift_factor
 
         logging.info("Percentiles adjusted successfully")
         return df
@@ -33,14 +74,258 @@ def adjust_percentiles(df, adjustment_factor=1.0):
         logging.error(f"function call: adjust_percentiles failed due to error - {str(e)}")
         raise
 
+
+def apply_projection_overrides(df, overrides, key=None, proj_multiplier=1.0, adjustment_factor=1.0):
+    # Applies a whole batch of projection overrides in one pass. 'overrides' maps a player key
+    # (Name, or an ID column present in df) to the new flex projection; proj_multiplier scales it
+    # for the role (1.5 for captain). Percentiles are rescaled from the values in df, so pass the
+    # unadjusted base table rather than a previously overridden one.
+    logging.info("Applying projection overrides...")
+    overrides = pd.Series(overrides, dtype=float)
+    if key is None:
+        key = overrides.index.name if overrides.index.name in df.columns else 'Name'
+
+    try:
+        df = df.copy()
+        new_proj = df[key].map(overrides).to_numpy(dtype=float) * proj_multiplier
+        proj = df['Proj'].to_numpy(dtype=float)
+        overridden = ~np.isnan(new_proj) & (proj != 0)
+
+        if overridden.any():
+            shift_factor = (new_proj[overridden] / proj[overridden]) * adjustment_factor
+            percentiles = df.loc[overridden, PERCENTILE_COLUMNS].to_numpy(dtype=float)
+            df.loc[overridden, PERCENTILE_COLUMNS] = rescale_percentiles(percentiles, shift_factor)
+            df.loc[overridden, 'Proj'] = new_proj[overridden]
+
+        # Recompute the /$ columns for the whole table in the same pass
+        df[[f'{col}/$' for col in PPD_COLUMNS]] = ppd_values(df)
+
+        logging.info(f"Applied {int(overridden.sum())} projection overrides")
+        return df
+
+    except Exception as e:
+        logging.error(f"function call: apply_projection_overrides failed due to error - {str(e)}")
+        raise
+
+
+def projection_deltas(base_df, overrides, key=None, proj_multiplier=1.0, adjustment_factor=1.0, rows=None):
+    # The rows of base_df a batch of overrides rewrites, without copying the frame: (row
+    # positions, values) with a column per OVERRIDE_COLUMNS, i.e. Proj, the percentiles rescaled
+    # from their base values and the /$ columns. 'rows' can give each override's row position
+    # (-1 if not in base_df), e.g. from a player registry, instead of searching the key column.
+    overrides = pd.Series(overrides, dtype=float)
+    if key is None:
+        key = overrides.index.name if overrides.index.name in base_df.columns else 'Name'
+
+    try:
+        if rows is None:
+            rows = np.flatnonzero(base_df[key].isin(overrides.index).to_numpy())
+            new_proj = overrides.reindex(base_df[key].iloc[rows]).to_numpy(dtype=float) * proj_multiplier
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            new_proj = overrides.to_numpy(dtype=float)[rows >= 0] * proj_multiplier
+            rows = rows[rows >= 0]
+        proj = base_df['Proj'].iloc[rows].to_numpy(dtype=float)
+        valid = ~np.isnan(new_proj) & (proj != 0)
+        rows, new_proj, proj = rows[valid], new_proj[valid], proj[valid]
+
+        # Positional reads of just these rows and columns
+        shift_factor = (new_proj / proj) * adjustment_factor
+        percentile_cols = base_df.columns.get_indexer(PERCENTILE_COLUMNS)
+        percentiles = rescale_percentiles(base_df.iloc[rows, percentile_cols].to_numpy(dtype=float), shift_factor)
+        values = pd.DataFrame(percentiles, columns=PERCENTILE_COLUMNS).assign(Proj=new_proj)
+        salary = base_df['Salary'].iloc[rows].to_numpy(dtype=float)
+        ppd = values[PPD_COLUMNS].to_numpy(dtype=float) / salary[:, None] * 1000
+        return rows, np.hstack([new_proj[:, None], percentiles, ppd])
+
+    except Exception as e:
+        logging.error(f"function call: projection_deltas failed due to error - {str(e)}")
+        raise
+
+
+def merge_projection_deltas(deltas, update):
+    # A session's deltas with a newer batch on top, rows in the update replace earlier ones
+    if deltas is None:
+        return update
+    rows, values = deltas
+    keep = ~np.isin(rows, update[0])
+    return np.concatenate([rows[keep], update[0]]), np.vstack([values[keep], update[1]])
+
+
+def overlay_projection_deltas(base_df, deltas):
+    # base_df with the delta rows written over it. Only the OVERRIDE_COLUMNS get new arrays, every
+    # other column shares the base frame's data, so a session keeps nothing but its deltas.
+    if deltas is None or not len(deltas[0]):
+        return base_df
+    rows, values = deltas
+    columns = {col: base_df[col].array for col in base_df.columns}
+    for i, col in enumerate(OVERRIDE_COLUMNS):
+        column = base_df[col].to_numpy(dtype=float, copy=True)
+        column[rows] = values[:, i]
+        columns[col] = column
+    return pd.DataFrame(columns, index=base_df.index, copy=False)
+
+
+def read_overrides_csv(source):
+    # Reads an overrides CSV (path or uploaded file) into a Series of new projections indexed by player key
+    logging.info("Reading projection overrides CSV...")
+    overrides = pd.read_csv(source)
+
+    key = next((col for col in OVERRIDE_KEY_COLUMNS if col in overrides.columns), None)
+    proj_col = next((col for col in OVERRIDE_PROJ_COLUMNS if col in overrides.columns), None)
+    if key is None or proj_col is None:
+        raise ValueError(f"Overrides CSV needs one of {OVERRIDE_KEY_COLUMNS} and one of {OVERRIDE_PROJ_COLUMNS}")
+
+    overrides = overrides.dropna(subset=[proj_col]).drop_duplicates(subset=key, keep='last')
+    return pd.Series(overrides[proj_col].to_numpy(dtype=float), index=pd.Index(overrides[key], name=key))
+
+
+def list_prepped_games(prepped_dir=settings.OUTPUT_DIR):
+    # Game identifiers with prepped captain/flex tables or a binary slate, e.g. 'DAL-@-NYG'
+    game_identifiers = set()
+    for f in os.listdir(prepped_dir):
+        if f.startswith('SD_') and (f.endswith('_captain.csv') or f.endswith('_flex.csv')):
+            game_identifiers.add(f.replace('SD_', '', 1).replace('_captain.csv', '').replace('_flex.csv', ''))
+        elif f.startswith('SD_') and f.endswith(slate_file.SLATE_EXTENSION):
+            game_identifiers.add(f.replace('SD_', '', 1).replace(slate_file.SLATE_EXTENSION, ''))
+    return sorted(game_identifiers)
+
+
+def prepped_table_path(game_identifier, table, prepped_dir=settings.OUTPUT_DIR):
+    # File a 'captain' or 'flex' table is read from: the memory-mapped binary slate when it is at
+    # least as new as the CSV, otherwise the CSV export. None if neither exists.
+    csv_path = os.path.join(prepped_dir, f'SD_{game_identifier}_{table}.csv')
+    binary_path = slate_file.slate_path(game_identifier, prepped_dir)
+    if os.path.exists(binary_path) and (not os.path.exists(csv_path)
+                                        or os.path.getmtime(binary_path) >= os.path.getmtime(csv_path)):
+        return binary_path
+    if os.path.exists(csv_path):
+        return csv_path
+    return None
+
+
+def read_prepped_table(path, table):
+    if path.endswith(slate_file.SLATE_EXTENSION):
+        header = slate_file.read_header(path)
+        stored = header['tables']
+        if table == 'captain' and table not in stored and PLAYER_TABLE in stored:
+            player_table = slate_file.open_slate(path, tables=[PLAYER_TABLE])[PLAYER_TABLE]
+            return captain_view(player_table, header['metadata'].get('captain_multiplier', settings.CAPTAIN_MULTIPLIER))
+        if table == 'flex' and table not in stored and PLAYER_TABLE in stored:
+            return flex_view(slate_file.open_slate(path, tables=[PLAYER_TABLE])[PLAYER_TABLE])
+        return slate_file.open_slate(path, tables=[table])[table]
+    return pd.read_csv(path)
+
+
+def load_prepped_table(game_identifier, table, prepped_dir=settings.OUTPUT_DIR):
+    # 'captain' or 'flex' table for one game, None if it hasn't been prepped
+    path = prepped_table_path(game_identifier, table, prepped_dir)
+    return None if path is None else read_prepped_table(path, table)
+
+
+def load_prepped_slate(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # Loads the captain and flex tables written by process_csv.py for one game
+    captain_df = load_prepped_table(game_identifier, 'captain', prepped_dir)
+    flex_df = load_prepped_table(game_identifier, 'flex', prepped_dir)
+    if captain_df is None or flex_df is None:
+        raise FileNotFoundError(f"No prepped captain and flex tables for {game_identifier} in {prepped_dir}")
+    return captain_df, flex_df
+
+
+def build_player_table(df, captain_columns=None):
+    # One row per player from raw rows holding both roles, in one pass: each player's lowest
+    # salary row is flex and their highest, when they have more than one, is captain. Rows keep
+    # the flex row's values in file order, with the captain row's salary and ownership added.
+    # captain_columns maps each captain column to the column it's read from, CAPTAIN_COLUMNS
+    # by default; raw exports name ownership differently.
+    names = pd.factorize(df['Name'])[0]
+    salary = df['Salary'].to_numpy()
+    order = np.lexsort((salary, names))
+    grouped = names[order]
+    starts = np.r_[True, grouped[1:] != grouped[:-1]]
+    ends = np.r_[grouped[1:] != grouped[:-1], True]
+    flex_rows = np.sort(order[starts])
+    captain_rows = order[ends & ~starts]
+
+    captain_of = np.full(names.max() + 1 if len(names) else 0, -1)
+    captain_of[names[captain_rows]] = captain_rows
+    captain_rows = captain_of[names[flex_rows]]
+    has_captain = captain_rows >= 0
+
+    table = df.iloc[flex_rows].reset_index(drop=True)
+    for captain_col, col in (captain_columns or CAPTAIN_COLUMNS).items():
+        if col in df.columns:
+            values = df[col].to_numpy(dtype=float)
+            table[captain_col] = np.where(has_captain, values[np.where(has_captain, captain_rows, 0)], np.nan)
+    return table
+
+
+def flex_view(table):
+    # Flex table from a player table, sharing its column data
+    columns = [col for col in table.columns if col not in CAPTAIN_COLUMNS]
+    return pd.DataFrame({col: table[col].array for col in columns}, index=table.index, copy=False)
+
+
+def captain_view(table, multiplier=settings.CAPTAIN_MULTIPLIER):
+    # Captain table from a player table: players with a captain salary, their captain salary and
+    # ownership, points columns scaled by multiplier and the /$ columns recomputed
+    rows = np.flatnonzero(table['CPT Salary'].notna().to_numpy())
+    captain_source = {col: captain_col for captain_col, col in CAPTAIN_COLUMNS.items() if captain_col in table.columns}
+    columns = {}
+    for col in table.columns:
+        if col in CAPTAIN_COLUMNS:
+            continue
+        values = table[captain_source.get(col, col)].iloc[rows]
+        if col == 'Salary':
+            values = values.astype(table['Salary'].dtype)
+        elif col in CAPTAIN_SCALED_COLUMNS:
+            values = (values * multiplier).round(2)
+        columns[col] = values.array
+    captain = pd.DataFrame(columns)
+    ppd_columns = [f'{col}/$' for col in PPD_COLUMNS]
+    if all(col in captain.columns for col in ppd_columns):
+        captain[ppd_columns] = np.round(ppd_values(captain), 2)
+    return captain
+
+
+def lineup_columns(flex_slots=settings.FLEX_SLOTS):
+    # Lineup table columns, one captain then the flex slots
+    return ['CPT'] + [f'FLEX{i + 1}' for i in range(flex_slots)]
+
+
+LINEUP_COLUMNS = lineup_columns()
+
+
+def lineups_to_frame(pool, lineups, metric='Proj', flex_slots=settings.FLEX_SLOTS):
+    # Lineup table with player names per slot plus salary and metric totals. Each lineup is a
+    # list of player pool indices, captain first.
+    names = pool['Name'].to_numpy()
+    rows = []
+    for captain, *flex in lineups:
+        salary = pool.at[captain, 'CPT Salary'] + pool.loc[flex, 'Salary'].sum()
+        points = pool.at[captain, 'CPT Points'] + pool.loc[flex, 'Points'].sum()
+        rows.append([names[captain]] + list(names[flex]) + [int(salary), round(points, 2)])
+    return pd.DataFrame(rows, columns=lineup_columns(flex_slots) + ['Salary', metric])
+
+
+def build_player_pool(captain_df, flex_df, metric='Proj'):
+    # One row per player in flex order, with the captain salary and metric joined on by name.
+    # 'Points'/'CPT Points' hold the chosen metric; players without a captain row get NaN there.
+    flex = flex_df.drop_duplicates('Name').reset_index(drop=True)
+    captain = captain_df.drop_duplicates('Name').set_index('Name').reindex(flex['Name'])
+    pool = flex[['Name', 'Pos', 'Team', 'Opp', 'Salary']].assign(Points=flex[metric].to_numpy(dtype=float))
+    pool['CPT Salary'] = captain['Salary'].to_numpy(dtype=float)
+    pool['CPT Points'] = captain[metric].to_numpy(dtype=float)
+    if 'Roster%' in flex.columns:
+        pool['Roster%'] = flex['Roster%'].to_numpy(dtype=float)
+        pool['CPT Roster%'] = captain['Roster%'].to_numpy(dtype=float)
+    return pool
+
+
 def calculate_ppd(df):
     logging.info("Calculating value range of outcomes...")
     df = df.copy()
-    df.loc[:, '25th/$'] = (df['25th'] / df['Salary']) * 1000
-    df.loc[:, '50th/$'] = (df['50th'] / df['Salary']) * 1000
-    df.loc[:, 'Proj/$'] = (df['Proj'] / df['Salary']) * 1000
-    df.loc[:, '75th/$'] = (df['75th'] / df['Salary']) * 1000
-    df.loc[:, '85th/$'] = (df['85th'] / df['Salary']) * 1000
+    df[[f'{col}/$' for col in PPD_COLUMNS]] = ppd_values(df)
     return df
 
 
@@ -48,7 +333,7 @@ def standardize_numeric_columns(df):
     logging.info("Standardizing numeric columns")
     df = df.copy()
     # Removed the 'Roster%' adjustment here
-    numeric_columns = df.select_dtypes(include=['float64', 'int64']).columns
+    numeric_columns = df.select_dtypes(include=['float64', 'float32', 'int64']).columns
     numeric_columns = numeric_columns.drop('Salary', errors='ignore')  # Exclude 'Salary' column
     df.loc[:, numeric_columns] = df[numeric_columns].round(2)
     return df
@@ -56,6 +341,7 @@ def standardize_numeric_columns(df):
 def adjust_roster_percentage(df):
     logging.info("Adjusting 'Roster%' percentages")
     df = df.copy()
-    df.loc[:, 'Roster%'] = df['Roster%'] / 100
+    for col in ['Roster%', 'CPT Roster%']:
+        if col in df.columns:
+            df.loc[:, col] = df[col] / 100
     return df
-
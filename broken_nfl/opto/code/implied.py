@@ -0,0 +1,200 @@
+import re
+import logging
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+import settings
+import functions as fn
+import players
+
+# Player stat markets read from a sportsbook pull: raw CSV stat column, DK points per unit and
+# the market name pattern. Combined markets ('Rushing + Receiving Yards') don't match.
+STAT_MARKETS = [
+    ('Pass Yds', 0.04, r'^(?:alt(?:ernate)?\s+)?(?:player\s+)?passing yards\b'),
+    ('Pass TD', 4.0, r'^(?:alt(?:ernate)?\s+)?(?:player\s+)?passing (?:touchdowns|tds)\b'),
+    ('Pass Int', -1.0, r'^(?:player\s+)?(?:passing\s+)?interceptions(?: thrown)?\b'),
+    ('Rush Yds', 0.1, r'^(?:alt(?:ernate)?\s+)?(?:player\s+)?rushing yards\b'),
+    ('Rec', 1.0, r'^(?:alt(?:ernate)?\s+)?(?:player\s+)?receptions\b'),
+    ('Rec Yds', 0.1, r'^(?:alt(?:ernate)?\s+)?(?:player\s+)?receiving yards\b'),
+]
+# Anytime touchdown scorer covers rushing and receiving touchdowns together
+ANYTIME_TD_PATTERN = r'anytime (?:td|touchdown)'
+TD_COLUMNS = ['Rush TD', 'Rec TD']
+TD_POINTS = 6.0
+STAT_COLUMNS = [stat for stat, _, _ in STAT_MARKETS] + TD_COLUMNS
+
+# Spread assumed when a stat only has one line, as a share of the line
+STAT_CV = {'Pass Yds': 0.25, 'Pass TD': 0.65, 'Pass Int': 1.0, 'Rush Yds': 0.5, 'Rec': 0.45, 'Rec Yds': 0.55}
+
+# Margin taken off one-sided prices (no opposing side in the market to de-vig against)
+SINGLE_SIDED_MARGIN = 0.05
+
+# Alternate-line labels like '250+' mean stat >= 250
+ALT_LINE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\+\s*$')
+
+
+def devig(selections):
+    # Fair probability for every selection. Prices on the same market, player and line are
+    # normalized to sum to one; a price with no opposing side just loses SINGLE_SIDED_MARGIN.
+    raw = 1.0 / selections['odds_decimal'].to_numpy(dtype=float)
+    keys = pd.DataFrame({col: pd.factorize(selections[col].to_numpy())[0] for col in ['market_id', 'participants']})
+    keys['points'] = selections['points'].fillna(-1.0).to_numpy()
+    group = keys.groupby(['market_id', 'participants', 'points'], sort=False).ngroup().to_numpy()
+    total = np.bincount(group, weights=raw)[group]
+    sides = np.bincount(group)[group]
+    return np.where(sides > 1, raw / total, raw / (1 + SINGLE_SIDED_MARGIN))
+
+
+def _unique_map(values, func):
+    # Applies func to each distinct value only; pull columns repeat a few names over many rows
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object).fillna('').astype(str))
+    return np.asarray(func(pd.Series(uniques, dtype=object)))[codes]
+
+
+def _market_stats(market_names):
+    # Index into STAT_MARKETS for each market name, -1 for markets that aren't used
+    lowered = market_names.str.lower()
+    stat = np.full(len(market_names), -1)
+    for i, (_, _, pattern) in reversed(list(enumerate(STAT_MARKETS))):
+        stat[lowered.str.contains(pattern, regex=True).to_numpy()] = i
+    return stat
+
+
+def stat_lines(selections, prob=None):
+    # One row per (player, stat, line) with the fair probability of going over the line
+    selections = selections.reset_index(drop=True)
+    prob = devig(selections) if prob is None else prob
+    stat = _unique_map(selections['market_name'], _market_stats)
+    label = selections['label']
+    alt = _unique_map(label, lambda labels: labels.str.extract(ALT_LINE_PATTERN, expand=False).astype(float))
+    is_over = _unique_map(selections['outcome_type'], lambda o: o.str.lower() == 'over') | \
+        _unique_map(label, lambda labels: labels.str.lower() == 'over')
+    line = np.where(is_over, selections['points'].to_numpy(dtype=float), alt - 0.5)
+    keep = (stat >= 0) & (is_over | ~np.isnan(alt)) & ~np.isnan(line)
+
+    stat_names = np.array([name for name, _, _ in STAT_MARKETS], dtype=object)
+    return pd.DataFrame({'participant': selections.loc[keep, 'participants'].astype(str).to_numpy(),
+                         'stat': stat_names[stat[keep]], 'line': line[keep], 'p_over': prob[keep]})
+
+
+def fit_stat_means(lines):
+    # Normal fit per (player, stat): line = mean + sd * z with z = ppf(1 - p_over). Several lines
+    # give a least-squares fit of mean and sd; one line uses the stat's default spread.
+    z = norm.ppf(np.clip(1 - lines['p_over'].to_numpy(), 0.01, 0.99))
+    frame = lines.assign(z=z, zz=z * z, zl=z * lines['line'], n=1)
+    sums = frame.groupby(['participant', 'stat'])[['n', 'z', 'line', 'zz', 'zl']].sum()
+
+    n = sums['n'].to_numpy(dtype=float)
+    z_mean, line_mean = sums['z'].to_numpy() / n, sums['line'].to_numpy() / n
+    z_var = sums['zz'].to_numpy() / n - z_mean ** 2
+    slope = np.divide(sums['zl'].to_numpy() / n - z_mean * line_mean, z_var,
+                      out=np.zeros_like(z_var), where=z_var > 1e-6)
+    default_sd = sums.index.get_level_values('stat').map(STAT_CV).to_numpy(dtype=float) * np.fmax(line_mean, 1)
+    sd = np.where((n > 1) & (slope > 0), slope, default_sd)
+    mean = np.fmax(line_mean - sd * z_mean, 0)
+    return pd.DataFrame({'mean': mean, 'sd': sd}, index=sums.index)
+
+
+def anytime_td_means(selections, prob=None):
+    # Expected rushing + receiving touchdowns from the fair anytime-TD price, as a Poisson rate
+    selections = selections.reset_index(drop=True)
+    prob = devig(selections) if prob is None else prob
+    in_market = _unique_map(selections['market_name'],
+                            lambda names: names.str.lower().str.contains(ANYTIME_TD_PATTERN, regex=True))
+    no_side = _unique_map(selections['label'], lambda labels: labels.str.lower() != 'no')
+    keep = in_market & no_side
+    prob = np.clip(prob[keep], 0, 0.99)
+    return pd.Series(-np.log1p(-prob), index=selections.loc[keep, 'participants'].astype(str).to_numpy()).groupby(level=0).mean()
+
+
+def implied_stats(selections):
+    # Wide tables of market-implied stat means and sds, one row per sportsbook player name. 'TD'
+    # is the anytime-TD Poisson rate, with the Poisson sd.
+    selections = selections.reset_index(drop=True)
+    prob = devig(selections)
+    fits = fit_stat_means(stat_lines(selections, prob))
+    means, sds = fits['mean'].unstack('stat'), fits['sd'].unstack('stat')
+    tds = anytime_td_means(selections, prob)
+    if len(tds):
+        index = means.index.union(tds.index)
+        means, sds = means.reindex(index), sds.reindex(index)
+        means['TD'], sds['TD'] = tds, np.sqrt(tds)
+    return means, sds
+
+
+def implied_points(df, selections, registry=None):
+    # DK points the markets add to or take from each row's stat-line projection, the variance of
+    # the market-covered points (stats taken as independent) and how many of the row's projected
+    # points those stats account for. All NaN for players without any market. Sportsbook names
+    # are matched through the slate's player registry.
+    logging.info("Deriving sportsbook-implied projections...")
+    registry = players.PlayerRegistry.from_raw(df) if registry is None else registry
+    means, sds = implied_stats(selections)
+    matched = registry.match(means.index)
+    rows = registry.index_of_names(df['Name'])
+    means = means[matched >= 0].groupby(matched[matched >= 0]).mean().reindex(rows)
+    sds = sds[matched >= 0].groupby(matched[matched >= 0]).mean().reindex(rows)
+
+    delta, variance, covered_points = np.zeros(len(df)), np.zeros(len(df)), np.zeros(len(df))
+    covered = np.zeros(len(df), dtype=bool)
+    for stat, weight, _ in STAT_MARKETS:
+        if stat in means.columns and stat in df.columns:
+            implied = means[stat].to_numpy(dtype=float)
+            has = ~np.isnan(implied)
+            projected = weight * df[stat].to_numpy(dtype=float)[has]
+            delta[has] += weight * implied[has] - projected
+            variance[has] += (weight * sds[stat].to_numpy(dtype=float)[has]) ** 2
+            covered_points[has] += projected
+            covered |= has
+    if 'TD' in means.columns and all(col in df.columns for col in TD_COLUMNS):
+        implied = means['TD'].to_numpy(dtype=float)
+        has = ~np.isnan(implied)
+        projected = TD_POINTS * df[TD_COLUMNS].to_numpy(dtype=float).sum(axis=1)[has]
+        delta[has] += TD_POINTS * implied[has] - projected
+        variance[has] += TD_POINTS ** 2 * implied[has]
+        covered_points[has] += projected
+        covered |= has
+    return tuple(np.where(covered, values, np.nan) for values in (delta, variance, covered_points))
+
+
+def apply_implied_projections(df, selections, weight=settings.IMPLIED_WEIGHT, registry=None):
+    # Writes the market view into Adj_Proj and the percentile columns of a renamed raw table,
+    # ahead of adjust_percentiles. Adj_Proj becomes Proj plus the implied points delta, blended
+    # with the existing Adj_Proj by weight.
+    # The market percentiles come from a normal points distribution around that projection. Its
+    # variance is the fitted stat spreads in DK points, plus the export's own spread (from its
+    # 25th-75th range) scaled to the share of the projection no market covers. They're blended with
+    # the export's percentiles by weight; adjust_percentiles rescales them by Adj_Proj / Proj,
+    # so they're stored pre-divided.
+    df = df.copy()
+    delta, variance, covered_points = implied_points(df, selections, registry)
+    matched = ~np.isnan(delta)
+    logging.info(f"Sportsbook markets cover {int(matched.sum())} of {len(df)} rows")
+    if not matched.any():
+        return df
+
+    proj = df['Proj'].to_numpy(dtype=float)
+    adj_proj = df['Adj_Proj'].to_numpy(dtype=float)
+    implied_proj = np.fmax(proj + np.nan_to_num(delta), 0)
+    new_adj = (1 - weight) * adj_proj + weight * implied_proj
+
+    percentiles = df[fn.PERCENTILE_COLUMNS].to_numpy(dtype=float)
+    quantiles = norm.ppf([int(col[:-2]) / 100 for col in fn.PERCENTILE_COLUMNS])
+    clamped = [fn.PERCENTILE_COLUMNS.index(col) for col in fn.CLAMPED_PERCENTILES]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = percentiles * (adj_proj / proj)[:, None]
+        export_sd = (scaled[:, fn.PERCENTILE_COLUMNS.index('75th')]
+                     - scaled[:, fn.PERCENTILE_COLUMNS.index('25th')]) / (norm.ppf(0.75) - norm.ppf(0.25))
+        # The uncovered points are that share of the export's distribution, so their sd scales with it
+        uncovered = np.clip(1 - np.nan_to_num(covered_points) / proj, 0, 1)
+        points_sd = np.sqrt(np.nan_to_num(variance) + (uncovered * np.nan_to_num(export_sd)) ** 2)
+        implied = implied_proj[:, None] + points_sd[:, None] * quantiles
+        implied[:, clamped] = np.fmax(implied[:, clamped], 0)
+        target = (1 - weight) * scaled + weight * implied
+        stored = target * (proj / new_adj)[:, None]
+
+    rows = matched & (proj != 0) & (new_adj != 0)
+    # Cast to the table's dtypes
+    df.loc[rows, 'Adj_Proj'] = new_adj[rows].astype(df['Adj_Proj'].dtype)
+    df.loc[rows, fn.PERCENTILE_COLUMNS] = stored[rows].astype(df[fn.PERCENTILE_COLUMNS[0]].dtype)
+    return df
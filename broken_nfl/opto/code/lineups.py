@@ -0,0 +1,140 @@
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+import settings
+import functions as fn
+import players
+import optimizer
+
+# Sims scored per step, bounds the (lineups x sims) score block
+SIM_SCORE_CHUNK = 100
+
+# DraftKings Showdown upload header, one captain then the flex slots
+DK_UPLOAD_COLUMNS = ['CPT'] + ['FLEX'] * settings.FLEX_SLOTS
+
+
+def incidence_matrix(lineups, num_players):
+    # Sparse (lineups, 2 x players) 0/1 matrix: captain flags in the first block of columns,
+    # flex flags in the second. lineups is a (N, 6) array of player indices, captain first.
+    count, slots = lineups.shape
+    rows = np.repeat(np.arange(count), slots)
+    columns = lineups + np.r_[0, np.full(slots - 1, num_players)]
+    return csr_matrix((np.ones(rows.size, dtype=np.float32), (rows, columns.ravel())),
+                      shape=(count, 2 * num_players))
+
+
+def sim_weight_matrix(incidence, num_players):
+    # Captain outcomes are CAPTAIN_MULTIPLIER x the flex draw, so scoring sims only needs one
+    # weight per player: (lineups, players) with the multiplier on the captain
+    return (incidence[:, :num_players] * np.float32(settings.CAPTAIN_MULTIPLIER)
+            + incidence[:, num_players:]).tocsr()
+
+
+class LineupStore:
+    # N lineups as a sparse (lineups, 2 x players) incidence matrix over the player pool: the
+    # first block of columns flags the captain, the second the flex players. Scoring is a single
+    # sparse product against a projection vector or a block of sims.
+
+    def __init__(self, pool, lineups):
+        # lineups is a (N, flex slots + 1) array of pool indices, captain first
+        self.pool = pool
+        self.lineups = np.ascontiguousarray(lineups, dtype=np.int32)
+        self.num_players = len(pool)
+        self.incidence = incidence_matrix(self.lineups, self.num_players)
+        self.sim_weights = sim_weight_matrix(self.incidence, self.num_players)
+
+    @classmethod
+    def from_frame(cls, pool, lineups_df, flex_slots=settings.FLEX_SLOTS):
+        # Builds a store from a lineup table with CPT, FLEX1..FLEXn player names
+        index = pd.Series(np.arange(len(pool)), index=pool['Name'])
+        lineups = np.column_stack([index.loc[lineups_df[col]].to_numpy()
+                                   for col in fn.lineup_columns(flex_slots)])
+        return cls(pool, lineups)
+
+    def __len__(self):
+        return len(self.lineups)
+
+    def salaries(self):
+        return self.incidence @ np.concatenate([self.pool['CPT Salary'].fillna(0).to_numpy(dtype=float),
+                                                self.pool['Salary'].to_numpy(dtype=float)])
+
+    def score(self, points=None, cpt_points=None):
+        # Lineup totals for per-player flex points (defaults to the pool metric). Captain points
+        # default to the pool's captain metric, or CAPTAIN_MULTIPLIER x points when points is given.
+        if points is None:
+            points = self.pool['Points'].to_numpy(dtype=float)
+            cpt_points = self.pool['CPT Points'].fillna(0).to_numpy(dtype=float)
+        elif cpt_points is None:
+            cpt_points = np.asarray(points, dtype=float) * settings.CAPTAIN_MULTIPLIER
+        return self.incidence @ np.concatenate([cpt_points, points])
+
+    def score_sims(self, outcomes, chunk_size=SIM_SCORE_CHUNK):
+        # Yields (lineups, sims) score blocks for a (sims, players) flex outcome matrix
+        for start in range(0, len(outcomes), chunk_size):
+            yield self.sim_weights @ np.asarray(outcomes[start:start + chunk_size], dtype=np.float32).T
+
+    def sim_summary(self, outcomes, thresholds=(), chunk_size=SIM_SCORE_CHUNK):
+        # Streams the sims and returns per-lineup mean, std and P(score >= threshold)
+        total = np.zeros(len(self))
+        total_sq = np.zeros(len(self))
+        exceed = np.zeros((len(thresholds), len(self)))
+        for scores in self.score_sims(outcomes, chunk_size):
+            total += scores.sum(axis=1)
+            total_sq += np.square(scores, dtype=np.float64).sum(axis=1)
+            for t, threshold in enumerate(thresholds):
+                exceed[t] += (scores >= threshold).sum(axis=1)
+
+        num_sims = len(outcomes)
+        mean = total / num_sims
+        summary = pd.DataFrame({'Sim Mean': mean,
+                                'Sim Std': np.sqrt(np.maximum(total_sq / num_sims - mean ** 2, 0))})
+        for t, threshold in enumerate(thresholds):
+            summary[f'P({threshold}+)'] = exceed[t] / num_sims
+        return summary
+
+    def exposure(self):
+        # Share of lineups using each player at captain, at flex and overall
+        counts = np.asarray(self.incidence.sum(axis=0)).ravel() / max(len(self), 1)
+        n = self.num_players
+        return pd.DataFrame({'Name': self.pool['Name'], 'CPT': counts[:n], 'FLEX': counts[n:],
+                             'Total': counts[:n] + counts[n:]})
+
+    def to_frame(self, metric='Proj'):
+        return fn.lineups_to_frame(self.pool, self.lineups.tolist(), metric, self.lineups.shape[1] - 1)
+
+    def to_dk_upload(self, path, registry):
+        # Bulk export in the DraftKings upload layout, 'Name (ID)' per slot with each role's DFS ID
+        # from the slate's player registry. Raises rather than writing names DraftKings rejects.
+        dense = registry.index_of_names(self.pool['Name'])
+        used = np.unique(self.lineups)
+        if (dense[used] < 0).any():
+            raise ValueError("Lineups have players that aren't in the slate's registry")
+        flex_ids = registry.ids[dense]
+        cpt_ids = registry.players['Captain ID'].to_numpy(dtype=np.int64)[dense]
+        if (cpt_ids[np.unique(self.lineups[:, 0])] < 0).any():
+            raise ValueError("The slate's registry has no DraftKings captain IDs, re-prep it from the raw export")
+
+        names = self.pool['Name'].to_numpy(dtype=object)
+        flex_entries = names + ' (' + flex_ids.astype(str).astype(object) + ')'
+        cpt_entries = names + ' (' + cpt_ids.astype(str).astype(object) + ')'
+        upload = np.column_stack([cpt_entries[self.lineups[:, 0]], flex_entries[self.lineups[:, 1:]]])
+        pd.DataFrame(upload, columns=DK_UPLOAD_COLUMNS).to_csv(path, index=False)
+        logging.info(f"Exported {len(self)} lineups for DraftKings upload")
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Export a lineups CSV in the DraftKings upload layout")
+    parser.add_argument('game', help="game identifier of the prepped slate, e.g. DAL-@-NYG")
+    parser.add_argument('lineups', help="lineups CSV with CPT, FLEX1..FLEX5 or DK entries")
+    parser.add_argument('output', help="path of the upload CSV to write")
+    args = parser.parse_args()
+
+    captain_df, flex_df = fn.load_prepped_slate(args.game)
+    registry = players.load_registry(args.game, flex_df=flex_df)
+    store = LineupStore.from_frame(fn.build_player_pool(captain_df, flex_df), optimizer.read_lineups_csv(args.lineups))
+    store.to_dk_upload(args.output, registry)
@@ -0,0 +1,266 @@
+import os
+import re
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import pulp
+import settings
+import functions as fn
+import enumeration
+
+# DK entry files write players as 'Name (DFS ID)'
+ENTRY_ID_SUFFIX = re.compile(r'\s*\(\d+\)\s*$')
+
+
+class ShowdownOptimizer:
+    # Builds the CPT + FLEX MILP once per slate and re-solves it for every lineup. Between
+    # solves only a uniqueness cut is added; exposure is applied by changing variable bounds and
+    # constraint constants, so the model is never rebuilt. Each solve is still a CBC run, so a
+    # plain top-N request without exposure rules goes to the exact enumeration instead.
+
+    def __init__(self, captain_df, flex_df, metric='Proj', salary_cap=settings.SALARY_CAP,
+                 flex_slots=settings.FLEX_SLOTS):
+        self.metric = metric
+        self.salary_cap = salary_cap
+        self.flex_slots = flex_slots
+        self.pool = fn.build_player_pool(captain_df, flex_df, metric)
+        # The model is tiny, plain branch and bound beats CBC's cut generation and heuristics
+        self.solver = pulp.PULP_CBC_CMD(msg=False, options=['cuts off', 'heur off'])
+        self._build_model()
+
+    def _build_model(self):
+        pool = self.pool
+        players = range(len(pool))
+        # Players without a captain row can only be used at flex
+        self.captain_ids = [i for i in players if pd.notna(pool.at[i, 'CPT Salary'])]
+
+        self.prob = pulp.LpProblem('showdown', pulp.LpMaximize)
+        self.cpt = {i: pulp.LpVariable(f'cpt_{i}', cat='Binary') for i in self.captain_ids}
+        self.flex = {i: pulp.LpVariable(f'flex_{i}', cat='Binary') for i in players}
+
+        self.prob += pulp.lpSum(self.cpt.values()) == 1, 'one_captain'
+        self.prob += pulp.lpSum(self.flex.values()) == self.flex_slots, 'flex_slots'
+        self.prob += (pulp.lpSum(pool.at[i, 'CPT Salary'] * var for i, var in self.cpt.items())
+                      + pulp.lpSum(pool.at[i, 'Salary'] * var for i, var in self.flex.items())
+                      <= self.salary_cap), 'salary_cap'
+        # The same player can't be both captain and flex
+        for i in self.captain_ids:
+            self.prob += self.cpt[i] + self.flex[i] <= 1, f'one_role_{i}'
+        self._set_score()
+        # Min exposure constraints start inactive (>= 0) and are switched on when a player falls behind
+        self.min_exposure_constraints = {}
+        self.cut_names = []
+        self.reset()
+
+    def _set_score(self):
+        # Objective from the pool's points
+        pool = self.pool
+        self.score = (pulp.lpSum(pool.at[i, 'CPT Points'] * var for i, var in self.cpt.items())
+                      + pulp.lpSum(pool.at[i, 'Points'] * var for i, var in self.flex.items()))
+        self.prob.setObjective(self.score)
+
+    def set_points(self, points, cpt_points=None):
+        # Swaps in new per-player flex points (and captain points, CAPTAIN_MULTIPLIER x points by
+        # default) in pool order. Only the objective changes.
+        points = np.asarray(points, dtype=float)
+        cpt_points = points * settings.CAPTAIN_MULTIPLIER if cpt_points is None else np.asarray(cpt_points, dtype=float)
+        self.pool['Points'] = points
+        self.pool['CPT Points'] = np.where(self.pool['CPT Salary'].notna(), cpt_points, np.nan)
+        self._set_score()
+
+    def player_vars(self, i):
+        return [var for var in (self.cpt.get(i), self.flex[i]) if var is not None]
+
+    def reset(self):
+        # Drops uniqueness cuts and exposure bounds from a previous run
+        for name in self.cut_names:
+            del self.prob.constraints[name]
+        self.cut_names = []
+        for constraint in self.min_exposure_constraints.values():
+            constraint.constant = 0
+        for var in list(self.cpt.values()) + list(self.flex.values()):
+            var.lowBound = 0
+            var.upBound = 1
+
+    def add_unique_cut(self, captain, flex):
+        # Uniqueness cut: later lineups have to differ from this one in at least one slot
+        name = f'unique_{len(self.cut_names)}'
+        chosen = [self.cpt[captain]] + [self.flex[i] for i in flex]
+        self.prob += pulp.lpSum(chosen) <= len(chosen) - 1, name
+        self.cut_names.append(name)
+
+    def solve(self):
+        # One solve of the current model, returns (captain, flex list) or None if infeasible
+        status = self.prob.solve(self.solver)
+        if pulp.LpStatus[status] != 'Optimal':
+            return None
+        captain = next(i for i, var in self.cpt.items() if var.value() > 0.5)
+        flex = [i for i, var in self.flex.items() if var.value() > 0.5]
+        return captain, flex
+
+    def _exposure_counts(self, exposure, num_lineups, default):
+        # Converts {name: fraction} exposure settings into per-player lineup counts
+        exposure = exposure or {}
+        fractions = np.array([exposure.get(name, default) for name in self.pool['Name']], dtype=float)
+        return np.round(fractions * num_lineups).astype(int)
+
+    def generate(self, num_lineups=1, min_exposure=None, max_exposure=None, default_max_exposure=1.0,
+                 use_enumeration=True):
+        # min_exposure/max_exposure map player names to a fraction of num_lineups
+        if not 1 <= num_lineups <= settings.MAX_LINEUPS:
+            raise ValueError(f"num_lineups must be between 1 and {settings.MAX_LINEUPS}")
+
+        # Without exposure rules the lineups are just the top N, which the enumeration finds
+        # exactly in a fraction of the time of N solves
+        if use_enumeration and not min_exposure and not max_exposure and default_max_exposure >= 1:
+            return enumeration.enumerate_pool(self.pool, self.metric, num_lineups, self.salary_cap, self.flex_slots)
+
+        logging.info(f"Generating {num_lineups} lineups by {self.metric}...")
+        self.reset()
+        max_counts = self._exposure_counts(max_exposure, num_lineups, default_max_exposure)
+        min_counts = self._exposure_counts(min_exposure, num_lineups, 0.0)
+        for i in np.flatnonzero(min_counts):
+            if i not in self.min_exposure_constraints:
+                name = f'min_exposure_{i}'
+                self.prob += pulp.lpSum(self.player_vars(i)) >= 0, name
+                self.min_exposure_constraints[i] = self.prob.constraints[name]
+        used = np.zeros(len(self.pool), dtype=int)
+
+        lineups = []
+        for lineup_num in range(num_lineups):
+            # Force in any player who needs every remaining lineup to reach their minimum
+            for i, constraint in self.min_exposure_constraints.items():
+                constraint.constant = -1 if min_counts[i] - used[i] >= num_lineups - lineup_num else 0
+
+            solution = self.solve()
+            if solution is None:
+                logging.warning(f"No feasible lineup after {len(lineups)} lineups")
+                break
+            captain, flex = solution
+            lineups.append([captain] + flex)
+            self.add_unique_cut(captain, flex)
+
+            # Max exposure: once a player hits their cap their variables are bounded to zero
+            for i in [captain] + flex:
+                used[i] += 1
+                if used[i] >= max_counts[i]:
+                    for var in self.player_vars(i):
+                        var.upBound = 0
+
+        logging.info(f"Generated {len(lineups)} lineups")
+        return fn.lineups_to_frame(self.pool, lineups, self.metric, self.flex_slots)
+
+    def late_swap(self, lineups_df, locked, unique=True):
+        # Re-optimizes the open slots of existing lineups on the current projections. A locked
+        # player keeps their slot in every lineup that has them and can't be added to one that
+        # doesn't; every other slot is open. Lineups with the same locked slots share one exact
+        # enumeration of their best completions, so no solver runs. With unique, the lineups of
+        # a group take its completions best first and can't repeat one another; lineups with
+        # different locked slots can't be the same lineup anyway.
+        logging.info(f"Late swapping {len(lineups_df)} lineups with {len(locked)} locked players...")
+        index = pd.Series(np.arange(len(self.pool)), index=self.pool['Name'])
+        is_locked = np.zeros(len(self.pool), dtype=bool)
+        is_locked[index.reindex(list(locked)).dropna().to_numpy(dtype=int)] = True
+        has_captain = self.pool['CPT Salary'].notna().to_numpy()
+
+        columns = fn.lineup_columns(self.flex_slots)
+        slots = index.reindex(lineups_df[columns].to_numpy().ravel()).to_numpy()
+        slots = slots.reshape(len(lineups_df), len(columns))
+        # Lineups by their locked slots: (captain or None, sorted flex players)
+        groups = {}
+        for lineup_num, lineup in enumerate(slots):
+            captain = lineup[0]
+            fixed_captain = (int(captain) if not np.isnan(captain) and is_locked[int(captain)]
+                             and has_captain[int(captain)] else None)
+            fixed_flex = tuple(sorted(int(i) for i in lineup[1:] if not np.isnan(i) and is_locked[int(i)]))
+            groups.setdefault((fixed_captain, fixed_flex), []).append(lineup_num)
+        solutions = {}
+        for (fixed_captain, fixed_flex), lineup_nums in groups.items():
+            completions, _ = enumeration.top_completions(
+                self.pool, len(lineup_nums) if unique else 1, self.salary_cap, captain=fixed_captain,
+                flex=fixed_flex, excluded=np.flatnonzero(is_locked), flex_slots=self.flex_slots)
+            for k, lineup_num in enumerate(lineup_nums):
+                k = k if unique else 0
+                solutions[lineup_num] = ((int(completions[k][0]), completions[k][1:].astype(int).tolist())
+                                         if k < len(completions) else None)
+
+        lineups, swaps = [], []
+        for lineup_num, lineup in enumerate(slots):
+            solution = solutions[lineup_num]
+            if solution is None:
+                # Nothing legal left to change, e.g. every slot locked and the lineup already used
+                if np.isnan(lineup).any():
+                    logging.warning(f"No feasible swap for lineup {lineup_num + 1} with players off the slate, dropped")
+                    continue
+                logging.warning(f"No feasible swap for lineup {lineup_num + 1}, kept as is")
+                lineups.append(lineup.astype(int).tolist())
+                swaps.append(0)
+                continue
+            captain, flex = solution
+            # Players still in the lineup stay in their FLEX column, a locked slot can't move
+            kept = [i if i in flex else None for i in lineup[1:]]
+            added = iter(i for i in flex if i not in kept)
+            lineups.append([captain] + [int(i) if i is not None else next(added) for i in kept])
+            swaps.append(int(lineup[0] != captain) + kept.count(None))
+
+        result = fn.lineups_to_frame(self.pool, lineups, self.metric, self.flex_slots)
+        result['Swaps'] = swaps
+        logging.info(f"Late swap changed {int(result['Swaps'].gt(0).sum())} of {len(result)} lineups")
+        return result
+
+
+def read_lineups_csv(source):
+    # Lineups from a CSV with CPT, FLEX1..FLEX5 columns, or a DK entries file (CPT then five FLEX
+    # columns holding 'Name (DFS ID)'). Rows without a full lineup are dropped.
+    lineups = pd.read_csv(source)
+    if not set(fn.LINEUP_COLUMNS).issubset(lineups.columns):
+        slot_columns = [col for col in lineups.columns if re.match(r'^(CPT|FLEX)(\.\d+)?$', str(col))]
+        if len(slot_columns) != len(fn.LINEUP_COLUMNS) or slot_columns[0] != 'CPT':
+            raise ValueError(f"Lineups CSV needs {fn.LINEUP_COLUMNS} or DK entry CPT/FLEX columns")
+        lineups = lineups[slot_columns].set_axis(fn.LINEUP_COLUMNS, axis=1)
+    lineups = lineups[fn.LINEUP_COLUMNS].dropna().astype(str)
+    return lineups.apply(lambda col: col.str.replace(ENTRY_ID_SUFFIX, '', regex=True)).reset_index(drop=True)
+
+
+def optimize_slate(game_identifier, num_lineups=settings.MAX_LINEUPS, metric='Proj', **exposure):
+    captain_df, flex_df = fn.load_prepped_slate(game_identifier)
+    return ShowdownOptimizer(captain_df, flex_df, metric=metric).generate(num_lineups, **exposure)
+
+
+def cross_check(captain_df, flex_df, num_lineups=settings.MAX_LINEUPS, metric='Proj'):
+    # Compares the MILP optimizer's lineup scores against the exact enumeration. Ties can make
+    # the lineups themselves differ, so the sorted score sequences are compared.
+    enumerated = enumeration.enumerate_lineups(captain_df, flex_df, metric, top_k=num_lineups)
+    lineup_optimizer = ShowdownOptimizer(captain_df, flex_df, metric=metric)
+    optimized = lineup_optimizer.generate(num_lineups, use_enumeration=False)
+    compared = min(len(enumerated), len(optimized))
+    mismatches = int((~np.isclose(enumerated[metric].to_numpy()[:compared],
+                                  optimized[metric].to_numpy()[:compared], atol=0.011)).sum())
+    mismatches += abs(len(enumerated) - len(optimized))
+    if mismatches:
+        logging.warning(f"MILP and enumeration disagree on {mismatches} of {num_lineups} lineup scores")
+    else:
+        logging.info(f"MILP and enumeration agree on all {num_lineups} lineup scores")
+    return mismatches
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Optimize lineups for every prepped slate")
+    parser.add_argument('--cross-check', action='store_true',
+                        help="compare the MILP's lineup scores against the exact enumeration instead")
+    args = parser.parse_args()
+
+    if args.cross_check:
+        for game_identifier in fn.list_prepped_games():
+            cross_check(*fn.load_prepped_slate(game_identifier))
+    else:
+        os.makedirs(settings.LINEUP_DIR, exist_ok=True)
+        for game_identifier in fn.list_prepped_games():
+            lineups_df = optimize_slate(game_identifier)
+            output_path = os.path.join(settings.LINEUP_DIR, f'SD_{game_identifier}_lineups.csv')
+            lineups_df.to_csv(output_path, index=False)
+            print(f"{game_identifier} {len(lineups_df)} lineups saved to {output_path}")
@@ -0,0 +1,166 @@
+import os
+import re
+import logging
+import unicodedata
+import numpy as np
+import pandas as pd
+import settings
+import slate_file
+
+# Per-slate player registry. Each player gets one integer ID, the DFS ID of their flex row
+# (the captain row's DFS ID resolves to the same player), and a dense index 0..n-1 that every
+# lookup returns, so callers index arrays instead of scanning Name columns.
+REGISTRY_TABLE = 'players'
+REGISTRY_COLUMNS = ['Player ID', 'Captain ID', 'Name', 'Pos', 'Team']
+
+NAME_SUFFIXES = {'jr', 'sr', 'ii', 'iii', 'iv', 'v'}
+NAME_PUNCTUATION = re.compile(r"[.'’,]")
+
+
+def normalize_name(name):
+    # 'D.K. Metcalf', 'DK Metcalf' and 'D. K. Metcalf' -> 'dk metcalf'; 'Odell Beckham Jr.' ->
+    # 'odell beckham'. Accents are dropped and hyphens become spaces.
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    tokens = NAME_PUNCTUATION.sub(' ', name.lower().replace('-', ' ')).split()
+    tokens = [t for t in tokens if t not in NAME_SUFFIXES] or tokens
+    # Runs of single letters are initials of one first name
+    merged = []
+    after_initial = False
+    for token in tokens:
+        initial = len(token) == 1
+        if initial and after_initial:
+            merged[-1] += token
+        else:
+            merged.append(token)
+        after_initial = initial
+    return ' '.join(merged)
+
+
+def name_aliases(name):
+    # Keys a sportsbook might use for a player: the normalized full name, first and last name
+    # without middle names, and first initial plus last name
+    full = normalize_name(name)
+    tokens = full.split()
+    aliases = [full]
+    if len(tokens) > 2:
+        aliases.append(f'{tokens[0]} {tokens[-1]}')
+    if len(tokens) > 1:
+        aliases.append(f'{tokens[0][0]} {tokens[-1]}')
+    return aliases
+
+
+class PlayerRegistry:
+
+    def __init__(self, players):
+        # players is a frame with REGISTRY_COLUMNS, one row per player in dense-index order
+        self.players = players[REGISTRY_COLUMNS].reset_index(drop=True)
+        self.ids = self.players['Player ID'].to_numpy(dtype=np.int64)
+        self.names = self.players['Name'].to_numpy(dtype=object)
+
+        # DFS IDs of both roles -> dense index
+        captain_ids = self.players['Captain ID'].to_numpy(dtype=np.int64)
+        has_captain = captain_ids >= 0
+        dense = np.arange(len(self.players))
+        self._id_index = pd.Index(np.concatenate([self.ids, captain_ids[has_captain]]))
+        self._id_dense = np.concatenate([dense, dense[has_captain]])
+        self._name_index = pd.Index(self.names)
+
+        # Alias -> dense index, aliases shared by two players are left out
+        alias_players = {}
+        for i, name in enumerate(self.names):
+            for alias in name_aliases(name):
+                alias_players.setdefault(alias, set()).add(i)
+        self.aliases = {alias: next(iter(found)) for alias, found in alias_players.items() if len(found) == 1}
+
+    def __len__(self):
+        return len(self.players)
+
+    @classmethod
+    def from_raw(cls, df):
+        # From a raw export (or its renamed form) with both roles' rows. A player's lower salary
+        # row is flex. Without a DFS ID column the IDs are the dense index.
+        columns = ['Name', 'Salary'] + [col for col in ['DFS ID', 'Pos', 'Team'] if col in df.columns]
+        rows = df[columns].reset_index(drop=True)
+        by_salary = rows.sort_values('Salary', kind='stable')
+        flex = by_salary.drop_duplicates('Name', keep='first').sort_index()
+        captain = by_salary[by_salary['Name'].duplicated(keep='first')].drop_duplicates('Name', keep='last')
+
+        players = pd.DataFrame({'Name': flex['Name'].to_numpy(dtype=object)})
+        if 'DFS ID' in rows.columns:
+            players['Player ID'] = flex['DFS ID'].to_numpy(dtype=np.int64)
+            captain_ids = captain.set_index('Name')['DFS ID'].reindex(players['Name'])
+            players['Captain ID'] = captain_ids.fillna(-1).to_numpy(dtype=np.int64)
+        else:
+            players['Player ID'] = np.arange(len(players), dtype=np.int64)
+            players['Captain ID'] = -1
+        for col in ['Pos', 'Team']:
+            players[col] = flex[col].astype(object).to_numpy() if col in flex.columns else ''
+        return cls(players)
+
+    @classmethod
+    def from_tables(cls, flex_df):
+        # From a prepped flex table, which carries no DFS IDs; players in flex order
+        players = flex_df.drop_duplicates('Name')
+        players = pd.DataFrame({'Player ID': np.arange(len(players), dtype=np.int64), 'Captain ID': -1,
+                                'Name': players['Name'].to_numpy(dtype=object),
+                                'Pos': players['Pos'].astype(object).to_numpy(),
+                                'Team': players['Team'].astype(object).to_numpy()})
+        return cls(players)
+
+    def to_frame(self):
+        return self.players.copy()
+
+    def index_of_ids(self, dfs_ids):
+        # Dense index for DFS IDs of either role, -1 for unknown IDs
+        found = self._id_index.get_indexer(np.asarray(dfs_ids, dtype=np.int64))
+        return np.where(found >= 0, self._id_dense[found], -1)
+
+    def index_of_names(self, names):
+        # Dense index for exact slate names, -1 for names not on the slate
+        return self._name_index.get_indexer(pd.Index(names, dtype=object))
+
+    def match(self, names):
+        # Dense index for names from another source (sportsbook participants), exact first, then
+        # through the alias index. -1 where nothing or more than one player matches.
+        names = pd.Index(names, dtype=object)
+        found = self.index_of_names(names)
+        for i in np.flatnonzero(found < 0):
+            # The other side's name as given, or without its middle names; it's never shortened to
+            # an initial, 'Anthony Brown' shouldn't find 'A.J. Brown'
+            tokens = normalize_name(names[i]).split()
+            for alias in [' '.join(tokens), ' '.join(tokens[:1] + tokens[-1:])]:
+                if alias in self.aliases:
+                    found[i] = self.aliases[alias]
+                    break
+        return found
+
+    def index_of_keys(self, keys):
+        # Dense index for an overrides index: DFS IDs when it's named 'DFS ID' or 'ID', else names
+        if getattr(keys, 'name', None) in ('DFS ID', 'ID'):
+            return self.index_of_ids(keys)
+        return self.index_of_names(keys)
+
+    def rows(self, positions, dense):
+        # Table row for each dense index, given that table's row_positions; -1 stays -1
+        dense = np.asarray(dense, dtype=np.int64)
+        return np.where(dense >= 0, positions[dense], -1)
+
+    def row_positions(self, df):
+        # Row position of each player in a table keyed by Name, -1 for players not in it
+        positions = np.full(len(self), -1, dtype=np.int64)
+        dense = self.index_of_names(df['Name'])
+        on_slate = dense >= 0
+        positions[dense[on_slate]] = np.flatnonzero(on_slate)
+        return positions
+
+
+def load_registry(game_identifier, prepped_dir=settings.OUTPUT_DIR, flex_df=None):
+    # The registry written with a game's binary slate, or one built from its prepped tables for
+    # slates prepped before registries were stored
+    path = slate_file.slate_path(game_identifier, prepped_dir)
+    if os.path.exists(path) and REGISTRY_TABLE in slate_file.read_header(path)['tables']:
+        return PlayerRegistry(slate_file.open_slate(path, tables=[REGISTRY_TABLE])[REGISTRY_TABLE])
+    if flex_df is None:
+        return None
+    logging.info(f"No stored player registry for {game_identifier}, building one from its tables")
+    return PlayerRegistry.from_tables(flex_df)
@@ -0,0 +1,187 @@
+import os
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import settings
+import functions as fn
+import process_csv
+import implied
+import players
+import slate_file
+
+# Long-running prep for the last stretch before lock. Polls the raw directory, waits until a
+# file has stopped changing for the debounce period, diffs its players against the previous
+# parse and re-preps only the changed players' rows before publishing the merged tables.
+
+
+def changed_players(previous_rows, player_rows):
+    # Names whose row differs from the previous parse (NaN equal to NaN), or None when the
+    # player list or columns changed and the slate needs a full prep
+    if (list(previous_rows.columns) != list(player_rows.columns)
+            or set(previous_rows['Name']) != set(player_rows['Name'])
+            or previous_rows['Name'].duplicated().any() or player_rows['Name'].duplicated().any()):
+        return None
+    previous = previous_rows.set_index('Name').reindex(player_rows['Name'])
+    current = player_rows.set_index('Name')
+    differs = np.zeros(len(current), dtype=bool)
+    for col in current.columns:
+        new, old = current[col].to_numpy(), previous[col].to_numpy()
+        same = new == old
+        if new.dtype.kind == 'f' or old.dtype.kind == 'f':
+            same |= pd.isna(new) & pd.isna(old)
+        differs |= ~same
+    return current.index[differs].tolist()
+
+
+def merge_site_table(previous_table, player_rows, changed, site, selections=None, registry=None):
+    # The previous prepped table with the changed players' rows re-prepped. prep_site_table works
+    # row by row, so the merged table matches a full prep once it's back in raw file order and
+    # sorted the same way.
+    changed_rows = player_rows[player_rows['Name'].isin(changed)].reset_index(drop=True)
+    update = process_csv.prep_site_table(changed_rows, site, selections, registry)
+    kept = previous_table[~previous_table['Name'].isin(changed)]
+    merged = pd.concat([kept, update], ignore_index=True)
+    file_order = pd.Index(player_rows['Name']).get_indexer(merged['Name'])
+    merged = merged.iloc[np.argsort(file_order, kind='stable')].reset_index(drop=True)
+    return merged.sort_values(by='Salary', ascending=False).reset_index(drop=True)
+
+
+class PrepDaemon:
+
+    def __init__(self, raw_dir=settings.RAW_CSV_DIR, output_dir=settings.OUTPUT_DIR, sites=None,
+                 odds_pull=settings.ODDS_PULL, poll_seconds=settings.PREP_POLL_SECONDS,
+                 debounce_seconds=settings.PREP_DEBOUNCE_SECONDS):
+        self.raw_dir = raw_dir
+        self.output_dir = output_dir
+        self.sites = sites or settings.PREP_SITES
+        self.odds_pull = odds_pull
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self.manifest_path = os.path.join(output_dir, os.path.basename(settings.PREP_MANIFEST))
+        # Raw path -> (mtime_ns, size) and when that version was first seen
+        self.pending = {}
+        # Raw path -> file version last handled, so a file is looked at once per change
+        self.handled = {}
+        # Raw path -> previous parse: player rows and each site's prepped table
+        self.parsed = {}
+
+    def scan(self):
+        # Raw files with a new version that hasn't changed for debounce_seconds
+        now = time.monotonic()
+        ready = []
+        for name in sorted(os.listdir(self.raw_dir)):
+            if not name.endswith('.csv'):
+                continue
+            path = os.path.join(self.raw_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            version = (stat.st_mtime_ns, stat.st_size)
+            if self.handled.get(path) == version:
+                continue
+            if path not in self.pending or self.pending[path][0] != version:
+                self.pending[path] = (version, now)
+            elif now - self.pending[path][1] >= self.debounce_seconds:
+                ready.append(path)
+        return ready
+
+    def prep(self, raw_csv_file):
+        # Re-preps one raw file and publishes it. Returns the changed player names, or None when
+        # the file was fully prepped.
+        fingerprint = process_csv.prep_fingerprint(raw_csv_file, self.odds_pull, self.sites)
+        manifest = process_csv.load_manifest(self.manifest_path)
+        entry = manifest.get(os.path.basename(raw_csv_file))
+        published = (entry is not None and entry['fingerprint'] == fingerprint
+                     and all(os.path.exists(os.path.join(self.output_dir, path)) for path in entry['outputs'].values()))
+        if published and raw_csv_file in self.parsed:
+            logging.info(f"{os.path.basename(raw_csv_file)} content unchanged, skipping")
+            return []
+
+        game_identifier = process_csv.game_identifier_from_path(raw_csv_file)
+        selections = (None if self.odds_pull is None
+                      else slate_file.open_slate(self.odds_pull, tables=['selections'])['selections'])
+        extra_columns = implied.STAT_COLUMNS if selections is not None else ()
+        raw_df = process_csv.read_raw_csv(raw_csv_file, extra_columns=extra_columns, sites=self.sites)
+        sites = process_csv.preppable_sites(raw_df.columns, self.sites, os.path.basename(raw_csv_file))
+        if not sites:
+            raise ValueError("none of the sites can be prepped from this export")
+        registry = players.PlayerRegistry.from_raw(raw_df)
+        player_rows = fn.build_player_table(raw_df, process_csv.raw_captain_columns(sites))
+
+        # Already published before the daemon started, its tables only become the baseline
+        if published:
+            self.parsed[raw_csv_file] = {'rows': player_rows, 'tables': {
+                site: process_csv.prep_site_table(player_rows, site, selections, registry) for site in sites}}
+            logging.info(f"{os.path.basename(raw_csv_file)} is up to date, kept as the baseline")
+            return []
+
+        previous = self.parsed.get(raw_csv_file)
+        # A site that became preppable has no previous table to merge into
+        changed = (None if previous is None or set(previous['tables']) != set(sites)
+                   else changed_players(previous['rows'], player_rows))
+        if changed == []:
+            logging.info(f"{os.path.basename(raw_csv_file)} has no player changes")
+            self.parsed[raw_csv_file]['rows'] = player_rows
+            return []
+
+        metadata = {'game': game_identifier, 'source': os.path.basename(raw_csv_file), 'fingerprint': fingerprint,
+                    'odds_pull': None if self.odds_pull is None else os.path.basename(self.odds_pull),
+                    'changed': changed}
+        tables, paths = {}, {}
+        for site in sites:
+            if changed is None:
+                tables[site] = process_csv.prep_site_table(player_rows, site, selections, registry)
+            else:
+                tables[site] = merge_site_table(previous['tables'][site], player_rows, changed, site, selections,
+                                                registry)
+            paths.update(process_csv.publish_site_table(tables[site], site, game_identifier, self.output_dir,
+                                                        metadata, registry))
+        self.parsed[raw_csv_file] = {'rows': player_rows, 'tables': tables}
+
+        manifest[os.path.basename(raw_csv_file)] = {
+            'fingerprint': fingerprint, 'game': game_identifier,
+            'outputs': {table: os.path.relpath(path, self.output_dir) for table, path in paths.items()}}
+        process_csv.save_manifest(manifest, self.manifest_path)
+        if changed is None:
+            logging.info(f"Published {game_identifier}, full prep")
+        else:
+            logging.info(f"Published {game_identifier}, {len(changed)} players re-prepped: {', '.join(changed)}")
+        return changed
+
+    def run_once(self):
+        for raw_csv_file in self.scan():
+            version = self.pending.pop(raw_csv_file)[0]
+            try:
+                self.prep(raw_csv_file)
+            except Exception as e:
+                # A half-written or malformed export, it's retried when the file changes again
+                logging.error(f"function call: prep of {os.path.basename(raw_csv_file)} failed due to error - {str(e)}")
+            self.handled[raw_csv_file] = version
+
+    def run(self):
+        logging.info(f"Watching {self.raw_dir} every {self.poll_seconds}s, publishing to {self.output_dir}")
+        try:
+            while True:
+                self.run_once()
+                time.sleep(self.poll_seconds)
+        except KeyboardInterrupt:
+            logging.info("Prep daemon stopped")
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Watch the raw CSV directory and re-prep changed exports")
+    parser.add_argument('--odds', default=settings.ODDS_PULL,
+                        help="sportsbook pull to take Adj_Proj and the percentiles from")
+    parser.add_argument('--sites', default=','.join(settings.PREP_SITES),
+                        help=f"comma separated sites to prep, from {', '.join(settings.SITE_RULES)}")
+    parser.add_argument('--poll', type=float, default=settings.PREP_POLL_SECONDS)
+    parser.add_argument('--debounce', type=float, default=settings.PREP_DEBOUNCE_SECONDS)
+    args = parser.parse_args()
+
+    PrepDaemon(sites=args.sites.split(','), odds_pull=args.odds, poll_seconds=args.poll, debounce_seconds=args.debounce).run()
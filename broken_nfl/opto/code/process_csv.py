@@ -1,90 +1,408 @@
+import numpy as np
 import pandas as pd
 import os
+import argparse
+import json
+import hashlib
 import settings
 import functions as fn
+import slate_file
+import implied
+import players
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pandas.api.types import union_categoricals
 
-# Configure logging to print to terminal
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Kept columns read as categoricals or integers, everything else numeric is float64. float32
+# parsing moves some prepped /$ values across a rounding boundary, so floats stay full width.
+CATEGORICAL_COLUMNS = ['Pos', 'Team', 'Opp']
+INTEGER_COLUMNS = ['Salary']
 
-# Read the CSV file
-csv_files = [f for f in os.listdir(settings.RAW_CSV_DIR) if f.endswith('.csv')]
-if not csv_files:
-    logging.error("No CSV files found in the raw CSV directory.")
-    exit(1)
-raw_csv_file = os.path.join(settings.RAW_CSV_DIR, csv_files[0])
-df = pd.read_csv(raw_csv_file)
+# Raw column the player registry takes its IDs from
+ID_COLUMN = 'DFS ID'
 
-# Rename columns first
-df.rename(columns=settings.RENAME_RULES, inplace=True)
+# Site rules recorded in each prepped slate's metadata
+SITE_METADATA = ['salary_cap', 'flex_slots', 'captain_multiplier', 'captain_salary_multiplier']
 
-# Filter out unwanted rows based on projection threshold
-df = df[df['Proj'] > settings.MY_PROJ_THRESHOLD]
 
-# Keep only the desired columns
-df_filtered = df[settings.COLUMNS_TO_KEEP].copy()
+def game_identifier_from_path(raw_csv_file):
+    # 'NFL_2024-09-26-815pm_DK_SHOWDOWN_DAL-@-NYG.csv' -> 'DAL-@-NYG'
+    file_base_name = os.path.basename(raw_csv_file)
+    return file_base_name.split('_')[-1].replace('.csv', '')
 
-# Reset index
-df_filtered = df_filtered.reset_index(drop=True)
 
-# Adjust 'Roster%' percentage
-if 'Roster%' in df_filtered.columns:
-    df_filtered = fn.adjust_roster_percentage(df_filtered)
+def raw_columns(sites=None):
+    # Raw export column -> dtype for just the columns prep uses, looked up through each site's
+    # rename rules. The other sites' salary and ownership columns are optional, the rest must be
+    # in the export.
+    dtypes = {}
+    for site in sites or [settings.DEFAULT_SITE]:
+        rules = settings.SITE_RULES[site]
+        source_names = {new: old for old, new in rules['rename'].items()}
+        for col in settings.COLUMNS_TO_KEEP:
+            if col == 'Name':
+                dtype = 'object'
+            elif col in CATEGORICAL_COLUMNS:
+                dtype = 'category'
+            elif col in INTEGER_COLUMNS:
+                dtype = 'int32'
+            else:
+                dtype = 'float64'
+            if col == 'Adj_Proj' and col not in source_names:
+                dtypes.update({ratio_col: 'float64' for ratio_col in settings.ADJ_PROJ_RATIO})
+                continue
+            dtypes[source_names.get(col, col)] = dtype
+        if rules['salary_column'] != 'Salary':
+            dtypes[rules['salary_column']] = 'float64'
+    return dtypes
 
-# Proceed with separating captains and flex players as before...
 
-# Identify duplicated names in the 'Name' column
-duplicated_names = df_filtered['Name'].duplicated(keep=False)
+def captain_ownership_column(site):
+    # Player table column holding a site's captain ownership, read from its own ownership column
+    # on the captain row. DK's is CPT Roster% itself.
+    if site == settings.DEFAULT_SITE:
+        return 'CPT Roster%'
+    return f"CPT {settings.SITE_RULES[site]['ownership_column']}"
 
-# Separate duplicated and non-duplicated rows
-duplicates_df = df_filtered[duplicated_names].copy()
-non_duplicates_df = df_filtered[~duplicated_names].copy()
 
-# For duplicated names, separate captain and flex rows based on salary
-# Captains have higher salaries
-captain_rows = duplicates_df.loc[duplicates_df.groupby('Name')['Salary'].idxmax()].reset_index(drop=True)
+def raw_captain_columns(sites=None):
+    # Captain columns of the player table -> the raw export columns they're read from, plus the
+    # captain ownership of every other site
+    source_names = {new: old for old, new in settings.RENAME_RULES.items()}
+    columns = {captain_col: source_names.get(col, col) for captain_col, col in fn.CAPTAIN_COLUMNS.items()}
+    for site in sites or []:
+        columns[captain_ownership_column(site)] = settings.SITE_RULES[site]['ownership_column']
+    return columns
 
-# Flex players from duplicates have lower salaries
-flex_rows_from_duplicates = duplicates_df.loc[duplicates_df.groupby('Name')['Salary'].idxmin()].reset_index(drop=True)
 
-# Combine flex_rows_from_duplicates with non_duplicated rows to get the full flex DataFrame
-flex_df_cleaned = pd.concat([flex_rows_from_duplicates, non_duplicates_df], ignore_index=True)
+def site_columns_needed(site):
+    rules = settings.SITE_RULES[site]
+    return [rules['salary_column'], rules['ownership_column']]
 
-# Continue with your calculations for both DataFrames
-# Adjust percentiles
-captain_df_cleaned = fn.adjust_percentiles(captain_rows, adjustment_factor=1.0)
-flex_df_cleaned = fn.adjust_percentiles(flex_df_cleaned, adjustment_factor=1.0)
 
-# Calculate PPD (Points Per Dollar or similar metric)
-captain_df_cleaned = fn.calculate_ppd(captain_df_cleaned)
-flex_df_cleaned = fn.calculate_ppd(flex_df_cleaned)
+def optional_columns(sites=None):
+    return {col for site in sites or [settings.DEFAULT_SITE] if site != settings.DEFAULT_SITE
+            for col in site_columns_needed(site)}
 
-# Select columns to display
-captain_df_cleaned = captain_df_cleaned[settings.COLUMNS_TO_DISPLAY]
-flex_df_cleaned = flex_df_cleaned[settings.COLUMNS_TO_DISPLAY]
 
-# Standardize numeric columns
-captain_df_cleaned = fn.standardize_numeric_columns(captain_df_cleaned)
-flex_df_cleaned = fn.standardize_numeric_columns(flex_df_cleaned)
+def preppable_sites(columns, sites, source):
+    # The sites whose own salary and ownership columns are in the export, the others are
+    # skipped with an error rather than prepped from the DK values
+    available = []
+    for site in sites:
+        missing = [col for col in site_columns_needed(site) if col not in columns]
+        if missing:
+            logging.error(f"Skipping {site} for {source}: the export has no {' or '.join(missing)} column")
+        else:
+            available.append(site)
+    return available
 
-# Sort DataFrames by 'Salary' in descending order
-captain_df_cleaned = captain_df_cleaned.sort_values(by='Salary', ascending=False)
-flex_df_cleaned = flex_df_cleaned.sort_values(by='Salary', ascending=False)
 
-# Save the processed CSV files
-file_base_name = os.path.basename(raw_csv_file)
-game_identifier = file_base_name.split('_')[-1].replace('.csv', '')
+def _concat_chunks(chunks):
+    # Chunks carry their own category sets, union them so the columns stay categorical
+    df = pd.concat(chunks, ignore_index=True)
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            df[col] = union_categoricals([chunk[col] for chunk in chunks])
+    return df
 
-# Ensure the output directory exists
-os.makedirs(settings.OUTPUT_DIR, exist_ok=True)
 
-# Save flex data
-flex_output_path = os.path.join(settings.OUTPUT_DIR, f'SD_{game_identifier}_flex.csv')
-flex_df_cleaned.to_csv(flex_output_path, index=False)
+def read_raw_csv(raw_csv_file, chunksize=None, extra_columns=(), sites=None):
+    # Reads only the columns prep uses for the given sites, with explicit dtypes, in one pass over
+    # the file. With chunksize the file is streamed and each chunk is cut to projected players
+    # before it's kept, for the big season exports. extra_columns are further numeric columns to
+    # read as float64, e.g. the stat projections.
+    dtypes = raw_columns(sites)
+    dtypes[ID_COLUMN] = 'int64'
+    dtypes.update({col: 'float64' for col in extra_columns})
+    optional = optional_columns(sites)
+    with open(raw_csv_file, newline='') as f:
+        header = pd.read_csv(f, nrows=0).columns
+    usecols = [col for col in dtypes if col not in optional or col in header]
+    source_proj = next((old for old, new in settings.RENAME_RULES.items() if new == 'Proj'), 'Proj')
+    if chunksize is None:
+        return pd.read_csv(raw_csv_file, usecols=usecols, dtype=dtypes)
 
-# Save captain data
-captain_output_path = os.path.join(settings.OUTPUT_DIR, f'SD_{game_identifier}_captain.csv')
-captain_df_cleaned.to_csv(captain_output_path, index=False)
+    chunks = [chunk[chunk[source_proj] > settings.MY_PROJ_THRESHOLD]
+              for chunk in pd.read_csv(raw_csv_file, usecols=usecols, dtype=dtypes, chunksize=chunksize)]
+    return _concat_chunks(chunks)
 
-print(f"{game_identifier} showdown CSV prepped for flex and captain")
 
+def site_columns(player_rows, site):
+    # A site's view of the shared player rows under the prepped column names: its projections,
+    # ownership, salaries and captain salaries, and Adj_Proj carried over as a ratio when it has none
+    rules = settings.SITE_RULES[site]
+    rename = rules['rename']
+    missing = [col for col in site_columns_needed(site) if col not in player_rows.columns]
+    if missing:
+        raise ValueError(f"No {' or '.join(missing)} column in the export to prep {site} from")
+    keep = [col for col in player_rows.columns
+            if col in rename or (col in settings.COLUMNS_TO_KEEP and col not in rename.values())
+            or col in fn.CAPTAIN_COLUMNS or col in implied.STAT_COLUMNS or col == ID_COLUMN]
+    df = player_rows[keep].rename(columns=rename)
+
+    if rules['salary_column'] != 'Salary':
+        salary = player_rows[rules['salary_column']].to_numpy(dtype=float)
+        df['Salary'] = np.round(salary).astype(player_rows['Salary'].dtype)
+        has_captain = df['CPT Salary'].notna().to_numpy()
+        df['CPT Salary'] = np.where(has_captain, np.round(salary * rules['captain_salary_multiplier']), np.nan)
+
+    # Captain ownership from the site's own column, never DK's
+    captain_ownership = captain_ownership_column(site)
+    if captain_ownership != 'CPT Roster%':
+        if captain_ownership not in player_rows.columns:
+            raise ValueError(f"No captain {rules['ownership_column']} column in the player rows to prep {site} from")
+        df['CPT Roster%'] = player_rows[captain_ownership].to_numpy(dtype=float)
+
+    if 'Adj_Proj' not in df.columns:
+        adjusted, base = (player_rows[col].to_numpy(dtype=float) for col in settings.ADJ_PROJ_RATIO)
+        ratio = np.divide(adjusted, base, out=np.ones_like(adjusted), where=base > 0)
+        df['Adj_Proj'] = (df['Proj'].to_numpy(dtype=float) * ratio).astype(df['Proj'].dtype)
+    return df
+
+
+def prep_site_table(player_rows, site=settings.DEFAULT_SITE, selections=None, registry=None):
+    # Turns the shared player rows of a raw export into one site's prepped player table, one row
+    # per player with the captain salary and ownership alongside. With a sportsbook selections
+    # frame, an 'implied' site takes Adj_Proj and the percentiles from the player markets,
+    # matched to players through the slate's registry.
+
+    # Site columns under the prepped names
+    table = site_columns(player_rows, site)
+
+    # Filter out unwanted rows based on projection threshold
+    table = table[table['Proj'] > settings.MY_PROJ_THRESHOLD].reset_index(drop=True)
+
+    # Market-implied projections replace Adj_Proj before the percentiles are adjusted to it
+    if selections is not None and settings.SITE_RULES[site]['implied']:
+        table = implied.apply_implied_projections(table, selections, settings.IMPLIED_WEIGHT, registry)
+
+    # Keep only the desired columns
+    captain_columns = [col for col in fn.CAPTAIN_COLUMNS if col in table.columns]
+    table = table[settings.COLUMNS_TO_KEEP + captain_columns].copy()
+
+    # Adjust 'Roster%' percentage
+    if 'Roster%' in table.columns:
+        table = fn.adjust_roster_percentage(table)
+
+    # Adjust percentiles and calculate PPD (Points Per Dollar), once per player for both roles
+    table = fn.adjust_percentiles(table, adjustment_factor=1.0)
+    table = fn.calculate_ppd(table)
+
+    # Select columns to display, plus Std for the simulation covariance
+    table = table[settings.COLUMNS_TO_DISPLAY + ['Std'] + captain_columns]
+
+    # Standardize numeric columns
+    table = fn.standardize_numeric_columns(table)
+
+    # Sort by 'Salary' in descending order
+    return table.sort_values(by='Salary', ascending=False).reset_index(drop=True)
+
+
+def prep_player_table(df, selections=None, registry=None, site=settings.DEFAULT_SITE):
+    # Prepped player table of a raw projection export for one site
+    return prep_site_table(fn.build_player_table(df, raw_captain_columns([site])), site, selections, registry)
+
+
+def prep_slate(df, selections=None, registry=None, site=settings.DEFAULT_SITE):
+    # Captain and flex tables of a raw projection export
+    table = prep_player_table(df, selections, registry, site)
+    return fn.captain_view(table, settings.SITE_RULES[site]['captain_multiplier']), fn.flex_view(table)
+
+
+def write_csv_atomic(df, path):
+    # Writes to a temp file in the same directory and renames it into place, so readers never
+    # see a half-written table
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w', newline='') as f:
+            df.to_csv(f, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def site_output_dir(output_dir, site):
+    # The default site's tables stay at the top of output_dir, where the apps read them, other
+    # sites get a subdirectory each
+    return output_dir if site == settings.DEFAULT_SITE else os.path.join(output_dir, site)
+
+
+def output_paths(game_identifier, output_dir=settings.OUTPUT_DIR, sites=None):
+    # Output files by key: 'captain', 'flex' and 'slate' for the default site, '<site>_captain'
+    # and so on for the others
+    paths = {}
+    for site in sites or [settings.DEFAULT_SITE]:
+        site_dir = site_output_dir(output_dir, site)
+        prefix = '' if site == settings.DEFAULT_SITE else f'{site}_'
+        paths.update({
+            f'{prefix}captain': os.path.join(site_dir, f'SD_{game_identifier}_captain.csv'),
+            f'{prefix}flex': os.path.join(site_dir, f'SD_{game_identifier}_flex.csv'),
+            f'{prefix}slate': slate_file.slate_path(game_identifier, site_dir),
+        })
+    return paths
+
+
+def prep_fingerprint(raw_csv_file, odds_pull=None, sites=None):
+    # Hash of the raw file's content plus the prep settings, so a settings change also re-preps.
+    # The rules of the sites prepped and the odds pull applied during prep are hashed too.
+    digest = hashlib.sha256()
+    sites = sites or [settings.DEFAULT_SITE]
+    settings_used = [settings.RENAME_RULES, settings.COLUMNS_TO_KEEP, settings.COLUMNS_TO_DISPLAY,
+                     settings.MY_PROJ_THRESHOLD]
+    if sites != [settings.DEFAULT_SITE]:
+        settings_used.append({site: settings.SITE_RULES[site] for site in sites})
+    if odds_pull is not None:
+        settings_used.append(settings.IMPLIED_WEIGHT)
+    digest.update(json.dumps(settings_used, sort_keys=True).encode())
+    for path in [raw_csv_file] + ([odds_pull] if odds_pull is not None else []):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path=settings.PREP_MANIFEST):
+    # Raw file name -> fingerprint and outputs of its last successful prep
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path=settings.PREP_MANIFEST):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def publish_site_table(player_table, site, game_identifier, output_dir, metadata, registry):
+    # Writes one site's prepped player table: the binary slate first, then the captain and flex
+    # CSV exports, then the slate's mtime is moved past theirs so readers go back to it. Each file
+    # is replaced atomically and readers take whichever of slate and CSV is newer, so any mix of
+    # old and new files they can see resolves to the new version.
+    rules = settings.SITE_RULES[site]
+    os.makedirs(site_output_dir(output_dir, site), exist_ok=True)
+    paths = output_paths(game_identifier, output_dir, [site])
+    prefix = '' if site == settings.DEFAULT_SITE else f'{site}_'
+
+    # The CSV exports keep the captain and flex layout, the binary slate stores only the player
+    # table and derives both views on read
+    metadata = dict(metadata, site=site, **{key: rules[key] for key in SITE_METADATA})
+    tables = {fn.PLAYER_TABLE: player_table, players.REGISTRY_TABLE: registry.to_frame()}
+    slate_file.write_slate(paths[f'{prefix}slate'], tables, metadata)
+    write_csv_atomic(fn.flex_view(player_table), paths[f'{prefix}flex'])
+    write_csv_atomic(fn.captain_view(player_table, rules['captain_multiplier']), paths[f'{prefix}captain'])
+    newest = max(os.stat(paths[f'{prefix}{table}']).st_mtime_ns for table in ['flex', 'captain'])
+    os.utime(paths[f'{prefix}slate'], ns=(newest + 1, newest + 1))
+    return paths
+
+
+def write_site_outputs(player_rows, site, game_identifier, output_dir, metadata, selections=None, registry=None):
+    # Preps one site's table from the shared player rows and publishes its captain and flex
+    # tables as CSVs and its player table as one memory-mappable binary slate
+    player_table = prep_site_table(player_rows, site, selections, registry)
+    return publish_site_table(player_table, site, game_identifier, output_dir, metadata, registry)
+
+
+def process_file(raw_csv_file, output_dir=settings.OUTPUT_DIR, fingerprint=None, odds_pull=None, sites=None):
+    # Preps one raw export for every site in sites from a single read of the file. The shared
+    # player rows are built once, each site only adds its column transforms, and the sites'
+    # outputs are written concurrently. odds_pull is a sportsbook selections .slate to project from.
+    sites = sites or [settings.DEFAULT_SITE]
+    game_identifier = game_identifier_from_path(raw_csv_file)
+    chunksize = settings.RAW_CHUNK_ROWS if os.path.getsize(raw_csv_file) > settings.RAW_CHUNKED_BYTES else None
+    selections = None if odds_pull is None else slate_file.open_slate(odds_pull, tables=['selections'])['selections']
+    extra_columns = implied.STAT_COLUMNS if selections is not None else ()
+    raw_df = read_raw_csv(raw_csv_file, chunksize, extra_columns, sites)
+    sites = preppable_sites(raw_df.columns, sites, os.path.basename(raw_csv_file))
+    if not sites:
+        raise ValueError("none of the sites can be prepped from this export")
+    registry = players.PlayerRegistry.from_raw(raw_df)
+    player_rows = fn.build_player_table(raw_df, raw_captain_columns(sites))
+
+    metadata = {'game': game_identifier, 'source': os.path.basename(raw_csv_file), 'fingerprint': fingerprint,
+                'odds_pull': None if odds_pull is None else os.path.basename(odds_pull)}
+    with ThreadPoolExecutor(max_workers=len(sites)) as executor:
+        futures = [executor.submit(write_site_outputs, player_rows, site, game_identifier, output_dir, metadata,
+                                   selections, registry) for site in sites]
+        paths = {}
+        for future in futures:
+            paths.update(future.result())
+    return game_identifier, paths
+
+
+def _process_task(task):
+    raw_csv_file, fingerprint, output_dir, odds_pull, sites = task
+    try:
+        game_identifier, paths = process_file(raw_csv_file, output_dir, fingerprint, odds_pull, sites)
+        return raw_csv_file, fingerprint, game_identifier, paths, None
+    except Exception as e:
+        return raw_csv_file, fingerprint, None, None, str(e)
+
+
+def process_directory(raw_dir=settings.RAW_CSV_DIR, output_dir=settings.OUTPUT_DIR, workers=None, force=False,
+                      odds_pull=settings.ODDS_PULL, sites=None):
+    # Preps every raw CSV in raw_dir for each site across a process pool, skipping files whose
+    # fingerprint matches the manifest and whose outputs still exist
+    sites = sites or settings.PREP_SITES
+    csv_files = sorted(os.path.join(raw_dir, f) for f in os.listdir(raw_dir) if f.endswith('.csv'))
+    if not csv_files:
+        logging.error("No CSV files found in the raw CSV directory.")
+        return []
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, os.path.basename(settings.PREP_MANIFEST))
+    manifest = load_manifest(manifest_path)
+
+    tasks = []
+    for raw_csv_file in csv_files:
+        fingerprint = prep_fingerprint(raw_csv_file, odds_pull, sites)
+        entry = manifest.get(os.path.basename(raw_csv_file))
+        # Only the outputs written last time are checked, sites skipped for missing columns have none
+        up_to_date = (entry is not None and entry['fingerprint'] == fingerprint
+                      and all(os.path.exists(os.path.join(output_dir, path)) for path in entry['outputs'].values()))
+        if up_to_date and not force:
+            logging.info(f"{os.path.basename(raw_csv_file)} unchanged, skipping")
+            continue
+        tasks.append((raw_csv_file, fingerprint, output_dir, odds_pull, sites))
+
+    if not tasks:
+        return []
+
+    if len(tasks) == 1:
+        results = [_process_task(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(tasks))) as executor:
+            results = list(executor.map(_process_task, tasks))
+
+    prepped = []
+    for raw_csv_file, fingerprint, game_identifier, paths, error in results:
+        if error is not None:
+            logging.error(f"Failed to prep {os.path.basename(raw_csv_file)}: {error}")
+            continue
+        outputs = {table: os.path.relpath(path, output_dir) for table, path in paths.items()}
+        manifest[os.path.basename(raw_csv_file)] = {'fingerprint': fingerprint, 'game': game_identifier,
+                                                    'outputs': outputs}
+        prepped.append(game_identifier)
+        prepped_sites = [site for site in sites
+                         if ('slate' if site == settings.DEFAULT_SITE else f'{site}_slate') in paths]
+        print(f"{game_identifier} showdown CSV prepped for flex and captain ({', '.join(prepped_sites)})")
+
+    save_manifest(manifest, manifest_path)
+    return prepped
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Prep raw projection exports into captain and flex tables")
+    parser.add_argument('--odds', default=settings.ODDS_PULL,
+                        help="sportsbook pull to take Adj_Proj and the percentiles from")
+    parser.add_argument('--sites', default=','.join(settings.PREP_SITES),
+                        help=f"comma separated sites to prep, from {', '.join(settings.SITE_RULES)}")
+    args = parser.parse_args()
+    process_directory(odds_pull=args.odds, sites=args.sites.split(','))
@@ -0,0 +1,230 @@
+import sys
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import numpy as np
+import pandas as pd
+import settings
+import functions as fn
+
+# Persistent store of lineup runs. A run is one slate plus the config that built it (method,
+# metric, exposure, overrides...); its lineups are stored as player-ID tuples with per-lineup
+# sim metrics and per-player exposure alongside. Lookups by captain, by player and by sim rank
+# go through indexes.
+SIM_COLUMNS = {'Win%': 'win_rate', 'Top 1%': 'top1_rate', 'Avg Payout': 'avg_payout', 'ROI': 'roi'}
+SLOT_COLUMNS = ['cpt_id'] + [f'flex{i + 1}_id' for i in range(settings.FLEX_SLOTS)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    game TEXT,
+    config_key TEXT,
+    config TEXT,
+    metric TEXT,
+    created_at INTEGER,
+    UNIQUE (game, config_key)
+);
+CREATE TABLE IF NOT EXISTS slate_players (
+    game TEXT,
+    player_id INTEGER,
+    name TEXT,
+    PRIMARY KEY (game, player_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lineups (
+    run_id INTEGER,
+    lineup_num INTEGER,
+    cpt_id INTEGER, flex1_id INTEGER, flex2_id INTEGER, flex3_id INTEGER, flex4_id INTEGER, flex5_id INTEGER,
+    salary INTEGER,
+    points REAL,
+    PRIMARY KEY (run_id, lineup_num)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lineup_players (
+    player_id INTEGER,
+    run_id INTEGER,
+    lineup_num INTEGER,
+    is_captain INTEGER,
+    PRIMARY KEY (player_id, run_id, lineup_num)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lineup_sims (
+    run_id INTEGER,
+    lineup_num INTEGER,
+    win_rate REAL, top1_rate REAL, avg_payout REAL, roi REAL,
+    PRIMARY KEY (run_id, lineup_num)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS exposures (
+    run_id INTEGER,
+    player_id INTEGER,
+    cpt_exposure REAL, flex_exposure REAL, exposure REAL,
+    PRIMARY KEY (run_id, player_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_game ON runs (game, run_id);
+CREATE INDEX IF NOT EXISTS lineups_cpt ON lineups (cpt_id, run_id);
+CREATE INDEX IF NOT EXISTS lineup_sims_top1 ON lineup_sims (run_id, top1_rate DESC);
+CREATE INDEX IF NOT EXISTS lineup_sims_roi ON lineup_sims (run_id, roi DESC);
+"""
+
+RUN_TABLES = ['lineups', 'lineup_players', 'lineup_sims', 'exposures']
+
+
+def config_key(config):
+    # Stable hash of a run config; dict order and numpy scalars don't change it
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=float).encode()).hexdigest()
+
+
+def lineup_ids(lineups_df, registry):
+    # (lineups, 6) player IDs for a CPT, FLEX1..FLEX5 lineup table, through the slate's registry
+    dense = registry.index_of_names(lineups_df[fn.LINEUP_COLUMNS].to_numpy().ravel())
+    if (dense < 0).any():
+        raise ValueError("Lineups have players that aren't in the slate's registry")
+    return registry.ids[dense].reshape(len(lineups_df), len(fn.LINEUP_COLUMNS))
+
+
+class ResultsStore:
+
+    def __init__(self, path=settings.RESULTS_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def save_run(self, game_identifier, config, lineups_df, registry):
+        # Stores a run's lineups and exposure, replacing an earlier run of the same slate and
+        # config. Returns the run ID.
+        key = config_key(config)
+        metric = config.get('metric', 'Proj')
+        ids = lineup_ids(lineups_df, registry)
+        lineup_nums = np.arange(len(lineups_df))
+        points = lineups_df[metric] if metric in lineups_df.columns else pd.Series(np.nan, index=lineups_df.index)
+
+        # Exposure as a share of the run's lineups, by role and in total
+        player_ids, cpt_counts = np.unique(ids[:, 0], return_counts=True)
+        exposure = pd.DataFrame({'cpt': pd.Series(cpt_counts, index=player_ids),
+                                 'flex': pd.Series(ids[:, 1:].ravel()).value_counts()}).fillna(0) / max(len(ids), 1)
+
+        with self.conn:
+            previous = self.conn.execute("SELECT run_id FROM runs WHERE game = ? AND config_key = ?",
+                                         (game_identifier, key)).fetchone()
+            if previous is not None:
+                self._delete_run(previous[0])
+            run_id = self.conn.execute(
+                "INSERT INTO runs (game, config_key, config, metric, created_at) VALUES (?, ?, ?, ?, ?)",
+                (game_identifier, key, json.dumps(config, sort_keys=True, default=float), metric,
+                 int(time.time()))).lastrowid
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO slate_players VALUES (?, ?, ?)",
+                zip([game_identifier] * len(registry), registry.ids.tolist(), registry.names.tolist()))
+            self.conn.executemany(
+                "INSERT INTO lineups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, n, *row, int(salary), None if p != p else float(p))
+                 for n, row, salary, p in zip(lineup_nums.tolist(), ids.tolist(), lineups_df['Salary'], points)])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO lineup_players VALUES (?, ?, ?, ?)",
+                [(player_id, run_id, n, int(slot == 0))
+                 for n, row in zip(lineup_nums.tolist(), ids.tolist()) for slot, player_id in enumerate(row)])
+            self.conn.executemany(
+                "INSERT INTO exposures VALUES (?, ?, ?, ?, ?)",
+                [(run_id, int(player_id), cpt, flex, cpt + flex)
+                 for player_id, cpt, flex in zip(exposure.index, exposure['cpt'], exposure['flex'])])
+        logging.info(f"Stored run {run_id} for {game_identifier}: {len(lineups_df)} lineups")
+        return run_id
+
+    def _delete_run(self, run_id):
+        for table in RUN_TABLES:
+            self.conn.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+        self.conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+
+    def delete_run(self, run_id):
+        with self.conn:
+            self._delete_run(run_id)
+
+    def save_sims(self, run_id, results_df):
+        # Per-lineup sim metrics from contest.simulate_contest, rows in the run's lineup order
+        values = [results_df[col].to_numpy(dtype=float) for col in SIM_COLUMNS]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO lineup_sims VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(run_id, n, *row) for n, row in enumerate(zip(*(v.tolist() for v in values)))])
+
+    def find_run(self, game_identifier, config):
+        row = self.conn.execute("SELECT run_id FROM runs WHERE game = ? AND config_key = ?",
+                                (game_identifier, config_key(config))).fetchone()
+        return None if row is None else row[0]
+
+    def runs(self, game_identifier):
+        # A slate's runs, newest first
+        runs = pd.read_sql_query("SELECT run_id, config, metric, created_at FROM runs WHERE game = ? "
+                                 "ORDER BY run_id DESC", self.conn, params=[game_identifier])
+        runs['config'] = runs['config'].map(json.loads)
+        return runs
+
+    def latest_run(self, game_identifier):
+        # (run ID, config) of a slate's newest run, None if it has none
+        row = self.conn.execute("SELECT run_id, config FROM runs WHERE game = ? ORDER BY run_id DESC LIMIT 1",
+                                (game_identifier,)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def _lineups_query(self, where, params, order="l.run_id, l.lineup_num"):
+        # Lineups with player names per slot, the metric total and any sim metrics
+        names = " ".join(f"JOIN slate_players p{i} ON p{i}.game = r.game AND p{i}.player_id = l.{col}"
+                         for i, col in enumerate(SLOT_COLUMNS))
+        slots = ", ".join(f"p{i}.name AS \"{col}\"" for i, col in enumerate(fn.LINEUP_COLUMNS))
+        sims = ", ".join(f"s.{col} AS \"{label}\"" for label, col in SIM_COLUMNS.items())
+        query = (f"SELECT l.run_id, l.lineup_num, {slots}, l.salary AS Salary, l.points, r.metric, {sims} "
+                 f"FROM lineups l JOIN runs r ON r.run_id = l.run_id {names} "
+                 f"LEFT JOIN lineup_sims s ON s.run_id = l.run_id AND s.lineup_num = l.lineup_num "
+                 f"WHERE {where} ORDER BY {order}")
+        return pd.read_sql_query(query, self.conn, params=list(params))
+
+    def load_lineups(self, run_id):
+        # A run's lineup table as it was generated, the metric column under the run's metric,
+        # sim columns when the run has been simulated
+        lineups = self._lineups_query("l.run_id = ?", [run_id])
+        metric = lineups['metric'].iat[0] if len(lineups) else 'Proj'
+        lineups = lineups.rename(columns={'points': metric}).drop(columns=['run_id', 'lineup_num', 'metric'])
+        if lineups[list(SIM_COLUMNS)].isna().all().all():
+            lineups = lineups.drop(columns=list(SIM_COLUMNS))
+        return lineups
+
+    def lineups_with_captain(self, player_id, run_id=None):
+        # Lineups with player_id at captain, in one run or across every run
+        if run_id is None:
+            return self._lineups_query("l.cpt_id = ?", [player_id])
+        return self._lineups_query("l.cpt_id = ? AND l.run_id = ?", [player_id, run_id])
+
+    def lineups_with_player(self, player_id, run_id=None):
+        # Lineups using player_id in any slot
+        where = "(l.run_id, l.lineup_num) IN (SELECT run_id, lineup_num FROM lineup_players WHERE player_id = ?"
+        params = [player_id]
+        if run_id is not None:
+            where += " AND run_id = ?"
+            params.append(run_id)
+        return self._lineups_query(where + ")", params)
+
+    def top_lineups(self, run_id, by='Top 1%', limit=20):
+        # A run's best simulated lineups by one of the SIM_COLUMNS, ranked on the sim index
+        column = SIM_COLUMNS[by]
+        where = (f"(l.run_id, l.lineup_num) IN (SELECT run_id, lineup_num FROM lineup_sims "
+                 f"WHERE run_id = ? AND {column} IS NOT NULL ORDER BY {column} DESC LIMIT ?)")
+        return self._lineups_query(where, [run_id, limit], order=f"s.{column} DESC")
+
+    def exposures(self, run_id):
+        return pd.read_sql_query(
+            "SELECT p.name AS Name, e.player_id, e.cpt_exposure AS \"CPT Exposure\", "
+            "e.flex_exposure AS \"FLEX Exposure\", e.exposure AS Exposure FROM exposures e "
+            "JOIN runs r ON r.run_id = e.run_id JOIN slate_players p ON p.game = r.game AND p.player_id = e.player_id "
+            "WHERE e.run_id = ? ORDER BY e.exposure DESC", self.conn, params=[run_id])
+
+
+if __name__ == "__main__":
+    # Runs stored for a slate, and the newest run's top lineups by top-1% rate
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    game_identifier = sys.argv[1] if len(sys.argv) > 1 else None
+    store = ResultsStore()
+    if game_identifier is not None and store.latest_run(game_identifier) is not None:
+        print(store.runs(game_identifier).to_string(index=False))
+        run_id, _ = store.latest_run(game_identifier)
+        print(store.top_lineups(run_id).to_string(index=False))
+    store.close()
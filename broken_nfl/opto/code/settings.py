@@ -9,6 +9,8 @@ RAW_CSV_DIR = os.path.join(BASE_DIR,'csvs')
 # Set up the output directory for prepped files
 OUTPUT_DIR = os.path.join(BASE_DIR, 'prepped')
 
+# Content hashes of the raw files behind the prepped outputs, unchanged files are skipped
+PREP_MANIFEST = os.path.join(OUTPUT_DIR, 'prep_manifest.json')
 
 #Removes players that have no projection
 MY_PROJ_THRESHOLD = 0  
@@ -25,11 +27,85 @@ RENAME_RULES = {
     'dk_std': 'Std'
 }
 
+# Multi-site prep. Each site maps its raw columns onto the prepped names and carries its own
+# roster rules. A site's salaries and ownership come from its own salary_column and
+# ownership_column; an export without them isn't prepped for that site, since the DK values
+# don't carry over. Sites without an Adj_Proj column take the export's own adjustment as a
+# ratio of SS Proj (ADJ_PROJ_RATIO). Only 'implied' sites use sportsbook pulls, which are
+# converted with DK scoring.
+DEFAULT_SITE = 'dk'
+PREP_SITES = ['dk']
+ADJ_PROJ_RATIO = ('My Proj', 'SS Proj')
+
+
+def site_rename_rules(prefix):
+    return {
+        f'{prefix}_points': 'Proj',
+        f'{prefix}_own': 'Roster%',
+        f'{prefix}_25_percentile': '25th',
+        f'{prefix}_50_percentile': '50th',
+        f'{prefix}_75_percentile': '75th',
+        f'{prefix}_85_percentile': '85th',
+        f'{prefix}_std': 'Std'
+    }
+
+
+SITE_RULES = {
+    'dk': {'rename': RENAME_RULES, 'salary_column': 'Salary', 'ownership_column': 'My Own', 'salary_cap': 50000,
+           'flex_slots': 5, 'captain_multiplier': 1.5, 'captain_salary_multiplier': 1.5, 'implied': True},
+    'fd': {'rename': site_rename_rules('fd'), 'salary_column': 'fd_salary', 'ownership_column': 'fd_own',
+           'salary_cap': 60000, 'flex_slots': 4, 'captain_multiplier': 1.5, 'captain_salary_multiplier': 1.0,
+           'implied': False},
+    'yahoo': {'rename': site_rename_rules('yahoo'), 'salary_column': 'yahoo_salary', 'ownership_column': 'yahoo_own',
+              'salary_cap': 50000, 'flex_slots': 5, 'captain_multiplier': 1.5, 'captain_salary_multiplier': 1.5,
+              'implied': False},
+    'ob': {'rename': site_rename_rules('ob'), 'salary_column': 'ob_salary', 'ownership_column': 'ob_own',
+           'salary_cap': 50000, 'flex_slots': 5, 'captain_multiplier': 1.5, 'captain_salary_multiplier': 1.5,
+           'implied': False},
+}
+
 #Columns to keep for the initial csv processing
 COLUMNS_TO_KEEP = ['Name', 'Pos', 'Team', 'Opp', 'Salary', 'Proj', 'Adj_Proj','Roster%', '25th',
                    '50th', '75th', '85th', 'Std']
+# Raw files bigger than this (season exports) are read in chunks of RAW_CHUNK_ROWS rows
+RAW_CHUNKED_BYTES = 50 * 1024 * 1024
+RAW_CHUNK_ROWS = 100000
+
+# Sportsbook pull (a dksb selections .slate) whose player markets set Adj_Proj and the
+# percentiles during prep, None to keep the export's own. IMPLIED_WEIGHT blends the market
+# view with the export's Adj_Proj, 1.0 is markets only.
+ODDS_PULL = None
+IMPLIED_WEIGHT = 1.0
+
 #Columns to display on webapp 
 COLUMNS_TO_DISPLAY = ['Name', 'Pos', 'Team', 'Opp', 'Salary', 'Roster%', '25th',
                    '50th','Proj', '75th', '85th', '25th/$', '50th/$', 'Proj/$', '75th/$', '85th/$']
 
 
+#Showdown roster rules
+SALARY_CAP = 50000
+FLEX_SLOTS = 5
+CAPTAIN_MULTIPLIER = 1.5
+MAX_LINEUPS = 150
+
+# Memory cap for the slate cache shared by all app sessions in a process
+SLATE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Slates whose fitted outcome models and covariance factors stay cached
+SLATE_FIT_CACHE_SIZE = 8
+
+# Set up the output directory for generated lineups
+LINEUP_DIR = os.path.join(BASE_DIR, 'lineups')
+
+# Per-slate stage results of backtest runs, keyed by the config each stage depends on
+BACKTEST_CACHE_DIR = os.path.join(BASE_DIR, 'backtest_cache')
+
+# Lineup runs, sim metrics and exposures kept across app sessions
+RESULTS_DB = os.path.join(BASE_DIR, 'results.sqlite')
+
+# Live prep daemon: how often the raw directory is polled, and how long a file has to stay
+# unchanged before it's prepped
+PREP_POLL_SECONDS = 2
+PREP_DEBOUNCE_SECONDS = 3
+
+# How often an app session following live updates checks for a new slate version
+LIVE_REFRESH_SECONDS = 15
@@ -0,0 +1,109 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+import settings
+import slate_cache
+
+# Quantile knots of the fitted outcome distribution. 25th-85th come straight from the prepped
+# tables; the lower knot and the upper tail are extrapolated from the spread on that side of the
+# median as if it were normal, then clamped at zero.
+KNOT_PROBS = np.array([0.001, 0.25, 0.50, 0.75, 0.85, 0.95, 0.99, 0.999])
+QUANTILE_COLUMNS = {0.25: '25th', 0.50: '50th', 0.75: '75th', 0.85: '85th'}
+
+# Sims drawn per chunk, bounds memory at chunk_size x players floats
+SIM_CHUNK_SIZE = 10000
+
+# Fitted models keyed on the flex table's path and slate version, least recently used first
+_model_cache = OrderedDict()
+
+
+class OutcomeModel:
+    # Piecewise-linear inverse CDF per player over KNOT_PROBS. knots is a (players, knots) array
+    # of flex scores; captain outcomes are always CAPTAIN_MULTIPLIER x the flex draw.
+
+    def __init__(self, names, knots):
+        self.names = np.asarray(names)
+        self.knots = np.ascontiguousarray(knots, dtype=np.float64)
+        self.slopes = np.diff(self.knots, axis=1) / np.diff(KNOT_PROBS)
+
+    @property
+    def num_players(self):
+        return len(self.names)
+
+    def scores_from_uniforms(self, uniforms):
+        # Maps a (sims, players) matrix of uniforms to flex scores. All players share the same
+        # knot probabilities, so one searchsorted gives every segment index.
+        segment = np.clip(np.searchsorted(KNOT_PROBS, uniforms) - 1, 0, len(KNOT_PROBS) - 2)
+        players = np.arange(self.num_players)
+        u = np.clip(uniforms, KNOT_PROBS[0], KNOT_PROBS[-1])
+        scores = self.knots[players, segment] + (u - KNOT_PROBS[segment]) * self.slopes[players, segment]
+        return scores.astype(np.float32)
+
+    def draw(self, num_sims, seed=None, chunk_size=SIM_CHUNK_SIZE, factor=None):
+        # Yields flex score matrices of at most chunk_size x players, num_sims rows in total.
+        # With a correlation.CorrelationFactor the players' outcomes move together.
+        if factor is not None and not np.array_equal(factor.names, self.names):
+            raise ValueError("Correlation factor and outcome model cover different players")
+        rng = np.random.default_rng(seed)
+        for start in range(0, num_sims, chunk_size):
+            rows = min(chunk_size, num_sims - start)
+            if factor is not None:
+                uniforms = factor.uniforms(rng, rows)
+            else:
+                uniforms = rng.random((rows, self.num_players))
+            yield self.scores_from_uniforms(uniforms)
+
+
+def captain_scores(flex_scores):
+    # Captain outcomes are derived from the flex draw, never sampled on their own
+    return flex_scores * np.float32(settings.CAPTAIN_MULTIPLIER)
+
+
+def fit_outcome_model(flex_df):
+    # Fits the per-player knots from the flex table's percentile columns
+    logging.info("Fitting player outcome distributions...")
+    quantiles = flex_df[list(QUANTILE_COLUMNS.values())].to_numpy(dtype=np.float64)
+    q25, q50, q85 = quantiles[:, 0], quantiles[:, 1], quantiles[:, 3]
+    z = norm.ppf(KNOT_PROBS)
+
+    knots = np.empty((len(flex_df), len(KNOT_PROBS)))
+    for k, p in enumerate(KNOT_PROBS):
+        if p in QUANTILE_COLUMNS:
+            knots[:, k] = flex_df[QUANTILE_COLUMNS[p]].to_numpy(dtype=np.float64)
+        elif p < 0.5:
+            knots[:, k] = q50 + (q50 - q25) * z[k] / norm.ppf(0.75)
+        else:
+            knots[:, k] = q50 + (q85 - q50) * z[k] / norm.ppf(0.85)
+
+    # Scores can't go below zero and the inverse CDF has to be non-decreasing
+    knots = np.maximum.accumulate(np.fmax(knots, 0), axis=1)
+    return OutcomeModel(flex_df['Name'].to_numpy(), knots)
+
+
+def load_outcome_model(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # Cached fit for a prepped slate, CSV or binary, refitted only when a new version is published
+    return slate_cache.cached_fit(_model_cache, game_identifier, fit_outcome_model, prepped_dir)
+
+
+def summarize_outcomes(model, num_sims, seed=None, thresholds=(10, 20, 30), chunk_size=SIM_CHUNK_SIZE,
+                       factor=None):
+    # Streams num_sims draws and returns per-player mean, std and P(flex score >= threshold)
+    # without ever holding more than one chunk
+    total = np.zeros(model.num_players)
+    total_sq = np.zeros(model.num_players)
+    exceed = np.zeros((len(thresholds), model.num_players))
+    for chunk in model.draw(num_sims, seed, chunk_size, factor):
+        chunk = chunk.astype(np.float64)
+        total += chunk.sum(axis=0)
+        total_sq += (chunk ** 2).sum(axis=0)
+        for t, threshold in enumerate(thresholds):
+            exceed[t] += (chunk >= threshold).sum(axis=0)
+
+    mean = total / num_sims
+    summary = {'Name': model.names, 'Sim Mean': mean,
+               'Sim Std': np.sqrt(np.maximum(total_sq / num_sims - mean ** 2, 0))}
+    for t, threshold in enumerate(thresholds):
+        summary[f'P({threshold}+)'] = exceed[t] / num_sims
+    return pd.DataFrame(summary)
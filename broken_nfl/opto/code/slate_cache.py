@@ -0,0 +1,118 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import settings
+import functions as fn
+import slate_file
+
+# Prepped tables shared by every session in the process, keyed on (file path, table) and
+# stamped with the file's mtime and size. Least recently used tables are evicted once the
+# cache holds more than SLATE_CACHE_MAX_BYTES.
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _evict(max_bytes):
+    # Drops the oldest tables until under the cap, the most recent one always stays
+    total = sum(entry[2] for entry in _cache.values())
+    while total > max_bytes and len(_cache) > 1:
+        key, (_, _, nbytes) = _cache.popitem(last=False)
+        total -= nbytes
+        logging.info(f"Evicted {key[1]} table {os.path.basename(key[0])} from the slate cache")
+
+
+def get_table(game_identifier, table, prepped_dir=settings.OUTPUT_DIR, max_bytes=settings.SLATE_CACHE_MAX_BYTES):
+    # Shared 'captain' or 'flex' table, loaded once per file version. Callers get a shallow copy,
+    # so adding columns stays private to them; values must not be modified in place, overrides
+    # are kept as fn.projection_deltas and laid over the table.
+    path = fn.prepped_table_path(game_identifier, table, prepped_dir)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    key = (os.path.abspath(path), table)
+
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] != version:
+            logging.info(f"Loading {table} table for {game_identifier} into the slate cache")
+            df = fn.read_prepped_table(path, table)
+            entry = (version, df, _frame_nbytes(df))
+            _cache[key] = entry
+        _cache.move_to_end(key)
+        _evict(max_bytes)
+    return entry[1].copy(deep=False)
+
+
+def slate_version(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # Path, mtime and size of the files a game's captain and flex tables are read from. It changes
+    # whenever a new version of the slate is published.
+    version = []
+    for table in ['captain', 'flex']:
+        path = fn.prepped_table_path(game_identifier, table, prepped_dir)
+        stat = os.stat(path) if path is not None else None
+        version.append(None if stat is None else (path, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+def slate_fingerprint(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # Prep fingerprint from the slate's metadata, which changes with the raw export it was prepped
+    # from. Slates without one (CSV-only or prepped without a fingerprint) get a hash of their
+    # captain and flex files instead.
+    paths = [fn.prepped_table_path(game_identifier, table, prepped_dir) for table in ['captain', 'flex']]
+    if paths[1] is not None and paths[1].endswith(slate_file.SLATE_EXTENSION):
+        fingerprint = slate_file.read_header(paths[1])['metadata'].get('fingerprint')
+        if fingerprint is not None:
+            return fingerprint
+    digest = hashlib.sha256()
+    for path in paths:
+        if path is not None:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_fit(cache, game_identifier, build, prepped_dir=settings.OUTPUT_DIR,
+                max_entries=settings.SLATE_FIT_CACHE_SIZE):
+    # build(flex_df) for a game's current flex table, kept in 'cache' (an OrderedDict) under the
+    # table's path and slate version. The least recently used fits go past max_entries.
+    path = fn.prepped_table_path(game_identifier, 'flex', prepped_dir)
+    if path is None:
+        raise FileNotFoundError(f"No prepped flex table for {game_identifier} in {prepped_dir}")
+    key = (os.path.abspath(path), slate_version(game_identifier, prepped_dir))
+    with _lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    fit = build(get_table(game_identifier, 'flex', prepped_dir))
+    with _lock:
+        cache[key] = fit
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+    return fit
+
+
+def get_slate(game_identifier, prepped_dir=settings.OUTPUT_DIR):
+    # (captain_df, flex_df) from the shared cache
+    captain_df = get_table(game_identifier, 'captain', prepped_dir)
+    flex_df = get_table(game_identifier, 'flex', prepped_dir)
+    if captain_df is None or flex_df is None:
+        raise FileNotFoundError(f"No prepped captain and flex tables for {game_identifier} in {prepped_dir}")
+    return captain_df, flex_df
+
+
+def cache_info():
+    with _lock:
+        return {'tables': len(_cache), 'bytes': sum(entry[2] for entry in _cache.values())}
+
+
+def clear():
+    with _lock:
+        _cache.clear()
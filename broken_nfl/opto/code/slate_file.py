@@ -0,0 +1,122 @@
+import os
+import json
+import struct
+import logging
+import numpy as np
+import pandas as pd
+import settings
+
+# Binary prepped slate: magic, header length, JSON header (schema and slate metadata), then each
+# column's values as a raw little-endian array aligned to ALIGNMENT bytes. Text columns are
+# stored as integer codes with their categories in the header, so every column maps straight
+# onto the file without parsing.
+SLATE_MAGIC = b'SDSLATE1'
+SLATE_EXTENSION = '.slate'
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sQ')
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _encode_column(series):
+    # Column -> (schema entry, array of values to write)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = [str(c) for c in series.cat.categories]
+        codes = series.cat.codes.to_numpy()
+        return {'kind': 'category', 'categories': categories}, codes
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        return {'kind': 'numeric'}, series.to_numpy()
+    codes, categories = pd.factorize(series.astype(object), use_na_sentinel=True)
+    return {'kind': 'string', 'categories': [str(c) for c in categories]}, codes.astype(np.int32)
+
+
+def write_slate(path, tables, metadata=None):
+    # Writes {table name: DataFrame} to path atomically. The index is not stored.
+    schema = {}
+    blocks = []
+    offset = 0
+    for table_name, df in tables.items():
+        columns = []
+        for col in df.columns:
+            entry, values = _encode_column(df[col])
+            values = np.ascontiguousarray(values)
+            values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+            entry.update({'name': col, 'dtype': values.dtype.str, 'offset': offset})
+            columns.append(entry)
+            blocks.append((offset, values))
+            offset = _align(offset + values.nbytes)
+        schema[table_name] = {'rows': len(df), 'columns': columns}
+
+    header = json.dumps({'version': 1, 'metadata': metadata or {}, 'tables': schema}).encode()
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREAMBLE.pack(SLATE_MAGIC, len(header)))
+            f.write(header)
+            for block_offset, values in blocks:
+                f.seek(data_start + block_offset)
+                f.write(values.tobytes())
+            f.truncate(data_start + offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        magic, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != SLATE_MAGIC:
+            raise ValueError(f"{path} is not a prepped slate file")
+        header = json.loads(f.read(header_length))
+    return header, _align(_PREAMBLE.size + header_length)
+
+
+def read_header(path):
+    # Schema and metadata without touching the column data
+    return _read_header(path)[0]
+
+
+def open_slate(path, tables=None):
+    # Maps the file and returns {table name: DataFrame}. Numeric and categorical columns are
+    # read-only views of the mapping, so repeated opens and other processes share the same pages.
+    header, data_start = _read_header(path)
+    mapping = np.memmap(path, dtype=np.uint8, mode='r')
+
+    frames = {}
+    for table_name, table in header['tables'].items():
+        if tables is not None and table_name not in tables:
+            continue
+        rows = table['rows']
+        columns = {}
+        for entry in table['columns']:
+            values = np.frombuffer(mapping, dtype=np.dtype(entry['dtype']), count=rows,
+                                   offset=data_start + entry['offset'])
+            if entry['kind'] == 'category':
+                columns[entry['name']] = pd.Categorical.from_codes(values, entry['categories'])
+            elif entry['kind'] == 'string':
+                categories = np.array(entry['categories'] + [np.nan], dtype=object)
+                columns[entry['name']] = categories[values]
+            else:
+                columns[entry['name']] = values
+        frames[table_name] = pd.DataFrame(columns, copy=False)
+    return frames
+
+
+def slate_path(game_identifier, prepped_dir):
+    return os.path.join(prepped_dir, f'SD_{game_identifier}{SLATE_EXTENSION}')
+
+
+if __name__ == "__main__":
+    # Configure logging to print to terminal
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    for f in sorted(os.listdir(settings.OUTPUT_DIR)):
+        if f.endswith(SLATE_EXTENSION):
+            header = read_header(os.path.join(settings.OUTPUT_DIR, f))
+            tables = {name: table['rows'] for name, table in header['tables'].items()}
+            print(f, header['metadata'], tables)
@@ -1,49 +1,64 @@
 import streamlit as st
 import pandas as pd
 import os
+import sys
 import logging
 
 st.set_page_config(page_title="Dusty Fan Sports", layout="wide")
 st.title ("DFS Lineup Optimizer")
 
 csv_dir = "opto/prepped"
-csv_files = [f for f in os.listdir(csv_dir) if f.endswith('_captain.csv') or f.endswith('_flex.csv')]
-game_identifiers = set()
-for f in csv_files:
-    if f.startswith('SD_'):
-        game_id = f.replace('SD_', '').replace('_captain.csv', '').replace('_flex.csv', '')
-        game_identifiers.add(game_id)
-sorted_game_ids = sorted(game_identifiers)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opto', 'code'))
+import functions as fn
+import slate_cache
+import app_tables
+import players
+import slate_file
+import settings
+sorted_game_ids = fn.list_prepped_games(csv_dir)
 with st.sidebar:
     selected_game = st.selectbox('Select game', sorted_game_ids)
-captain_file = os.path.join(csv_dir, f"SD_{selected_game}_captain.csv")
-flex_file = os.path.join(csv_dir, f"SD_{selected_game}_flex.csv")
+    follow_live = st.toggle('Follow live updates', value=False)
+    app_tables.show_notice()
 
-# Load the dataframes into session state if not already loaded or if the selected game has changed
-if 'selected_game' not in st.session_state or st.session_state['selected_game'] != selected_game:
+# Function to load a game's base tables and player registry into session state. The base frames
+# are shallow copies of the process-wide slate cache, the session only owns its overrides and
+# the rows they rewrite.
+def load_base_tables(game):
     # Try to load captain data
-    if os.path.exists(captain_file):
-        captain_df = pd.read_csv(captain_file)
+    captain_df = slate_cache.get_table(game, 'captain', csv_dir)
+    if captain_df is not None:
         # Initialize 'Original_Proj' if not already in columns
         if 'Old_Proj' not in captain_df.columns:
             captain_df['Old_Proj'] = captain_df['Proj']
     else:
-        captain_df = None
-        st.warning(f"Captain file not found for game {selected_game}.")
+        st.warning(f"Captain file not found for game {game}.")
 
     # Try to load flex data
-    if os.path.exists(flex_file):
-        flex_df = pd.read_csv(flex_file)
+    flex_df = slate_cache.get_table(game, 'flex', csv_dir)
+    if flex_df is not None:
         # Initialize 'Original_Proj' if not already in columns
         if 'Old_Proj' not in flex_df.columns:
             flex_df['Old_Proj'] = flex_df['Proj']
     else:
-        flex_df = None
-        st.warning(f"Flex file not found for game {selected_game}.")
+        st.warning(f"Flex file not found for game {game}.")
+
+    st.session_state['captain_base'] = captain_df
+    st.session_state['flex_base'] = flex_df
+    # Player registry and each table's row for every player, so lookups index rather than scan
+    registry = players.load_registry(game, csv_dir, flex_df) if flex_df is not None else None
+    st.session_state['players'] = registry
+    st.session_state['flex_rows'] = registry.row_positions(flex_df) if registry is not None else None
+    st.session_state['captain_rows'] = (registry.row_positions(captain_df)
+                                        if registry is not None and captain_df is not None else None)
+    st.session_state['slate_version'] = slate_cache.slate_version(game, csv_dir)
 
-    # Store dataframes in session state
-    st.session_state['captain_df'] = captain_df
-    st.session_state['flex_df'] = flex_df
+# Load the dataframes into session state if not already loaded or if the selected game has changed
+if 'selected_game' not in st.session_state or st.session_state['selected_game'] != selected_game:
+    load_base_tables(selected_game)
+    st.session_state['overrides'] = {}
+    st.session_state['captain_deltas'] = st.session_state['flex_deltas'] = None
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
     st.session_state['selected_game'] = selected_game
 
 
@@ -62,128 +77,91 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# Function to recalculate dependent metrics
-def recalculate_metrics(df):
-    df = df.copy()
-    # Recalculate PPD columns
-    df['25th/$'] = (df['25th'] / df['Salary']) * 1000
-    df['50th/$'] = (df['50th'] / df['Salary']) * 1000
-    df['Proj/$'] = (df['Proj'] / df['Salary']) * 1000
-    df['75th/$'] = (df['75th'] / df['Salary']) * 1000
-    df['85th/$'] = (df['85th'] / df['Salary']) * 1000
-    return df
-
-# Function to adjust percentiles
-def adjust_percentiles(df, adjustment_factor=1.0):
-    logging.info("Adjusting percentile outcome values...")
-    df = df.copy()
-    try:
-        # Filter rows where 'Proj' is different from 'Original_Proj'
-        adjustment_needed = df[df['Proj'] != df['Original_Proj']]
-
-        # Iterate over rows where adjustment is needed
-        for idx, row in adjustment_needed.iterrows():
-            # Calculate the shift factor based on 'Proj' and 'Original_Proj'
-            shift_factor = (row['Proj'] / row['Original_Proj']) * adjustment_factor
-
-            # Adjust the percentiles
-            df.at[idx, '25th'] = max(0, row['25th'] * shift_factor)
-            df.at[idx, '50th'] = max(0, row['50th'] * shift_factor)
-            df.at[idx, '75th'] = row['75th'] * shift_factor
-            df.at[idx, '85th'] = row['85th'] * shift_factor
-
-        logging.info("Percentiles adjusted successfully")
-        return df
-
-    except Exception as e:
-        logging.error(f"function call: adjust_percentiles failed due to error - {str(e)}")
-        raise
+# Function to rebuild the session's override deltas against the current base frames. A session
+# keeps only its overrides and the rows they rewrite; the tables are the shared base frames with
+# those rows laid over them when they're used.
+def apply_session_overrides():
+    overrides = st.session_state.get('overrides', {})
+    registry = st.session_state.get('players')
+    dense = registry.index_of_names(list(overrides)) if registry is not None else None
+    for role, multiplier in (('flex', 1.0), ('captain', 1.5)):
+        # Captain projection is 1.5x the flex projection
+        base = st.session_state.get(f'{role}_base')
+        st.session_state[f'{role}_deltas'] = (
+            fn.projection_deltas(base, overrides, proj_multiplier=multiplier,
+                                 rows=registry.rows(st.session_state[f'{role}_rows'], dense))
+            if base is not None and overrides else None)
+
+# Function to update a batch of projections, only the changed players' rows are recomputed
+def update_projections(overrides):
+    st.session_state.setdefault('overrides', {}).update(overrides)
+    registry = st.session_state['players']
+    dense = registry.index_of_names(list(overrides))
+    for role, multiplier in (('flex', 1.0), ('captain', 1.5)):
+        base = st.session_state.get(f'{role}_base')
+        if base is not None:
+            update = fn.projection_deltas(base, overrides, proj_multiplier=multiplier,
+                                          rows=registry.rows(st.session_state[f'{role}_rows'], dense))
+            st.session_state[f'{role}_deltas'] = fn.merge_projection_deltas(
+                st.session_state.get(f'{role}_deltas'), update)
+    # Anything built from the previous projections is now stale
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
 
 # Function to update projection
 def update_projection(player_name, new_proj):
-    if 'flex_df' in st.session_state and st.session_state['flex_df'] is not None:
-        # Update projection in flex_df
-        player_mask = st.session_state['flex_df']['Name'] == player_name
-        # Store Original_Proj if not already stored
-        if 'Original_Proj' not in st.session_state['flex_df'].columns:
-            st.session_state['flex_df']['Original_Proj'] = st.session_state['flex_df']['Proj']
-        st.session_state['flex_df'].loc[player_mask, 'Proj'] = new_proj
-        # Recalculate percentiles
-        st.session_state['flex_df'] = adjust_percentiles(st.session_state['flex_df'])
-        # Recalculate dependent columns in flex_df
-        st.session_state['flex_df'] = recalculate_metrics(st.session_state['flex_df'])
-    if 'captain_df' in st.session_state and st.session_state['captain_df'] is not None:
-        # Update projection in captain_df
-        player_mask = st.session_state['captain_df']['Name'] == player_name
-        # Store Original_Proj if not already stored
-        if 'Original_Proj' not in st.session_state['captain_df'].columns:
-            st.session_state['captain_df']['Original_Proj'] = st.session_state['captain_df']['Proj']
-        # Update 'Proj' in captain_df (1.5x flex projection)
-        new_captain_proj = new_proj * 1.5
-        st.session_state['captain_df'].loc[player_mask, 'Proj'] = new_captain_proj
-        # Recalculate percentiles
-        st.session_state['captain_df'] = adjust_percentiles(st.session_state['captain_df'])
-        # Recalculate dependent columns in captain_df
-        st.session_state['captain_df'] = recalculate_metrics(st.session_state['captain_df'])
-
-# Sidebar for updating player projections
-if 'flex_df' in st.session_state and st.session_state['flex_df'] is not None:
+    update_projections({player_name: new_proj})
+
+# A new version of the slate published while the session is open (the prep daemon re-preps
+# exports as they land) replaces the base tables, and the session's overrides go back on top
+if slate_cache.slate_version(selected_game, csv_dir) != st.session_state.get('slate_version'):
+    load_base_tables(selected_game)
+    apply_session_overrides()
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
+    slate_path = fn.prepped_table_path(selected_game, 'flex', csv_dir)
+    changed = (slate_file.read_header(slate_path)['metadata'].get('changed')
+               if slate_path is not None and slate_path.endswith(slate_file.SLATE_EXTENSION) else None)
+    st.info("Slate updated" + (f": {', '.join(changed)}" if changed else "")
+            + (", your overrides were reapplied" if st.session_state.get('overrides') else ""))
+
+# Sidebar for updating player projections. Its inputs rerun only this fragment; an update reruns
+# the app so the tables pick it up
+@st.fragment
+def projection_controls():
+    st.write("## Update Player Projection")
+    registry = st.session_state['players']
+    player_names = st.session_state['flex_base']['Name'].unique()
+    selected_player = st.selectbox('Select player', player_names)
+    flex_row = registry.rows(st.session_state['flex_rows'], registry.index_of_names([selected_player]))[0]
+    current_proj = st.session_state['overrides'].get(selected_player,
+                                                     st.session_state['flex_base']['Proj'].iat[flex_row])
+    new_proj = st.number_input('New Projection', value=float(current_proj))
+    if st.button('Update Projection'):
+        update_projection(selected_player, new_proj)
+        app_tables.rerun_with_notice(f'Projection updated for {selected_player}')
+
+    st.write("## Upload Projection Overrides")
+    overrides_file = st.file_uploader('Overrides CSV (Name, Proj)', type='csv')
+    if overrides_file is not None and st.button('Apply Overrides'):
+        try:
+            overrides = fn.read_overrides_csv(overrides_file)
+            # Keyed by name or DFS ID, either resolves through the registry to a slate name
+            dense = registry.index_of_keys(overrides.index)
+            unknown = (dense < 0) | (registry.rows(st.session_state['flex_rows'], dense) < 0)
+            update_projections(dict(zip(registry.names[dense[~unknown]], overrides.to_numpy()[~unknown])))
+            app_tables.rerun_with_notice(f'Projections updated for {int((~unknown).sum())} players'
+                                         + (f", skipped {int(unknown.sum())} not on this slate" if unknown.any() else ""))
+        except ValueError as e:
+            st.error(str(e))
+
+if st.session_state.get('flex_base') is not None:
     with st.sidebar:
-        st.write("## Update Player Projection")
-        player_names = st.session_state['flex_df']['Name'].unique()
-        selected_player = st.selectbox('Select player', player_names)
-        current_proj = st.session_state['flex_df'].loc[st.session_state['flex_df']['Name'] == selected_player, 'Proj'].values[0]
-        new_proj = st.number_input('New Projection', value=float(current_proj))
-        if st.button('Update Projection'):
-            update_projection(selected_player, new_proj)
-            st.success(f'Projection updated for {selected_player}')
-
-# Retrieve dataframes from session state after updates
-captain_df = st.session_state.get('captain_df', None)
-flex_df = st.session_state.get('flex_df', None)
-
-def style_dataframe(df):
-    # Format numeric columns to display two decimal places
-    numeric_cols = df.select_dtypes(include=['float', 'float64']).columns
-    styled_df = df.style.format({col: "{:.2f}" for col in numeric_cols})
-
-    # Center all data
-    styled_df = styled_df.set_properties(**{
-        'text-align': 'center',
-        'background-color': '#f7f7f7',
-        'color': '#4d4d4d'
-    })
-
-    # Center the column headers and adjust background and font colors
-    styled_df = styled_df.set_table_styles([
-        {'selector': 'th', 'props': [
-            ('text-align', 'center'),
-            ('background-color', '#e0e0e0'),
-            ('color', '#4d4d4d')
-        ]}
-    ])
-
-    # Style the 'Proj' column
-    if 'Proj' in df.columns:
-        # Create a CSS style for the 'Proj' column
-        proj_style = [
-            {'selector': f'th.col{df.columns.get_loc("Proj")}', 'props': [
-                ('font-weight', 'bold'),
-                ('font-size', '16px'),
-                ('background-color', '#d9d9d9'),
-                ('color', '#4d4d4d')
-            ]},
-            {'selector': f'td.col{df.columns.get_loc("Proj")}', 'props': [
-                ('font-weight', 'bold'),
-                ('font-size', '16px'),
-                ('background-color', '#d9d9d9'),
-                ('color', '#4d4d4d')
-            ]}
-        ]
-        styled_df = styled_df.set_table_styles(proj_style, overwrite=False)
-
-    return styled_df
+        projection_controls()
 
+# Tables for this rerun: the shared base frames with the session's override rows laid over them
+captain_df = (fn.overlay_projection_deltas(st.session_state['captain_base'], st.session_state.get('captain_deltas'))
+              if st.session_state.get('captain_base') is not None else None)
+flex_df = (fn.overlay_projection_deltas(st.session_state['flex_base'], st.session_state.get('flex_deltas'))
+           if st.session_state.get('flex_base') is not None else None)
 
 # Tabs for Captain and Flex
 if captain_df is not None or flex_df is not None:
@@ -192,8 +170,7 @@ if captain_df is not None or flex_df is not None:
     if captain_df is not None:
         with tab_capt:
             st.write("Captain Table")
-            styled_captain_df = style_dataframe(captain_df)
-            st.write(styled_captain_df)
+            app_tables.show_table(captain_df)
     else:
         with tab_capt:
             st.warning("Captain data not available.")
@@ -201,14 +178,23 @@ if captain_df is not None or flex_df is not None:
     if flex_df is not None:
         with tab_flex:
             st.write("Flex Table")
-            styled_flex_df = style_dataframe(flex_df)
-            st.write(styled_flex_df)
+            app_tables.show_table(flex_df)
     else:
         with tab_flex:
             st.warning("Flex data not available.")
 else:
     st.error("No data available for the selected game.")
 
+# Sessions following live updates poll the slate's version on a timer. Only this fragment
+# reruns on the timer, the whole app reruns once a new version has been published.
+@st.fragment(run_every=settings.LIVE_REFRESH_SECONDS)
+def watch_slate_version():
+    if slate_cache.slate_version(selected_game, csv_dir) != st.session_state.get('slate_version'):
+        st.rerun()
+
+if follow_live:
+    watch_slate_version()
+
 
 
 
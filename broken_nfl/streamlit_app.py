@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
 import os
+import io
+import sys
 import logging
 
 # Get the current directory where the Streamlit app is located
@@ -8,61 +10,94 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 
 # Set up the relative path to the 'opto/prepped/' directory
 csv_dir = os.path.join(current_dir, 'opto', 'prepped')
+
+# Make the shared functions in 'opto/code/' importable
+sys.path.append(os.path.join(current_dir, 'opto', 'code'))
+import functions as fn
+import slate_cache
+import app_tables
+import players
+import optimizer
+import enumeration
+import diversity
+import contest
+import lineups as lu
+import results_store
+import slate_file
+import settings
+
 st.set_page_config(page_title="Showdown Projections", layout="wide")
 st.title("Showdown Optimizer")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# List CSV files ending with '_captain.csv' or '_flex.csv'
-csv_files = [f for f in os.listdir(csv_dir) if f.endswith('_captain.csv') or f.endswith('_flex.csv')]
-
-# Extract game identifiers by removing prefixes and suffixes
-game_identifiers = set()
-for f in csv_files:
-    if f.startswith('SD_'):
-        game_id = f.replace('SD_', '').replace('_captain.csv', '').replace('_flex.csv', '')
-        game_identifiers.add(game_id)
-
-# Sort game identifiers for consistent display
-sorted_game_ids = sorted(game_identifiers)
+# Games with prepped tables, from the CSVs or the binary slates
+sorted_game_ids = fn.list_prepped_games(csv_dir)
 
 # Sidebar for selecting the game and updating projections
 with st.sidebar:
     selected_game = st.selectbox('Select game', sorted_game_ids)
+    follow_live = st.toggle('Follow live updates', value=False)
+    app_tables.show_notice()
 
 # Displaying the selected game in the title, cleaned up
 st.write(f"Displaying data for game: **{selected_game.replace('-@-', ' @ ')}**")
 
-# Paths to the captain and flex CSV files
-captain_file = os.path.join(csv_dir, f"SD_{selected_game}_captain.csv")
-flex_file = os.path.join(csv_dir, f"SD_{selected_game}_flex.csv")
-
-# Load the dataframes into session state if not already loaded or if the selected game has changed
-if 'selected_game' not in st.session_state or st.session_state['selected_game'] != selected_game:
+# Function to load a game's base tables and player registry into session state. The base frames
+# are shallow copies of the process-wide slate cache, the session only owns its overrides and
+# the frames derived from them.
+def load_base_tables(game):
     # Try to load captain data
-    if os.path.exists(captain_file):
-        captain_df = pd.read_csv(captain_file)
+    captain_df = slate_cache.get_table(game, 'captain', csv_dir)
+    if captain_df is not None:
         # Initialize 'Original_Proj' if not already in columns
         if 'Original_Proj' not in captain_df.columns:
             captain_df['Original_Proj'] = captain_df['Proj']
     else:
-        captain_df = None
-        st.warning(f"Captain file not found for game {selected_game}.")
+        st.warning(f"Captain file not found for game {game}.")
 
     # Try to load flex data
-    if os.path.exists(flex_file):
-        flex_df = pd.read_csv(flex_file)
+    flex_df = slate_cache.get_table(game, 'flex', csv_dir)
+    if flex_df is not None:
         # Initialize 'Original_Proj' if not already in columns
         if 'Original_Proj' not in flex_df.columns:
             flex_df['Original_Proj'] = flex_df['Proj']
     else:
-        flex_df = None
-        st.warning(f"Flex file not found for game {selected_game}.")
+        st.warning(f"Flex file not found for game {game}.")
+
+    st.session_state['captain_base'] = captain_df
+    st.session_state['flex_base'] = flex_df
+    # Player registry and each table's row for every player, so lookups index rather than scan
+    registry = players.load_registry(game, csv_dir, flex_df) if flex_df is not None else None
+    st.session_state['players'] = registry
+    st.session_state['flex_rows'] = registry.row_positions(flex_df) if registry is not None else None
+    st.session_state['captain_rows'] = (registry.row_positions(captain_df)
+                                        if registry is not None and captain_df is not None else None)
+    st.session_state['slate_version'] = slate_cache.slate_version(game, csv_dir)
+    st.session_state['slate_fingerprint'] = slate_cache.slate_fingerprint(game, csv_dir)
 
-    # Store dataframes in session state
-    st.session_state['captain_df'] = captain_df
-    st.session_state['flex_df'] = flex_df
+# Load the dataframes into session state if not already loaded or if the selected game has changed
+if 'selected_game' not in st.session_state or st.session_state['selected_game'] != selected_game:
+    load_base_tables(selected_game)
+    st.session_state['overrides'] = {}
+    st.session_state['captain_deltas'] = st.session_state['flex_deltas'] = None
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
+    st.session_state['lineups_df'] = None
+    st.session_state['run_id'] = None
+    # The slate's last stored run comes back as it was, flagged stale if it was built on overrides
+    # or on another version of the slate
+    if 'results' not in st.session_state:
+        st.session_state['results'] = results_store.ResultsStore()
+    latest_run = st.session_state['results'].latest_run(selected_game)
+    if latest_run is not None:
+        run_id, run_config = latest_run
+        st.session_state['lineups_df'] = st.session_state['results'].load_lineups(run_id)
+        st.session_state['run_id'] = run_id
+        fresh = (not run_config.get('overrides')
+                 and run_config.get('slate') == st.session_state['slate_fingerprint'])
+        st.session_state['lineups_version'] = st.session_state['projection_version'] if fresh else None
+        st.session_state['lineups_built'] = st.session_state.get('lineups_built', 0) + 1
     st.session_state['selected_game'] = selected_game
 
 # Universal styling for both tables
@@ -80,138 +115,185 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# Function to recalculate dependent metrics
-def recalculate_metrics(df):
-    df = df.copy()
-    # Recalculate PPD columns
-    df['25th/$'] = (df['25th'] / df['Salary']) * 1000
-    df['50th/$'] = (df['50th'] / df['Salary']) * 1000
-    df['Proj/$'] = (df['Proj'] / df['Salary']) * 1000
-    df['75th/$'] = (df['75th'] / df['Salary']) * 1000
-    df['85th/$'] = (df['85th'] / df['Salary']) * 1000
-    return df
-
-# Function to adjust percentiles
-def adjust_percentiles(df, adjustment_factor=1.0):
-    logging.info("Adjusting percentile outcome values...")
-    df = df.copy()
-    try:
-        # Filter rows where 'Proj' is different from 'Original_Proj'
-        adjustment_needed = df[df['Proj'] != df['Original_Proj']]
-
-        # Iterate over rows where adjustment is needed
-        for idx, row in adjustment_needed.iterrows():
-            # Calculate the shift factor based on 'Proj' and 'Original_Proj'
-            shift_factor = (row['Proj'] / row['Original_Proj']) * adjustment_factor
-
-            # Adjust the percentiles
-            df.at[idx, '25th'] = max(0, row['25th'] * shift_factor)
-            df.at[idx, '50th'] = max(0, row['50th'] * shift_factor)
-            df.at[idx, '75th'] = row['75th'] * shift_factor
-            df.at[idx, '85th'] = row['85th'] * shift_factor
-
-        logging.info("Percentiles adjusted successfully")
-        return df
-
-    except Exception as e:
-        logging.error(f"function call: adjust_percentiles failed due to error - {str(e)}")
-        raise
+# Function to rebuild the session's override deltas against the current base frames. A session
+# keeps only its overrides and the rows they rewrite; the tables are the shared base frames with
+# those rows laid over them when they're used.
+def apply_session_overrides():
+    overrides = st.session_state.get('overrides', {})
+    registry = st.session_state.get('players')
+    dense = registry.index_of_names(list(overrides)) if registry is not None else None
+    for role, multiplier in (('flex', 1.0), ('captain', 1.5)):
+        # Captain projection is 1.5x the flex projection
+        base = st.session_state.get(f'{role}_base')
+        st.session_state[f'{role}_deltas'] = (
+            fn.projection_deltas(base, overrides, proj_multiplier=multiplier,
+                                 rows=registry.rows(st.session_state[f'{role}_rows'], dense))
+            if base is not None and overrides else None)
+
+# Function to update a batch of projections, only the changed players' rows are recomputed
+def update_projections(overrides):
+    st.session_state.setdefault('overrides', {}).update(overrides)
+    registry = st.session_state['players']
+    dense = registry.index_of_names(list(overrides))
+    for role, multiplier in (('flex', 1.0), ('captain', 1.5)):
+        base = st.session_state.get(f'{role}_base')
+        if base is not None:
+            update = fn.projection_deltas(base, overrides, proj_multiplier=multiplier,
+                                          rows=registry.rows(st.session_state[f'{role}_rows'], dense))
+            st.session_state[f'{role}_deltas'] = fn.merge_projection_deltas(
+                st.session_state.get(f'{role}_deltas'), update)
+    # Anything built from the previous projections is now stale
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
 
 # Function to update projection
 def update_projection(player_name, new_proj):
-    if 'flex_df' in st.session_state and st.session_state['flex_df'] is not None:
-        # Update projection in flex_df
-        player_mask = st.session_state['flex_df']['Name'] == player_name
-        # Store Original_Proj if not already stored
-        if 'Original_Proj' not in st.session_state['flex_df'].columns:
-            st.session_state['flex_df']['Original_Proj'] = st.session_state['flex_df']['Proj']
-        st.session_state['flex_df'].loc[player_mask, 'Proj'] = new_proj
-        # Recalculate percentiles
-        st.session_state['flex_df'] = adjust_percentiles(st.session_state['flex_df'])
-        # Recalculate dependent columns in flex_df
-        st.session_state['flex_df'] = recalculate_metrics(st.session_state['flex_df'])
-    if 'captain_df' in st.session_state and st.session_state['captain_df'] is not None:
-        # Update projection in captain_df
-        player_mask = st.session_state['captain_df']['Name'] == player_name
-        # Store Original_Proj if not already stored
-        if 'Original_Proj' not in st.session_state['captain_df'].columns:
-            st.session_state['captain_df']['Original_Proj'] = st.session_state['captain_df']['Proj']
-        # Update 'Proj' in captain_df (1.5x flex projection)
-        new_captain_proj = new_proj * 1.5
-        st.session_state['captain_df'].loc[player_mask, 'Proj'] = new_captain_proj
-        # Recalculate percentiles
-        st.session_state['captain_df'] = adjust_percentiles(st.session_state['captain_df'])
-        # Recalculate dependent columns in captain_df
-        st.session_state['captain_df'] = recalculate_metrics(st.session_state['captain_df'])
-
-# Sidebar for updating player projections
-if 'flex_df' in st.session_state and st.session_state['flex_df'] is not None:
+    update_projections({player_name: new_proj})
+
+# A new version of the slate published while the session is open (the prep daemon re-preps
+# exports as they land) replaces the base tables, and the session's overrides go back on top
+if slate_cache.slate_version(selected_game, csv_dir) != st.session_state.get('slate_version'):
+    load_base_tables(selected_game)
+    apply_session_overrides()
+    st.session_state['projection_version'] = st.session_state.get('projection_version', 0) + 1
+    slate_path = fn.prepped_table_path(selected_game, 'flex', csv_dir)
+    changed = (slate_file.read_header(slate_path)['metadata'].get('changed')
+               if slate_path is not None and slate_path.endswith(slate_file.SLATE_EXTENSION) else None)
+    st.info("Slate updated" + (f": {', '.join(changed)}" if changed else "")
+            + (", your overrides were reapplied" if st.session_state.get('overrides') else ""))
+
+# Function to show a new set of lineups and keep it in the results store under its run config,
+# which includes the session's overrides and the slate's fingerprint, so a rebuild on a new
+# export is a new run rather than replacing the old one
+def store_lineups(new_lineups, config):
+    config = dict(config, overrides=st.session_state.get('overrides', {}),
+                  slate=st.session_state.get('slate_fingerprint'))
+    st.session_state['run_id'] = st.session_state['results'].save_run(
+        st.session_state['selected_game'], config, new_lineups, st.session_state['players'])
+    st.session_state['lineups_df'] = new_lineups
+    st.session_state['lineups_version'] = st.session_state['projection_version']
+    st.session_state['lineups_built'] = st.session_state.get('lineups_built', 0) + 1
+
+# Sidebar for updating player projections. Its inputs rerun only this fragment; an update reruns
+# the app so the tables pick it up
+@st.fragment
+def projection_controls():
+    st.write("## Update Player Projection")
+    registry = st.session_state['players']
+    player_names = st.session_state['flex_base']['Name'].unique()
+    selected_player = st.selectbox('Select player', player_names)
+    flex_row = registry.rows(st.session_state['flex_rows'], registry.index_of_names([selected_player]))[0]
+    current_proj = st.session_state['overrides'].get(selected_player,
+                                                     st.session_state['flex_base']['Proj'].iat[flex_row])
+    new_proj = st.number_input('New Projection', value=float(current_proj))
+    if st.button('Update Projection'):
+        update_projection(selected_player, new_proj)
+        app_tables.rerun_with_notice(f'Projection updated for {selected_player}')
+
+    st.write("## Upload Projection Overrides")
+    overrides_file = st.file_uploader('Overrides CSV (Name, Proj)', type='csv')
+    if overrides_file is not None and st.button('Apply Overrides'):
+        try:
+            overrides = fn.read_overrides_csv(overrides_file)
+            # Keyed by name or DFS ID, either resolves through the registry to a slate name
+            dense = registry.index_of_keys(overrides.index)
+            unknown = (dense < 0) | (registry.rows(st.session_state['flex_rows'], dense) < 0)
+            update_projections(dict(zip(registry.names[dense[~unknown]], overrides.to_numpy()[~unknown])))
+            app_tables.rerun_with_notice(f'Projections updated for {int((~unknown).sum())} players'
+                                         + (f", skipped {int(unknown.sum())} not on this slate" if unknown.any() else ""))
+        except ValueError as e:
+            st.error(str(e))
+
+if st.session_state.get('flex_base') is not None:
     with st.sidebar:
-        st.write("## Update Player Projection")
-        player_names = st.session_state['flex_df']['Name'].unique()
-        selected_player = st.selectbox('Select player', player_names)
-        current_proj = st.session_state['flex_df'].loc[st.session_state['flex_df']['Name'] == selected_player, 'Proj'].values[0]
-        new_proj = st.number_input('New Projection', value=float(current_proj))
-        if st.button('Update Projection'):
-            update_projection(selected_player, new_proj)
-            st.success(f'Projection updated for {selected_player}')
-
-# Retrieve dataframes from session state after updates
-captain_df = st.session_state.get('captain_df', None)
-flex_df = st.session_state.get('flex_df', None)
-
-def style_dataframe(df):
-    # Format numeric columns to display two decimal places
-    numeric_cols = df.select_dtypes(include=['float', 'float64']).columns
-    styled_df = df.style.format({col: "{:.2f}" for col in numeric_cols})
-
-    # Center all data
-    styled_df = styled_df.set_properties(**{
-        'text-align': 'center',
-        'background-color': '#f7f7f7',
-        'color': '#4d4d4d'
-    })
-
-    # Center the column headers and adjust background and font colors
-    styled_df = styled_df.set_table_styles([
-        {'selector': 'th', 'props': [
-            ('text-align', 'center'),
-            ('background-color', '#e0e0e0'),
-            ('color', '#4d4d4d')
-        ]}
-    ])
-
-    # Style the 'Proj' column
-    if 'Proj' in df.columns:
-        # Create a CSS style for the 'Proj' column
-        proj_style = [
-            {'selector': f'th.col{df.columns.get_loc("Proj")}', 'props': [
-                ('font-weight', 'bold'),
-                ('font-size', '16px'),
-                ('background-color', '#d9d9d9'),
-                ('color', '#4d4d4d')
-            ]},
-            {'selector': f'td.col{df.columns.get_loc("Proj")}', 'props': [
-                ('font-weight', 'bold'),
-                ('font-size', '16px'),
-                ('background-color', '#d9d9d9'),
-                ('color', '#4d4d4d')
-            ]}
-        ]
-        styled_df = styled_df.set_table_styles(proj_style, overwrite=False)
-
-    return styled_df
-
+        projection_controls()
+
+# Tables for this rerun: the shared base frames with the session's override rows laid over them
+captain_df = (fn.overlay_projection_deltas(st.session_state['captain_base'], st.session_state.get('captain_deltas'))
+              if st.session_state.get('captain_base') is not None else None)
+flex_df = (fn.overlay_projection_deltas(st.session_state['flex_base'], st.session_state.get('flex_deltas'))
+           if st.session_state.get('flex_base') is not None else None)
+
+# Sidebar for building lineups from the current projections. Its inputs rerun only this fragment,
+# so the tables aren't sent again while the options change; a build, swap or sim reruns the app.
+@st.fragment
+def lineup_controls():
+    st.write("## Build Lineups")
+    num_lineups = st.number_input('Number of lineups', min_value=1, max_value=150, value=20)
+    method = st.radio('Method', ['Optimizer', 'Exact top-N', 'Randomized'], horizontal=True)
+    # Randomized lineups are scored on draws around Proj, so the metric doesn't apply to them
+    metric = st.selectbox('Optimize for', ['Proj', '50th', '75th', '85th'], disabled=method == 'Randomized')
+    seed = st.number_input('Seed', min_value=0, value=0, step=1, disabled=method != 'Randomized')
+    max_exposure = st.slider('Max exposure', min_value=0.1, max_value=1.0, value=1.0, step=0.05,
+                             disabled=method == 'Exact top-N')
+    if st.button('Build Lineups'):
+        config = {'method': method, 'metric': metric, 'num_lineups': int(num_lineups),
+                  'max_exposure': max_exposure}
+        if method == 'Exact top-N':
+            new_lineups = enumeration.enumerate_lineups(captain_df, flex_df, metric=metric, top_k=int(num_lineups))
+            config.pop('max_exposure')
+        elif method == 'Randomized':
+            # Each lineup optimal for a projection set drawn from the 25th-85th band. The seed
+            # is part of the run config, so the stored run can be reproduced.
+            config.update(metric='Proj', seed=int(seed))
+            new_lineups = diversity.generate_randomized(captain_df, flex_df, int(num_lineups), seed=config['seed'],
+                                                        default_max_exposure=max_exposure)
+        else:
+            lineup_optimizer = optimizer.ShowdownOptimizer(captain_df, flex_df, metric=metric)
+            new_lineups = lineup_optimizer.generate(int(num_lineups), default_max_exposure=max_exposure)
+        store_lineups(new_lineups, config)
+        app_tables.rerun_with_notice(f"Built {len(new_lineups)} lineups")
+
+    # Late swap: locked players keep their slots, the open slots are re-optimized on the
+    # current projections
+    st.write("## Late Swap")
+    swap_file = st.file_uploader('Lineups CSV (CPT, FLEX1..FLEX5 or DK entries)', type='csv')
+    locked = st.multiselect('Locked players', flex_df['Name'].unique())
+    if st.button('Late Swap'):
+        try:
+            if swap_file is not None:
+                swap_lineups = optimizer.read_lineups_csv(swap_file)
+            else:
+                swap_lineups = st.session_state.get('lineups_df')
+            if swap_lineups is None:
+                st.warning("Upload a lineups CSV or build lineups first")
+            else:
+                lineup_optimizer = optimizer.ShowdownOptimizer(captain_df, flex_df, metric=metric)
+                store_lineups(lineup_optimizer.late_swap(swap_lineups, locked), {
+                    'method': 'Late Swap', 'metric': metric, 'locked': sorted(locked),
+                    'source': results_store.config_key(swap_lineups[fn.LINEUP_COLUMNS].to_numpy().tolist())})
+                app_tables.rerun_with_notice(f"Changed {int(st.session_state['lineups_df']['Swaps'].gt(0).sum())} "
+                                             f"of {len(st.session_state['lineups_df'])} lineups")
+        except ValueError as e:
+            st.error(str(e))
+
+    # Contest sims of the current lineups, stored with their run
+    if st.session_state.get('lineups_df') is not None:
+        st.write("## Simulate Contest")
+        field_size = st.number_input('Field size', min_value=100, max_value=100000, value=10000, step=1000)
+        num_sims = st.number_input('Simulations', min_value=100, max_value=10000, value=1000, step=100)
+        if st.button('Simulate Contest'):
+            sim_lineups = st.session_state['lineups_df'].drop(columns=list(results_store.SIM_COLUMNS),
+                                                              errors='ignore')
+            sim_results = contest.simulate_contest(captain_df, flex_df, sim_lineups, field_size=int(field_size),
+                                                   num_sims=int(num_sims), seed=0)
+            st.session_state['results'].save_sims(st.session_state['run_id'], sim_results)
+            st.session_state['lineups_df'] = sim_results
+            st.session_state['lineups_built'] = st.session_state.get('lineups_built', 0) + 1
+            app_tables.rerun_with_notice(f"Simulated {len(sim_results)} lineups")
+
+if captain_df is not None and flex_df is not None:
+    with st.sidebar:
+        lineup_controls()
+lineups_df = st.session_state.get('lineups_df', None)
 
 # Tabs for Captain and Flex
 if captain_df is not None or flex_df is not None:
-    tab_capt, tab_flex = st.tabs(["Capt", "Flex"])
+    tab_capt, tab_flex, tab_lineups = st.tabs(["Capt", "Flex", "Lineups"])
 
     if captain_df is not None:
         with tab_capt:
             st.write("Captain Table")
-            styled_captain_df = style_dataframe(captain_df)
-            st.write(styled_captain_df)
+            app_tables.show_table(captain_df)
     else:
         with tab_capt:
             st.warning("Captain data not available.")
@@ -219,12 +301,43 @@ if captain_df is not None or flex_df is not None:
     if flex_df is not None:
         with tab_flex:
             st.write("Flex Table")
-            styled_flex_df = style_dataframe(flex_df)
-            st.write(styled_flex_df)
+            app_tables.show_table(flex_df)
     else:
         with tab_flex:
             st.warning("Flex data not available.")
+
+    with tab_lineups:
+        if lineups_df is not None:
+            st.write("Lineups")
+            if st.session_state.get('lineups_version') != st.session_state.get('projection_version'):
+                st.warning("Projections have changed since these lineups were built, rebuild to refresh them.")
+            app_tables.show_table(lineups_df)
+            # DraftKings bulk upload of these lineups, with the DFS IDs from the slate's registry
+            try:
+                upload = io.StringIO()
+                lu.LineupStore.from_frame(fn.build_player_pool(captain_df, flex_df), lineups_df).to_dk_upload(
+                    upload, st.session_state['players'])
+                st.download_button('Download DK upload CSV', upload.getvalue(),
+                                   file_name=f"DK_upload_{selected_game}.csv", mime='text/csv')
+            except (ValueError, KeyError) as e:
+                st.warning(f"No DK upload for these lineups: {e}")
+            if st.session_state.get('run_id') is not None:
+                st.write("Exposure")
+                app_tables.show_table(st.session_state['results'].exposures(st.session_state['run_id'])
+                                      .drop(columns='player_id'))
+        else:
+            st.info("Build lineups from the sidebar to display them here.")
 else:
     st.error("No data available for the selected game.")
 
 st.write("Select different games from the sidebar to display.")
+
+# Sessions following live updates poll the slate's version on a timer. Only this fragment
+# reruns on the timer, the whole app reruns once a new version has been published.
+@st.fragment(run_every=settings.LIVE_REFRESH_SECONDS)
+def watch_slate_version():
+    if slate_cache.slate_version(selected_game, csv_dir) != st.session_state.get('slate_version'):
+        st.rerun()
+
+if follow_live:
+    watch_slate_version()